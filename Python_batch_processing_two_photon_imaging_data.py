@@ -0,0 +1,285 @@
+"""
+Batch processing of many recordings with LegVibration_separate_z and AxonRecording_separate_z.
+
+* **find_recordings**: find the ScanImage files, frame signal files and videos in a directory (paired in sorted order) and write a manifest (.yaml).
+
+* **run_batch**: run the stages of each recording in the manifest, in parallel over recordings.
+The completed stages and the output paths of each recording are saved in a state file next to the ScanImage file,
+so when the batch is run again (e.g. after a crash) the completed stages are skipped. A completed stage is run again
+(with the stages after it that use its outputs) if the input files or the config keys it depends on changed
+or one of its outputs no longer exists.
+
+* **run_recording**: run the stages of one recording (used by run_batch).
+
+Example:
+  manifest_filepath=find_recordings(path, 'AxonRecording_separate_z', 'Copy of 2*.tif', '*T1*', '*.mp4', path+'/config.yaml')
+  run_batch(manifest_filepath, n_workers=4)
+"""
+import os
+import fnmatch
+import traceback
+import yaml
+
+from Python_functions_for_preprocessing_and_analyzing_two_photon_imaging_data import run_in_parallel, stage_cache_key
+
+
+#stages run for each class (in this order) when the manifest does not list them
+default_stages={'LegVibration_separate_z':['filter_ScanImageFile_separate_z', 'motion_correction_separate_z', 'detect_camera_imaging_frames2',
+                                           'detect_piezo_start_frames', 'get_piezo_response_map_separate_z', 'merge_piezo_response_map'],
+                'AxonRecording_separate_z':['filter_ScanImageFile_separate_z', 'motion_correction_separate_z', 'detect_camera_imaging_frames2',
+                                            'detect_piezo_start_frames', 'make_synchronized_video_gray', 'get_piezo_response_map_separate_z',
+                                            'merge_piezo_response_map']}
+
+#attributes that are saved in the state file after each stage (the outputs of the stages)
+state_attributes=['gcamp_filtered_path', 'tdTomato_filtered_path', 'gcamp_registered_path', 'tdTomato_registered_path',
+                  'frame_data_path', 'piezo_data_path', 'map_data_path', 'merged_path', 'dF_F_path', 'dR_R_path', 'roi_traces_path', 'online_data_path',
+                  'video_path']
+
+#config keys that change the outputs of each stage (see get_stage_key). Keys that only change the speed (e.g. n_workers, cache_directory)
+#or the plots (e.g. min_range3, max_range3, plot) are not listed, so changing them does not run the stages again.
+registration_config_keys=['n_of_z', 'upsample', 'registration_channel', 'registration_normalization', 'registration_block_size']
+stage_config_keys={'filter_ScanImageFile_separate_z':['n_of_z', 'gaussian_filter', 'filter_engine'],
+                   'motion_correction_separate_z':registration_config_keys+['registration_reference', 'reference_tau', 'reference_window',
+                                                                            'volume_registration', 'volume_projection', 'volume_refine_threshold'],
+                   'filter_and_register_separate_z':registration_config_keys+['gaussian_filter', 'filter_engine', 'fused_reference_volumes'],
+                   'preprocess_online_separate_z':['n_of_z', 'gaussian_filter', 'upsample', 'registration_channel', 'registration_normalization',
+                                                   'online_filter_tau', 'online_reference_tau', 'online_baseline_tau', 'online_response_tau',
+                                                   'tdTomato_threshold', 'ratio_threshold', 'trace_gcamp_threshold'],
+                   'detect_camera_imaging_frames2':['number_of_channels', 'camera_channel', 'imaging_channel', 'c_height', 'c_width', 'c_distance',
+                                                    'i_height', 'i_width', 'i_distance', 'window_width'],
+                   'detect_piezo_start_frames':['number_of_channels', 'imaging_channel', 'piezo_channel', 'i_height', 'i_width', 'i_distance',
+                                                'window_width', 'n_of_z', 'skip_interval', 'piezo_debounce'],
+                   'make_synchronized_video_gray':['n_of_z', 'frames_per_second', 'min_range1', 'max_range1', 'min_range2', 'max_range2'],
+                   'make_synchronized_video_gray_piezo':['n_of_z', 'frames_per_second', 'min_range1', 'max_range1', 'min_range2', 'max_range2'],
+                   'get_piezo_response_map_separate_z':['n_of_z', 'response_range', 'base_range', 'gcamp_threshold_ratio', 'tdTomato_threshold',
+                                                        'ratio_threshold', 'map_dtype'],
+                   'get_pixel_traces_separate_z':['tdTomato_threshold', 'ratio_threshold', 'trace_baseline_window', 'trace_baseline_percentile',
+                                                  'trace_baseline_step', 'trace_gcamp_threshold'],
+                   'get_roi_traces_separate_z':['roi_filepath', 'tdTomato_threshold', 'ratio_threshold', 'trace_baseline_window',
+                                                'trace_baseline_percentile', 'trace_baseline_step', 'trace_gcamp_threshold'],
+                   'merge_piezo_response_map':[]}
+
+#stages whose outputs each stage uses (if they are run before it). Stages that are not listed use the outputs of all the stages before them.
+registration_stages=['motion_correction_separate_z', 'filter_and_register_separate_z']
+stage_dependencies={'filter_ScanImageFile_separate_z':[],
+                    'motion_correction_separate_z':['filter_ScanImageFile_separate_z'],
+                    'filter_and_register_separate_z':[],
+                    'preprocess_online_separate_z':[],
+                    'detect_camera_imaging_frames2':[],
+                    'detect_piezo_start_frames':[],
+                    'make_synchronized_video_gray':registration_stages+['detect_camera_imaging_frames2'],
+                    'make_synchronized_video_gray_piezo':registration_stages,
+                    'get_piezo_response_map_separate_z':registration_stages+['detect_piezo_start_frames'],
+                    'get_pixel_traces_separate_z':registration_stages,
+                    'get_roi_traces_separate_z':registration_stages,
+                    'merge_piezo_response_map':['get_piezo_response_map_separate_z']}
+
+
+def find_recordings(path, class_name, image_pattern='*.tif', frame_signal_pattern='*.bin', video_pattern='*.mp4', config_filepath=None, manifest_filepath=None):
+  """
+  a function to find the recordings in a directory and write them to a manifest (.yaml).
+  The ScanImage files, frame signal files and videos are sorted by name and paired in that order.
+
+  *class_name: 'LegVibration_separate_z' or 'AxonRecording_separate_z'.
+  *image_pattern, frame_signal_pattern, video_pattern: fnmatch patterns for each type of file (video_pattern is only used for AxonRecording_separate_z).
+  *config_filepath: config.yaml used for all recordings (default is path/config.yaml).
+  *manifest_filepath: default is path/manifest.yaml.
+
+  returns the path of the manifest.
+  """
+  if config_filepath is None:
+    config_filepath=os.path.join(path,'config.yaml')
+  if manifest_filepath is None:
+    manifest_filepath=os.path.join(path,'manifest.yaml')
+
+  file_names=sorted(os.listdir(path))
+  image_file_path=[os.path.join(path,file_name) for file_name in file_names if fnmatch.fnmatch(file_name,image_pattern)]
+  frame_signal_file_path=[os.path.join(path,file_name) for file_name in file_names if fnmatch.fnmatch(file_name,frame_signal_pattern)]
+  if len(image_file_path)!=len(frame_signal_file_path):
+    raise ValueError('found %d image files but %d frame signal files' % (len(image_file_path),len(frame_signal_file_path)))
+  if class_name=='AxonRecording_separate_z':
+    video_file_path=[os.path.join(path,file_name) for file_name in file_names if fnmatch.fnmatch(file_name,video_pattern)]
+    if len(image_file_path)!=len(video_file_path):
+      raise ValueError('found %d image files but %d videos' % (len(image_file_path),len(video_file_path)))
+
+  recordings=[]
+  for trial_index in range(len(image_file_path)):
+    recording={'class':class_name,
+               'data_filepath':image_file_path[trial_index],
+               'frame_signal_filepath':frame_signal_file_path[trial_index],
+               'config_filepath':config_filepath}
+    if class_name=='AxonRecording_separate_z':
+      recording['video_filepath']=video_file_path[trial_index]
+    recordings.append(recording)
+
+  with open(manifest_filepath, 'w') as yaml_file:
+    yaml.dump(recordings, yaml_file, sort_keys=False)
+  print(manifest_filepath)
+
+  return manifest_filepath
+
+
+def get_state_filepath(recording):
+  """
+  returns the path of the state file of a recording (next to the ScanImage file).
+  """
+  return recording['data_filepath'].split('.')[0]+'_batch_state.yaml'
+
+
+def load_state(state_filepath):
+  """
+  returns the state saved in state_filepath (or an empty state if the file does not exist).
+  """
+  if not os.path.exists(state_filepath):
+    return {'completed_stages':[], 'paths':{}, 'stages':{}, 'status':'pending', 'error':None}
+  with open(state_filepath, 'r') as file:
+    state=yaml.safe_load(file)
+  #state files written before the stage keys were saved: all stages are run again
+  state.setdefault('stages', {})
+  return state
+
+
+def save_state(state_filepath, state):
+  """
+  save the state to a temporary file and rename it, so the state file is never half written.
+  """
+  temporary_filepath=state_filepath+'.tmp'
+  with open(temporary_filepath, 'w') as yaml_file:
+    yaml.dump(state, yaml_file, sort_keys=False)
+  os.replace(temporary_filepath, state_filepath)
+
+
+def get_stage_dependencies(stage, stages):
+  """
+  returns the stages before stage in stages whose outputs it uses, directly or through the other stages (see stage_dependencies).
+  """
+  earlier_stages=stages[:stages.index(stage)]
+  if stage not in stage_dependencies:
+    return earlier_stages
+  dependencies=set()
+  for earlier_stage in earlier_stages:
+    if earlier_stage in stage_dependencies[stage]:
+      dependencies.add(earlier_stage)
+      dependencies.update(get_stage_dependencies(earlier_stage, stages))
+  return [earlier_stage for earlier_stage in earlier_stages if earlier_stage in dependencies]
+
+
+def get_stage_key(recording, stage, stages, config):
+  """
+  returns the key of a stage of a recording (see stage_cache_key) from the identity of the input files of the recording
+  (ScanImage file, frame signal file and video) and the config keys that change the outputs of the stage and of the stages
+  it depends on (see stage_config_keys and get_stage_dependencies), so it changes when the inputs or those config keys change.
+  The whole config is used for a stage that is not in stage_config_keys.
+  """
+  input_files=[recording[key] for key in ('data_filepath', 'frame_signal_filepath', 'video_filepath') if recording.get(key) is not None]
+  key_stages=[stage]+get_stage_dependencies(stage, stages)
+  if all(key_stage in stage_config_keys for key_stage in key_stages):
+    config_keys=sorted(set(key for key_stage in key_stages for key in stage_config_keys[key_stage]))
+    stage_config={key:config[0].get(key) for key in config_keys}
+  else:
+    stage_config=config
+  return stage_cache_key(stage, input_files, {'class':recording['class'], 'config':stage_config})
+
+
+def run_recording(recording):
+  """
+  a function to run the stages of one recording, skipping the stages that are already completed in its state file.
+  The key (see get_stage_key) and the output paths of each stage are saved in the state file after the stage. A completed stage
+  is only skipped if its key is the same and all its output paths exist; its outputs are then restored from the state file.
+  Otherwise it runs again, and so do the stages after it that use its outputs (see get_stage_dependencies).
+  Errors are saved in the state file (status 'failed') instead of being raised, so other recordings keep running.
+
+  *recording: dictionary from the manifest with class, data_filepath, frame_signal_filepath,
+  (video_filepath), config_filepath and optionally stages (list of method names) and plot (default False).
+
+  returns the state of the recording.
+  """
+  class_name=recording['class']
+  stages=recording.get('stages', default_stages[class_name])
+  state_filepath=get_state_filepath(recording)
+  state=load_state(state_filepath)
+
+  try:
+    if class_name=='LegVibration_separate_z':
+      from Python_class_for_preprocessing_and_analyzing_two_photon_imaging_data_piezo_multi_z import LegVibration_separate_z
+      experiment=LegVibration_separate_z(recording['data_filepath'], recording['frame_signal_filepath'], recording['config_filepath'])
+    elif class_name=='AxonRecording_separate_z':
+      from Python_class_for_preprocessing_and_analyzing_two_photon_imaging_data_AxonRecording_RH_Swing_multi_z import AxonRecording_separate_z
+      experiment=AxonRecording_separate_z(recording['data_filepath'], recording['frame_signal_filepath'], recording['video_filepath'],
+                                          recording['config_filepath'])
+    else:
+      raise ValueError('unknown class %s' % class_name)
+
+    #no plots when running in a batch (unless plot: True in the manifest)
+    experiment.plot=recording.get('plot', False)
+
+    with open(recording['config_filepath'], 'r') as file:
+      config=yaml.safe_load(file)
+
+    for stage in stages:
+      stage_key=get_stage_key(recording, stage, stages, config)
+      stage_state=state['stages'].get(stage)
+      if stage in state['completed_stages'] and stage_state is not None:
+        if stage_state['key']!=stage_key:
+          print('run again', stage, '(config or input files changed)', recording['data_filepath'])
+        elif not all(os.path.exists(path) for path in stage_state['outputs'].values()):
+          print('run again', stage, '(outputs missing)', recording['data_filepath'])
+        else:
+          #restore the outputs of the completed stage
+          for attribute, value in stage_state['outputs'].items():
+            setattr(experiment, attribute, value)
+          print('skip', stage, recording['data_filepath'])
+          continue
+      #the stages that use the outputs of this stage are not completed any more, so they run again after it
+      #(or in the next batch if this one stops before)
+      state['completed_stages']=[completed_stage for completed_stage in state['completed_stages'] if completed_stage in stages
+                                 and completed_stage!=stage and stage not in get_stage_dependencies(completed_stage, stages)]
+      state['status']='running '+stage
+      save_state(state_filepath, state)
+
+      previous_paths={attribute:getattr(experiment, attribute) for attribute in state_attributes}
+      getattr(experiment, stage)()
+
+      #the outputs of the stage are the paths it set
+      outputs={attribute:getattr(experiment, attribute) for attribute in state_attributes
+               if getattr(experiment, attribute) is not None and getattr(experiment, attribute)!=previous_paths[attribute]}
+      state['stages'][stage]={'key':stage_key, 'outputs':outputs}
+      state['completed_stages']=[completed_stage for completed_stage in stages if completed_stage in state['completed_stages']+[stage]]
+      state['paths']={attribute:getattr(experiment, attribute) for attribute in state_attributes if getattr(experiment, attribute) is not None}
+      save_state(state_filepath, state)
+
+    state['status']='completed'
+    state['error']=None
+  except Exception:
+    state['status']='failed'
+    state['error']=traceback.format_exc()
+    print(state['error'])
+  save_state(state_filepath, state)
+
+  return state
+
+
+def run_batch(manifest_filepath, n_workers=1, backend='process'):
+  """
+  a function to run all recordings in the manifest with n_workers processes (or threads, see run_in_parallel).
+  Each recording runs its stages in order; recordings run in parallel. Completed stages are skipped (see run_recording),
+  so run_batch can be called again with the same manifest to finish a batch that crashed or had failed recordings.
+  The status and output paths of each recording are written back to the manifest at the end.
+
+  returns the list of states (one per recording).
+  """
+  with open(manifest_filepath, 'r') as file:
+    recordings=yaml.safe_load(file)
+
+  states=run_in_parallel(run_recording, [(recording,) for recording in recordings], n_workers, backend)
+
+  for recording, state in zip(recordings, states):
+    recording['status']=state['status']
+    recording['completed_stages']=state['completed_stages']
+    recording['paths']=state['paths']
+    print(recording['data_filepath'], state['status'])
+
+  with open(manifest_filepath, 'w') as yaml_file:
+    yaml.dump(recordings, yaml_file, sort_keys=False)
+
+  return states
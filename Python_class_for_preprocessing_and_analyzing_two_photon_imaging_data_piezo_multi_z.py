@@ -7,32 +7,33 @@
 
 * **detect_camera_imaging_frames2**: use frame signals and mirror signals recorded for the two-photon image and IR high-speed camera to synchronize the two imaging streams.
 
+* **preprocess_online_separate_z**: filter and register the frames and update live DF/F and DR/R maps while the ScanImage file is being acquired, and report the latency of each frame.
+
 * **make_synchronized_video_gray**: make a video that shows two-photon images (both green and red channel) and IR high-speed camera images simultaneously for a quick review of the data.
 
 * **make_synchronized_video_gray_piezo**: same as above, but for piezo experiments (does not have IR high-speed camera images).
 
+* **get_pixel_traces_separate_z**: calculate the DF/F and DR/R time series of every pixel with a running percentile baseline.
+
+* **get_roi_traces_separate_z**: extract the traces (and DF/F and DR/R) of polygon ROIs with sparse pixel masks.
+
 * parameters are set in .yaml file
 
 """
 #Import packages
-from ScanImageTiffReader import ScanImageTiffReader
 import numpy as np
-import os
-import fnmatch
-import matplotlib.pyplot as plt
-from scipy.ndimage import gaussian_filter, median_filter
 import pickle
-import scipy.signal
-import re
-import pandas as pd
-import seaborn as sns
-import cv2
 import yaml
+#scipy.signal, cv2, matplotlib and seaborn are imported in the methods that use them,
+#so importing the class (e.g. in each worker process of a batch) stays fast.
 
-from skimage import data
-from skimage.registration import phase_cross_correlation
-from skimage.registration._phase_cross_correlation import _upsampled_dft
-from scipy.ndimage import fourier_shift
+from Python_functions_for_preprocessing_and_analyzing_two_photon_imaging_data import get_ScanImageFile_shape, filter_ScanImageFile_streaming, preprocess_ScanImageFile_fused, preprocess_ScanImageFile_online, latency_summary, register_z_levels, piezo_response_maps, image_stack_min, pixel_traces
+from Python_functions_for_preprocessing_and_analyzing_two_photon_imaging_data import rasterize_rois, roi_traces, roi_trace_responses
+from Python_functions_for_preprocessing_and_analyzing_two_photon_imaging_data import register_z_levels_running, register_volumes
+from Python_functions_for_preprocessing_and_analyzing_two_photon_imaging_data import create_image_stack, load_image_stack, save_image_stack
+from Python_functions_for_preprocessing_and_analyzing_two_photon_imaging_data import stage_cache_key, restore_cached_stage, store_cached_stage, load_analog_signals, match_nearest_peaks
+from Python_functions_for_preprocessing_and_analyzing_two_photon_imaging_data import detect_stimulus_epochs, load_piezo_epochs, profiled_stage
+from Python_functions_for_preprocessing_and_analyzing_two_photon_imaging_data import render_synchronized_video
 
 # Define a class "LegVibration_separate_z" for analyzing two-photon calcium imaging data in response to the
 #vibration stimuli (high frequency vibration with Piezo).
@@ -45,8 +46,9 @@ class LegVibration_separate_z:
   """
   This class initializes a LegVibration_separate_z objects with attributes: data_file_path, frame_signal_filepath,
   config_filepath, etc (all parameters are included in the config.yaml configuration file)
-  and methods: filter_ScanImageFile_separate_z, motion_correction_separate_z, detect_camera_imaging_frames2,
-  detect_piezo_start_frames, make_synchronized_video_gray_piezo, get_piezo_response_map_separate_z,
+  and methods: filter_ScanImageFile_separate_z, motion_correction_separate_z, filter_and_register_separate_z, preprocess_online_separate_z,
+  detect_camera_imaging_frames2, detect_piezo_start_frames, make_synchronized_video_gray_piezo, get_piezo_response_map_separate_z,
+  get_pixel_traces_separate_z, get_roi_traces_separate_z
   and merge_piezo_response_map
   """
   def __init__(self,data_filepath,frame_signal_filepath,config_filepath):
@@ -67,6 +69,8 @@ class LegVibration_separate_z:
     self.i_distance = config[0]['i_distance']
     self.window_width = config[0]['window_width']
     self.skip_interval = config[0]['skip_interval']
+    #minimum number of samples between two piezo stimuli (optional, older config files use skip_interval)
+    self.piezo_debounce = config[0].get('piezo_debounce', self.skip_interval)
 
     self.n_of_z = config[0]['n_of_z']
     self.frames_per_second = config[0]['frames_per_second']
@@ -81,9 +85,59 @@ class LegVibration_separate_z:
     self.ratio_threshold = config[0]['ratio_threshold']
     self.response_range = config[0]['response_range']
     self.base_range = config[0]['base_range']
+    #'float64' (default) or 'float32' for the response maps (see piezo_response_maps)
+    self.map_dtype = config[0].get('map_dtype', 'float64')
+    #running percentile baseline of the pixel traces (optional, see get_pixel_traces_separate_z)
+    self.trace_baseline_window = config[0].get('trace_baseline_window', 101)
+    self.trace_baseline_percentile = config[0].get('trace_baseline_percentile', 10)
+    self.trace_baseline_step = config[0].get('trace_baseline_step', 25)
+    self.trace_chunk_frames = config[0].get('trace_chunk_frames', 100)
+    self.trace_gcamp_threshold = config[0].get('trace_gcamp_threshold', 0)
+    #causal filter, running reference and live maps of the online mode (optional, see preprocess_online_separate_z)
+    self.online_filter_tau = config[0].get('online_filter_tau', None)
+    self.online_reference_tau = config[0].get('online_reference_tau', 100)
+    self.online_baseline_tau = config[0].get('online_baseline_tau', 100)
+    self.online_response_tau = config[0].get('online_response_tau', 3)
+    self.online_poll_interval = config[0].get('online_poll_interval', 0.05)
+    self.online_idle_timeout = config[0].get('online_idle_timeout', 10)
+    #pickle file with the polygon ROIs (optional, see get_roi_traces_separate_z)
+    self.roi_filepath = config[0].get('roi_filepath', None)
 
     self.upsample = config[0]['upsample']
     self.registration_channel = config[0]['registration_channel']
+    #number of frames registered at a time (optional, older config files do not have it)
+    self.registration_block_size = config[0].get('registration_block_size', 32)
+    #'phase' (default, same as phase_cross_correlation) or None (see register_images_batched)
+    self.registration_normalization = config[0].get('registration_normalization', 'phase')
+    #'average' (default), 'exponential' or 'window' reference for motion_correction_separate_z (see register_running_reference)
+    self.registration_reference = config[0].get('registration_reference', 'average')
+    self.reference_tau = config[0].get('reference_tau', 100)
+    self.reference_window = config[0].get('reference_window', 100)
+    #one shift per volume from the 'max' or 'mean' projection over z (see register_volumes), frames with a residual
+    #shift above volume_refine_threshold (pixels, None: no refinement) are registered per z-level
+    self.volume_registration = config[0].get('volume_registration', False)
+    self.volume_projection = config[0].get('volume_projection', 'max')
+    self.volume_refine_threshold = config[0].get('volume_refine_threshold', None)
+    #number of threads (or processes) to process z-levels and frame chunks in parallel (optional)
+    self.n_workers = config[0].get('n_workers', 1)
+    self.parallel_backend = config[0].get('parallel_backend', 'thread')
+    #number of volumes read from the ScanImage file at a time (optional)
+    self.read_chunk_volumes = config[0].get('read_chunk_volumes', 100)
+    #'scipy' (default), 'float32' or 'fft' (see gaussian_filter_frames)
+    self.filter_engine = config[0].get('filter_engine', 'scipy')
+    #volumes used as the reference image in filter_and_register_separate_z (optional, None is all volumes)
+    self.fused_reference_volumes = config[0].get('fused_reference_volumes', None)
+    #directory to cache the outputs of the filtering and registration (optional, None disables the cache)
+    #and its maximum size in GB (least recently used outputs are deleted first)
+    self.cache_directory = config[0].get('cache_directory', None)
+    self.cache_max_gb = config[0].get('cache_max_gb', 100)
+    #show the diagnostic plots (optional, set to False for batch processing).
+    #the diagnostic arrays (frame intervals, maps) are always kept in self.diagnostics
+    self.plot = config[0].get('plot', True)
+    #file to append one JSON line per stage with its time, memory and I/O (optional, None disables it)
+    #and whether to save a cProfile of each stage (see profiled_stage)
+    self.profile_path = config[0].get('profile_path', None)
+    self.profile_cprofile = config[0].get('profile_cprofile', False)
 
     self.data_filepath = data_filepath
     self.frame_signal_filepath = frame_signal_filepath
@@ -95,8 +149,19 @@ class LegVibration_separate_z:
     self.piezo_data_path = None
     self.map_data_path = None
     self.merged_path = None
-
-
+    self.dF_F_path = None
+    self.dR_R_path = None
+    self.roi_traces_path = None
+    self.online_data_path = None
+    self.video_path = None
+    #memory-mapped frame signal file (see get_analog_signal)
+    self.analog_signals = None
+    self.analog_signals_path = None
+    self.diagnostics = {}
+    self.profile_records = []
+
+
+  @profiled_stage(frames='tdTomato_filtered_path')
   def filter_ScanImageFile_separate_z(self):
     """
     This method loads the image generated by scanImage, demultiplex it into
@@ -111,63 +176,56 @@ class LegVibration_separate_z:
     file_name=self.data_filepath
     gaussian_sigma_array=self.gaussian_sigma
     n_of_z=self.n_of_z
-
-    #Load the image using ScanImageTiffReader
-    TimeSeries=ScanImageTiffReader(file_name).data()
-    #Close the file
-    ScanImageTiffReader(file_name).close()
+    n_workers=self.n_workers
+    parallel_backend=self.parallel_backend
+    chunk_volumes=self.read_chunk_volumes
+    filter_engine=self.filter_engine
+    #split each z-level into frame chunks if there are more workers than channels and z-levels
+    n_of_chunks=max(1,n_workers//(2*n_of_z))
 
     #Currently the images are multiplexed so NofFrames*NoChannels*n_of_z
-    #is the first dimension.
-
-    #We first split into two channels because we know they all have two channels
-    #for the 1st channel (start with 1 and take every other frame)
-    Channel_1_Index=np.arange(0, TimeSeries.shape[0],2)
-    Channel_2_Index=np.arange(1,TimeSeries.shape[0],2)
+    #is the first dimension. Read the file in chunks of volumes and
+    #route each page to its channel and z-level (see read_ScanImage_volumes),
+    #so the whole raw file never needs to be in memory.
+    n_of_frames, rows, columns = get_ScanImageFile_shape(file_name, n_of_z)
 
     #assuming GCaMP is channel 1 and tdT is channel 2
     #This is true for all downstairs experiments
+    #the filtered images are written directly into memory-mapped .npy files
+    image_file_name=file_name.split('.')
+    GCaMP_name=(image_file_name[0]+"GCaMP_Filtered_Zs")
+    tdTomato_name=(image_file_name[0]+"tdTomato_Filtered_Zs")
 
-    GCaMPSignal=TimeSeries[Channel_1_Index]
-    tdTomatoSignal=TimeSeries[Channel_2_Index]
-    del TimeSeries
+    #skip the filtering if the cache has the same file filtered with the same parameters
+    cache_key=stage_cache_key('filter_ScanImageFile_separate_z', [file_name],
+                              {'gaussian_filter':gaussian_sigma_array, 'n_of_z':n_of_z, 'filter_engine':filter_engine})
+    if restore_cached_stage(self.cache_directory, cache_key, [GCaMP_name, tdTomato_name]):
+      self.gcamp_filtered_path = GCaMP_name
+      self.tdTomato_filtered_path = tdTomato_name
+      return self.gcamp_filtered_path, self.tdTomato_filtered_path
 
-    #Split into different z-levels and apply 3D gaussian filter
-    #First for the GCaMP signal.
-    depth_avg_image_GCaMP=np.zeros((n_of_z,GCaMPSignal.shape[0]//n_of_z,GCaMPSignal.shape[1],GCaMPSignal.shape[2]),dtype=np.int16)
+    depth_avg_image_GCaMP=create_image_stack(GCaMP_name,(n_of_z,n_of_frames,rows,columns))
+    depth_avg_image_tdTomato=create_image_stack(tdTomato_name,(n_of_z,n_of_frames,rows,columns))
 
-    for depth in range(n_of_z):
-        depthIndex=np.arange(depth,GCaMPSignal.shape[0],n_of_z)
-        depth_avg_image_GCaMP[depth,:,:,:] = np.round(gaussian_filter(GCaMPSignal[depthIndex], sigma=gaussian_sigma_array))
+    #Split into different z-levels and apply 3D gaussian filter (both channels)
+    filter_ScanImageFile_streaming(file_name, n_of_z, gaussian_sigma_array, [depth_avg_image_GCaMP, depth_avg_image_tdTomato],
+                                   chunk_volumes, n_of_chunks, n_workers, parallel_backend, filter_engine)
 
     #save the depth_avg_image
-    image_file_name=file_name.split('.')
-    GCaMP_name=(image_file_name[0]+"GCaMP_Filtered_Zs")
     print(GCaMP_name)
-    with open(GCaMP_name, "wb") as f:
-      pickle.dump(depth_avg_image_GCaMP,f)
+    depth_avg_image_GCaMP.flush()
     del depth_avg_image_GCaMP
-
-    #Do the same for the tdTomato signal.
-    depth_avg_image_tdTomato=np.zeros((n_of_z,tdTomatoSignal.shape[0]//n_of_z,tdTomatoSignal.shape[1],tdTomatoSignal.shape[2]),dtype=np.int16)
-
-    for depth in range(n_of_z):
-        depthIndex=np.arange(depth,tdTomatoSignal.shape[0],n_of_z)
-        depth_avg_image_tdTomato[depth,:,:,:] = np.round(gaussian_filter(tdTomatoSignal[depthIndex], sigma=gaussian_sigma_array))
-
-    #save the depth_avg_image
-    image_file_name=file_name.split('.')
-    tdTomato_name=(image_file_name[0]+"tdTomato_Filtered_Zs")
     print(tdTomato_name)
-    with open(tdTomato_name, "wb") as f:
-      pickle.dump(depth_avg_image_tdTomato,f)
+    depth_avg_image_tdTomato.flush()
     del depth_avg_image_tdTomato
 
+    store_cached_stage(self.cache_directory, cache_key, [GCaMP_name, tdTomato_name], self.cache_max_gb)
     self.gcamp_filtered_path = GCaMP_name
     self.tdTomato_filtered_path = tdTomato_name
 
     return self.gcamp_filtered_path, self.tdTomato_filtered_path
 
+  @profiled_stage(frames='tdTomato_registered_path')
   def motion_correction_separate_z(self):
 
     """
@@ -175,95 +233,265 @@ class LegVibration_separate_z:
     individual images to the average image. Use subpixel registration algorithm
     that uses FFT. Use the registration_channel to register images. Use the same
     shift for both channels in the two-photon images.
+    With registration_reference: 'exponential' or 'window' the images are registered
+    in one pass to a running average of the registered images instead (see register_running_reference).
+    With volume_registration: True all z-levels of a volume are registered with one shift, found from their projection
+    over z (see register_volumes). The number of frames (of all z-levels) registered per z-level instead is in .diagnostics['volume_registration'].
     """
     registration_channel=self.registration_channel
     gcamp_filtered_path = self.gcamp_filtered_path
     tdTomato_filtered_path = self.tdTomato_filtered_path
     upsample = self.upsample
     n_of_z = self.n_of_z
+    block_size = self.registration_block_size
+    n_workers = self.n_workers
+    parallel_backend = self.parallel_backend
+    normalization = self.registration_normalization
+    reference = self.registration_reference
+    volume_registration = self.volume_registration
+    if volume_registration and reference!='average':
+      raise ValueError("volume_registration needs registration_reference: 'average'")
+    #split each z-level into frame chunks if there are more workers than z-levels
+    n_of_chunks = max(1,n_workers//n_of_z)
+
+    #skip the registration if the cache has the same filtered images registered with the same parameters
+    parameters={'upsample':upsample, 'registration_channel':registration_channel}
+    if normalization!='phase' or reference!='average':
+      parameters.update({'registration_normalization':normalization, 'registration_reference':reference,
+                         'reference_tau':self.reference_tau, 'reference_window':self.reference_window, 'registration_block_size':block_size})
+    if volume_registration:
+      parameters.update({'volume_registration':True, 'volume_projection':self.volume_projection,
+                         'volume_refine_threshold':self.volume_refine_threshold, 'registration_block_size':block_size})
+    cache_key=stage_cache_key('motion_correction_separate_z', [gcamp_filtered_path, tdTomato_filtered_path], parameters)
+    cached_files=[gcamp_filtered_path+"_registered_Zs", tdTomato_filtered_path+"_registered_Zs"]
+    if restore_cached_stage(self.cache_directory, cache_key, cached_files):
+      self.gcamp_registered_path, self.tdTomato_registered_path = cached_files
+      return self.gcamp_registered_path, self.tdTomato_registered_path
 
     #This version keeps each z level separate and register each one.
     ### For now use the average of gaussian filtered data to register the images.
     #use the registration channel to correct for motion.
     #apply the same shift to the other channel.
 
-    #Get filtered images for registration channel
+    #Get filtered images for registration channel (memory-mapped)
     if registration_channel==1:
       #use gcamp signal to register
-      with open(gcamp_filtered_path, "rb") as f:
-        filtered_images=pickle.load(f)
+      filtered_images=load_image_stack(gcamp_filtered_path)
       #load the tdTomato signal as well
-      with open(tdTomato_filtered_path, "rb") as f:
-        filtered_images2=pickle.load(f)
+      filtered_images2=load_image_stack(tdTomato_filtered_path)
+      outfile_name=(gcamp_filtered_path+"_registered_Zs")
+      outfile_name2=(tdTomato_filtered_path+"_registered_Zs")
     else:
       #use tdTomato signal to register
-      with open(tdTomato_filtered_path, "rb") as f:
-        filtered_images=pickle.load(f)
+      filtered_images=load_image_stack(tdTomato_filtered_path)
       #load the gcamp signal as well
-      with open(gcamp_filtered_path, "rb") as f:
-        filtered_images2=pickle.load(f)
+      filtered_images2=load_image_stack(gcamp_filtered_path)
+      outfile_name=(tdTomato_filtered_path+"_registered_Zs")
+      outfile_name2=(gcamp_filtered_path+"_registered_Zs")
 
     #filtered_images is np array with [n_of_z, frames, rows, columns]
     n_of_frames=filtered_images.shape[1]
 
-    #initialize an array with the same size and data type as filtered images
-    registered_images=np.zeros_like(filtered_images)
-    registered_images2=np.zeros_like(filtered_images2)
-
-    #run motion correction for each z-level.
-    for z_level in range(n_of_z):
-      #make an average image to register to.
-      average_image=np.mean(filtered_images[z_level,:,:,:],axis=0)
-
-      for frame in range(n_of_frames):
-
-        # subpixel precision
-        shift, error, diffphase = phase_cross_correlation(average_image, filtered_images[z_level,frame,:,:],upsample_factor=upsample)
-        #correct for the movement
-        new_image = fourier_shift(np.fft.fftn(filtered_images[z_level,frame,:,:]), shift)
-        new_image2 = fourier_shift(np.fft.fftn(filtered_images2[z_level,frame,:,:]), shift)
-        new_image = np.fft.ifftn(new_image)
-        new_image2 = np.fft.ifftn(new_image2)
-        new_image = new_image.real
-        new_image2 = new_image2.real
-        registered_images[z_level,frame,:,:]=np.round(new_image)
-        registered_images2[z_level,frame,:,:]=np.round(new_image2)
+    #initialize memory-mapped arrays with the same size and data type as filtered images
+    registered_images=create_image_stack(outfile_name,filtered_images.shape,filtered_images.dtype)
+    registered_images2=create_image_stack(outfile_name2,filtered_images2.shape,filtered_images2.dtype)
+
+    if reference=='average':
+      #make an average image to register to for each z-level.
+      average_images=np.mean(filtered_images,axis=1)
+
+      if volume_registration:
+        #one shift per volume for all z-levels and both channels
+        _, n_of_refined = register_volumes(average_images, filtered_images, upsample, registered_images, filtered_images2, registered_images2,
+                                           self.volume_projection, self.volume_refine_threshold, block_size, n_workers, normalization)
+        self.diagnostics['volume_registration']={'refined_frames':n_of_refined}
+        print('volume registration: %d of %d frames refined per z-level' % (n_of_refined, n_of_z*n_of_frames))
+      else:
+        #run motion correction for each z-level (in parallel if n_workers>1).
+        # subpixel precision. Register blocks of frames at a time and
+        #correct for the movement in both channels with the same shift.
+        register_z_levels(average_images, filtered_images, upsample, registered_images, filtered_images2, registered_images2,
+                          block_size, n_of_chunks, n_workers, parallel_backend, normalization)
+    else:
+      #register in one pass to a running reference that is updated with the registered frames
+      register_z_levels_running(filtered_images, upsample, registered_images, filtered_images2, registered_images2, reference,
+                                self.reference_tau, self.reference_window, block_size, n_workers, normalization)
 
     #Save the registered images
-    if registration_channel==1:
+    registered_images.flush()
+    registered_images2.flush()
+    print(outfile_name)
+    print(outfile_name2)
+    del registered_images
+    del registered_images2
 
+    if registration_channel==1:
       #we used gcamp signal to register.
-      outfile_name=(gcamp_filtered_path+"_registered_Zs")
-      print(outfile_name)
-      with open(outfile_name, "wb") as f:
-        pickle.dump(registered_images,f)
       self.gcamp_registered_path = outfile_name
-      #Also save tdTomato signals
-      outfile_name=(tdTomato_filtered_path+"_registered_Zs")
-      print(outfile_name)
-      with open(outfile_name, "wb") as f:
-        pickle.dump(registered_images2,f)
-      self.tdTomato_registered_path = outfile_name
-
+      self.tdTomato_registered_path = outfile_name2
     else:
       #we used tdTomato signal to register.
-      outfile_name=(tdTomato_filtered_path+"_registered_Zs")
-      print(outfile_name)
-      with open(outfile_name, "wb") as f:
-        pickle.dump(registered_images,f)
       self.tdTomato_registered_path = outfile_name
-      #Also save gcamp signals
-      outfile_name=(gcamp_filtered_path+"_registered_Zs")
-      print(outfile_name)
-      with open(outfile_name, "wb") as f:
-        pickle.dump(registered_images2,f)
-      self.gcamp_registered_path = outfile_name
+      self.gcamp_registered_path = outfile_name2
+
+
+
+    store_cached_stage(self.cache_directory, cache_key, [self.gcamp_registered_path, self.tdTomato_registered_path], self.cache_max_gb)
+
+    return self.gcamp_registered_path, self.tdTomato_registered_path
 
 
+  @profiled_stage(frames='tdTomato_registered_path')
+  def filter_and_register_separate_z(self):
+    """
+    This method runs filter_ScanImageFile_separate_z and motion_correction_separate_z
+    in one pass: chunks of frames are demultiplexed, gaussian filtered and registered
+    and only the registered images are saved (the filtered images are never written to disk).
+    Use instead of the two methods above. Sets gcamp_registered_path and tdTomato_registered_path
+    (same file names as the two methods) so the other methods work the same.
+    With fused_reference_volumes: None (default) the images are registered to the average of
+    all filtered frames (same result as the two methods, the ScanImage file is read twice).
+    With fused_reference_volumes: N the images are registered to the average of the
+    first N filtered volumes and the ScanImage file is read only once.
+    """
+    file_name=self.data_filepath
+    gaussian_sigma_array=self.gaussian_sigma
+    n_of_z=self.n_of_z
+    registration_channel=self.registration_channel
+    upsample=self.upsample
+    reference_volumes=self.fused_reference_volumes
+    block_size=self.registration_block_size
+    n_workers=self.n_workers
+    parallel_backend=self.parallel_backend
+    chunk_volumes=self.read_chunk_volumes
+    filter_engine=self.filter_engine
+    #split each z-level into frame chunks if there are more workers than z-levels
+    n_of_chunks=max(1,n_workers//n_of_z)
+
+    n_of_frames, rows, columns = get_ScanImageFile_shape(file_name, n_of_z)
+
+    #assuming GCaMP is channel 1 and tdT is channel 2
+    image_file_name=file_name.split('.')
+    GCaMP_name=(image_file_name[0]+"GCaMP_Filtered_Zs"+"_registered_Zs")
+    tdTomato_name=(image_file_name[0]+"tdTomato_Filtered_Zs"+"_registered_Zs")
+
+    parameters={'gaussian_filter':gaussian_sigma_array, 'n_of_z':n_of_z, 'filter_engine':filter_engine, 'upsample':upsample,
+                'registration_channel':registration_channel, 'fused_reference_volumes':reference_volumes}
+    if self.registration_normalization!='phase':
+      parameters['registration_normalization']=self.registration_normalization
+    cache_key=stage_cache_key('filter_and_register_separate_z', [file_name], parameters)
+    if restore_cached_stage(self.cache_directory, cache_key, [GCaMP_name, tdTomato_name]):
+      self.gcamp_registered_path = GCaMP_name
+      self.tdTomato_registered_path = tdTomato_name
+      return self.gcamp_registered_path, self.tdTomato_registered_path
+
+    registered_GCaMP=create_image_stack(GCaMP_name,(n_of_z,n_of_frames,rows,columns))
+    registered_tdTomato=create_image_stack(tdTomato_name,(n_of_z,n_of_frames,rows,columns))
+
+    #registration_channel 1 is GCaMP (index 0), 2 is tdTomato (index 1)
+    if registration_channel==1:
+      channel_index=0
+    else:
+      channel_index=1
+
+    #filter and register chunk by chunk, apply the same shift to the other channel.
+    preprocess_ScanImageFile_fused(file_name, n_of_z, gaussian_sigma_array, [registered_GCaMP, registered_tdTomato], channel_index, upsample,
+                                   reference_volumes, block_size, chunk_volumes, n_of_chunks, n_workers, parallel_backend, filter_engine,
+                                   self.registration_normalization)
+
+    #Save the registered images
+    registered_GCaMP.flush()
+    registered_tdTomato.flush()
+    print(GCaMP_name)
+    print(tdTomato_name)
+    del registered_GCaMP
+    del registered_tdTomato
+
+    store_cached_stage(self.cache_directory, cache_key, [GCaMP_name, tdTomato_name], self.cache_max_gb)
+    self.gcamp_registered_path = GCaMP_name
+    self.tdTomato_registered_path = tdTomato_name
 
     return self.gcamp_registered_path, self.tdTomato_registered_path
 
 
+  @profiled_stage
+  def preprocess_online_separate_z(self, callback=None):
+    """
+    This method preprocesses the ScanImage file while it is being acquired (online mode):
+    the pages are read as soon as they are written, demultiplexed into channels and z-levels,
+    filtered (spatial gaussian filter and a causal exponential filter in time), registered to
+    a running reference image of each z-level and added to the live DF/F and DR/R maps
+    (see preprocess_ScanImageFile_online). Stops when no new page is written for online_idle_timeout seconds.
+    *callback: called as callback(volume, registered, maps) after each volume (e.g. to show the registered
+    images and the live maps), see preprocess_ScanImageFile_online.
+    The latency of each frame (from the arrival of its pages to the end of its processing) is measured
+    and summarized in .diagnostics['online_latency'].
+    The shifts, the final maps and the latency are saved in a pickle file. Use the offline methods
+    (e.g. filter_and_register_separate_z) on the complete file for the final analysis.
+    """
+    file_name=self.data_filepath
+    gaussian_sigma_array=self.gaussian_sigma
+    filter_tau=self.online_filter_tau
+    if filter_tau is None:
+      filter_tau=gaussian_sigma_array[0]
+
+    #registration_channel 1 is GCaMP (index 0), 2 is tdTomato (index 1)
+    if self.registration_channel==1:
+      channel_index=0
+    else:
+      channel_index=1
+
+    shifts, maps, latency = preprocess_ScanImageFile_online(file_name, self.n_of_z, gaussian_sigma_array, channel_index, self.upsample, filter_tau,
+                                                            self.online_reference_tau, self.online_baseline_tau, self.online_response_tau,
+                                                            self.tdTomato_threshold, self.trace_gcamp_threshold, self.ratio_threshold,
+                                                            self.online_poll_interval, self.online_idle_timeout, callback,
+                                                            self.registration_normalization)
+    summary=latency_summary(latency)
+    self.diagnostics['online_latency']=summary
+    print('%d frames, latency (ms): mean %.1f, median %.1f, 95%% %.1f, max %.1f' % (summary['frames'], summary.get('mean_ms',0),
+          summary.get('median_ms',0), summary.get('p95_ms',0), summary.get('max_ms',0)))
+
+    if self.plot:
+      import matplotlib.pyplot as plt
+      fig, axs = plt.subplots(1,3, figsize=(12,5),tight_layout = True)
+
+      axs[0].imshow(np.max(maps[0],axis=0),vmin=self.min_range3,vmax=self.max_range3)
+      axs[0].set_yticks([])
+      axs[0].set_xticks([])
+      axs[0].set_title('live DF/F', fontsize=20)
+
+      axs[1].imshow(np.max(maps[1],axis=0),vmin=self.min_range3,vmax=self.max_range3)
+      axs[1].set_yticks([])
+      axs[1].set_xticks([])
+      axs[1].set_title('live DR/R', fontsize=20)
+
+      axs[2].hist(np.ravel(latency)*1000,bins=50)
+      axs[2].set_xlabel('latency (ms)')
+      axs[2].set_title('latency', fontsize=20)
+
+    image_file_name=file_name.split('.')
+    outfile_name=image_file_name[0]+'_online'
+    with open(outfile_name, "wb") as f:
+      pickle.dump([shifts, maps, latency], f)
+    print(outfile_name)
+
+    self.online_data_path = outfile_name
+
+    return self.online_data_path
+
+
+  def get_analog_signal(self, channel):
+    """
+    a method to get one channel of the frame signal file (.bin) as a view of the memory-mapped file.
+    The file is mapped once and reused by detect_camera_imaging_frames2 and detect_piezo_start_frames.
+    """
+    if self.analog_signals is None or self.analog_signals_path!=self.frame_signal_filepath:
+      self.analog_signals=load_analog_signals(self.frame_signal_filepath, self.number_of_channels)
+      self.analog_signals_path=self.frame_signal_filepath
+
+    return self.analog_signals[:,channel]
+
+  @profiled_stage
   def detect_camera_imaging_frames2(self):
     """
     a method for finding the match between the imaging frame and the camera frames.
@@ -276,9 +504,9 @@ class LegVibration_separate_z:
     * i_height, i_width, i_distance: same for the imaging frames.
     * window_width: window to average the frame signals (necessary if sampling rate is too high). Should be 10.
     """
+    import scipy.signal
     input_file=self.frame_signal_filepath
 
-    number_of_channels=self.number_of_channels
     camera_channel=self.camera_channel
     imaging_channel = self.imaging_channel
     c_height = self.c_height
@@ -290,19 +518,11 @@ class LegVibration_separate_z:
     window_width = self.window_width
 
 
-    #read the binary file.
-    frame_data=np.fromfile(input_file)
-
-    #Check the number of data points
-    number_of_data=frame_data.shape[0]
-
-    #Get the camera exposure signal
-    camera_frame_signal_index=np.arange(camera_channel,number_of_data,number_of_channels)
-    camera_frame_signal=frame_data[camera_frame_signal_index]
+    #Get the camera exposure signal (memory-mapped, shared with the other methods)
+    camera_frame_signal=self.get_analog_signal(camera_channel)
 
     #Get the image frame signal
-    image_frame_signal_index=np.arange(imaging_channel,number_of_data,number_of_channels)
-    image_frame_signal=frame_data[image_frame_signal_index]
+    image_frame_signal=self.get_analog_signal(imaging_channel)
     #Convolve the image_frame_signal
     image_frame_signal=np.convolve(image_frame_signal,np.ones((window_width,))/window_width, mode='valid')
 
@@ -317,31 +537,27 @@ class LegVibration_separate_z:
     #Use scipy.signal.find_peaks to get the peaks in the diff data.
     peaks_image, _ =scipy.signal.find_peaks(image_diff,height=i_height, width=i_width, distance=i_distance)
 
-    #plot to camera and frame interval to check the detection.
+    #camera and frame interval to check the detection (plot if plot is True).
     camera_interval=np.diff(peaks_camera)
-    plt.figure(figsize=(10,3))
-    plt.plot(camera_interval)
-    sns.despine()
-
     image_interval=np.diff(peaks_image)
-    plt.figure(figsize=(10,3))
-    plt.plot(image_interval)
-    sns.despine()
-
-    #Go through each imaging frame and find the camera frame with the closest index
+    self.diagnostics['camera_interval']=camera_interval
+    self.diagnostics['image_interval']=image_interval
+    if self.plot:
+      import matplotlib.pyplot as plt
+      import seaborn as sns
+      plt.figure(figsize=(10,3))
+      plt.plot(camera_interval)
+      sns.despine()
+
+      plt.figure(figsize=(10,3))
+      plt.plot(image_interval)
+      sns.despine()
+
+    #For each imaging frame find the camera frame with the closest index
     #This camera frame will be closest to the beginning of the image acquisition.
-    image_in_camera_index=np.zeros((peaks_image.shape[0],1), dtype=np.int)
-
-    #keep track of how far away the camera signal was relative to the imaging signal.
-    camera_minus_image_index=np.zeros((peaks_image.shape[0],1), dtype=np.int)
-
-    for n in range(peaks_image.shape[0]):
-        #take the absolute difference in the index between the image acquisition and all camera images
-        time_to_camera=np.absolute(peaks_camera-peaks_image[n])
-        #Find the camera image that is closest (frame number)
-        image_in_camera_index[n]=np.argmin(time_to_camera)
-        #find the time between the image peak and the closest camera peak. positive indicates that the camera began after the start of image acquisition
-        camera_minus_image_index[n]=peaks_camera[image_in_camera_index[n]]-peaks_image[n]
+    #also keep track of how far away the camera signal was relative to the imaging signal.
+    #positive indicates that the camera began after the start of image acquisition
+    image_in_camera_index, camera_minus_image_index = match_nearest_peaks(peaks_camera, peaks_image)
 
     #Save the two index in a pickle file
     new_file_name=input_file+'frame_data'
@@ -354,9 +570,10 @@ class LegVibration_separate_z:
 
     return self.frame_data_path
 
+  @profiled_stage
   def detect_piezo_start_frames(self):
     """
-    a method for finding the imaging frame where the piezo stimulus starts.
+    a method for finding the imaging frames (volumes) where each piezo stimulus starts and ends.
 
     * each object should have the path to the frame info file.
     * number_of_channels: number of channels in the data. Should be 7.
@@ -365,11 +582,13 @@ class LegVibration_separate_z:
     * i_height, i_width, i_distance: parameters for detecting image frame signal with scipy.signal.findpeaks.
     * window_width: window to average the frame signals (necessary if sampling rate is too high). Should be 10.
     * n_of_z: number of z-levels in the fast-z image stack
-    * skip_interval: number of samples to skip from the initial piezo start for the detection of the second stimulus
+    * piezo_debounce: minimum number of samples between the starts of two stimuli (skip_interval if it is not set).
+    The piezo signal is on during the vibration cycles of a stimulus, so onsets closer than this are the same stimulus.
+    Saves an [n_of_epochs, 2] array with the start and end volume of each stimulus.
     """
+    import scipy.signal
     input_file=self.frame_signal_filepath
 
-    number_of_channels=self.number_of_channels
     piezo_channel=self.piezo_channel
     imaging_channel = self.imaging_channel
     i_height = self.i_height
@@ -377,32 +596,20 @@ class LegVibration_separate_z:
     i_distance = self.i_distance
     window_width = self.window_width
     n_of_z = self.n_of_z
-    skip_interval = self.skip_interval
-
+    piezo_debounce = self.piezo_debounce
 
-    #read the binary file.
-    frame_data=np.fromfile(input_file)
 
-    #Check the number of data points
-    number_of_data=frame_data.shape[0]
-
-    #Get the piezo signal
-    piezo_signal_index=np.arange(piezo_channel,number_of_data,number_of_channels)
-    piezo_signal=frame_data[piezo_signal_index]
+    #Get the piezo signal (memory-mapped, shared with the other methods)
+    piezo_signal=self.get_analog_signal(piezo_channel)
 
     #find when the piezo was on: define "On" as time point that it reaches half max amplitude.
     piezo_threshold=(np.max(piezo_signal)-np.min(piezo_signal))/2+np.min(piezo_signal)
-    piezo_on=piezo_signal>=piezo_threshold
-
-    #find first start
-    first_start=np.argmax(piezo_on)
 
-    #Find second start: hard coded for now
-    second_start=np.argmax(piezo_on[first_start+skip_interval:])+first_start+skip_interval
+    #find the start and the end (sample) of all stimuli
+    piezo_epochs=detect_stimulus_epochs(piezo_signal,piezo_threshold,piezo_debounce)
 
     #Get the image frame signal
-    image_frame_signal_index=np.arange(imaging_channel,number_of_data,number_of_channels)
-    image_frame_signal=frame_data[image_frame_signal_index]
+    image_frame_signal=self.get_analog_signal(imaging_channel)
     #Convolve the image_frame_signal
     image_frame_signal=np.convolve(image_frame_signal,np.ones((window_width,))/window_width, mode='valid')
 
@@ -412,45 +619,41 @@ class LegVibration_separate_z:
     peaks_image, _ =scipy.signal.find_peaks(image_diff,height=i_height, width=i_width, distance=i_distance)
 
     image_interval=np.diff(peaks_image)
-    plt.figure(figsize=(10,3))
-    plt.plot(image_interval)
-    sns.despine()
+    self.diagnostics['piezo_epochs']=piezo_epochs
+    self.diagnostics['image_interval']=image_interval
+    if self.plot:
+      import matplotlib.pyplot as plt
+      import seaborn as sns
+      plt.figure(figsize=(10,3))
+      plt.plot(image_interval)
+      sns.despine()
 
     #we need to divide by n_of_z to convert to the volume number from the frame number
 
-    #Find the frame that's closest to the piezo start
-    time_to_piezo=np.absolute(peaks_image-first_start)
-    #Find the image that is closest (frame number)
-    first_piezo_frame=np.argmin(time_to_piezo)
-    #Find the volume that started after the piezo on.
-    first_piezo_frame=first_piezo_frame//n_of_z+1
-    print(first_piezo_frame)
-
-    #Find the frame that's closest to the second start
-    #Find the frame that's closest to the piezo start
-    time_to_piezo=np.absolute(peaks_image-second_start)
-    #Find the image that is closest (frame number)
-    second_piezo_frame=np.argmin(time_to_piezo)
-    second_piezo_frame=second_piezo_frame//n_of_z+1
-    print(second_piezo_frame)
-
-    #Save the two start times in a pickle file
+    #Find the frame that's closest to each piezo start and end (frame number)
+    piezo_frames, _ = match_nearest_peaks(peaks_image, piezo_epochs.ravel())
+    #Find the volume that started after the piezo on (and off).
+    piezo_volumes=(piezo_frames.reshape(-1,2)//n_of_z+1).astype(int)
+    print(piezo_volumes)
+
+    #Save the start and end volumes ([n_of_epochs, 2] array) in a pickle file
     new_file_name=input_file+'piezo_data'
 
     with open(new_file_name, "wb") as f:
-      pickle.dump([first_piezo_frame,second_piezo_frame], f)
+      pickle.dump(piezo_volumes, f)
     print(new_file_name)
 
     self.piezo_data_path = new_file_name
 
     return self.piezo_data_path
 
+  @profiled_stage(frames='tdTomato_registered_path')
   def make_synchronized_video_gray_piezo(self):
     """
     For Piezo trials that don't have the videos.
     a method to load the filtered and registered data for both tdTomato and GCaMP
     and make a synchronized .avi movie.
-    *tdTomato_file: a pickle file that contains the filtered and registered tdTomato images.
+    *tdTomato_file: a .npy (or older pickle) file that contains the filtered and registered tdTomato images.
     Each object should have a path to this file
     *GCaMP_file: same for the GCaMP.
     * n_of_z: number of z levels
@@ -469,61 +672,36 @@ class LegVibration_separate_z:
     min_range2 = self.min_range2
     max_range2 = self.max_range2
 
-    #Get tdTomato images
-    with open(tdTomato_file, "rb") as f:
-      tdTomato_Filtered=pickle.load(f)
+    #Get tdTomato images (memory-mapped, [n_of_z, frames, rows, columns])
+    tdTomato_Filtered=load_image_stack(tdTomato_file)
     #Get GCaMP images
-    with open(GCaMP_file, "rb") as f:
-      GCaMP_Filtered=pickle.load(f)
-
-    #Number of frames should be the same for tdTomato and GCaMP.
-    total_frames=tdTomato_Filtered.shape[0]
-    x_size=tdTomato_Filtered.shape[2]#number of columns
-    y_size=tdTomato_Filtered.shape[1]#number of rows
+    GCaMP_Filtered=load_image_stack(GCaMP_file)
 
-    #Make a video with the tdTomato signal + GCaMP signal + prep image
+    #Make a video with the tdTomato signal + GCaMP signal
+    #(maximum intensity projection over z-levels)
     video_name = (tdTomato_file+"synchronized_video_gray.avi")
-    #Image width will be 2 * imaging_width
-    #Final "0" necessary for gray scale image
-    video = cv2.VideoWriter(video_name,cv2.VideoWriter_fourcc(*'mp4v'),frames_per_second,(x_size*2,y_size),0)
 
+    #For making video, all numbers below min_range will be treated as 0.
+    #all numbers above max_range will be treated as max_range value.
+    #Then normalize the image to be between 0 to 255 (with a lookup table, see render_synchronized_video).
+    render_synchronized_video(video_name,tdTomato_Filtered,GCaMP_Filtered,(min_range1,max_range1),(min_range2,max_range2),frames_per_second,
+                              n_workers=self.n_workers)
 
-    #For making video, all numbers below min_range1 will be treated as 0.
-    #all numbers above max_range1 will be treated as max_range1 value.
-    #Then normalize the image to be between 0 to 255.
-    tdTomato_Filtered[tdTomato_Filtered<=min_range1]=0
-    tdTomato_Filtered[tdTomato_Filtered>=max_range1]=max_range1
-    range_adjusted_tdTomato=(tdTomato_Filtered/max_range1)*255
+    print(video_name)
 
-    #For GCaMP
-    GCaMP_Filtered[GCaMP_Filtered<=min_range2]=0
-    GCaMP_Filtered[GCaMP_Filtered>=max_range2]=max_range2
-    range_adjusted_GCaMP=(GCaMP_Filtered/max_range2)*255
-
-    #Initialize the frame
-    frame_original=np.zeros((y_size,x_size*2))
-
-    for video_frame in range(total_frames):
-      #Insert images in the right location.
-      frame_original[:,0:x_size]=range_adjusted_tdTomato[video_frame,:,:]
-      frame_original[:,x_size:x_size*2]=range_adjusted_GCaMP[video_frame,:,:]
-
-      frame=np.uint8(frame_original)
-
-      video.write(frame)
-
-    video.release()
+    self.video_path = video_name
 
+  @profiled_stage
   def get_piezo_response_map_separate_z(self):
     """
     a method to generate the DF/F and DR/R response map in separate z level
     for the piezo stimulation:
     load the filtered and registered data for both tdTomato and GCaMP and calculate
-    the DF/F and DR/R map during the two piezo stimuli and average them.
-    *tdTomato_file: a pickle file that contains the filtered and registered tdTomato images.
+    the DF/F and DR/R map during all piezo stimuli and average them.
+    *tdTomato_file: a .npy (or older pickle) file that contains the filtered and registered tdTomato images.
     Each object should have a path to this file
     *GCaMP_file: same for the GCaMP.
-    *piezo_data_file: a file that contains first and second piezo start frames (volumes)
+    *piezo_data_file: a file that contains the start and end frames (volumes) of the piezo stimuli (or first and second start in older files)
     *min_range and max_range defines the min and max for the DF/F and DR/R images.
 
 
@@ -540,34 +718,25 @@ class LegVibration_separate_z:
     response_range = self.response_range
     base_range = self.base_range
     n_of_z = self.n_of_z
+    map_dtype = self.map_dtype
 
     #load the info on piezo start frame and get the tdTomato and gcamp data (filtered and registered)
-    with open(piezo_data_file, "rb") as f:
-      [first_piezo_start,second_piezo_start]=pickle.load(f)
+    piezo_starts=load_piezo_epochs(piezo_data_file)[:,0]
 
-    with open(tdTomato_file,"rb") as f:
-      tdTomato_registered=pickle.load(f)
+    #memory-mapped: only the baseline and response windows are read
+    tdTomato_registered=load_image_stack(tdTomato_file)
 
-    with open(gcamp_file,"rb") as f:
-      gcamp_registered=pickle.load(f)
+    gcamp_registered=load_image_stack(gcamp_file)
 
     #tdTomato_registered and gcamp_registered may contain negative pixel values.
     #image brightness should always be positive (or zero), so subtract the min
-    #value to make all values above zero.
-    tdTomato_registered=tdTomato_registered-np.min(tdTomato_registered)
-    gcamp_registered=gcamp_registered-np.min(gcamp_registered)
-
-    #initialize the data array
-    average_tdTomato_all=np.zeros((n_of_z,tdTomato_registered.shape[2],tdTomato_registered.shape[3]))
-    average_gcamp_all=np.zeros_like(average_tdTomato_all)
-    base_tdTomato_all=np.zeros_like(average_tdTomato_all)
-    base_gcamp_all=np.zeros_like(average_tdTomato_all)
-    ratio_response_all=np.zeros_like(average_tdTomato_all)
-    ratio_baseline_all=np.zeros_like(average_tdTomato_all)
-    DF_F_map_all=np.zeros_like(average_tdTomato_all)
-    DR_R_map_all=np.zeros_like(average_tdTomato_all)
+    #value to make all values above zero (only from the frames in the windows, see piezo_response_maps).
+    tdTomato_offset=image_stack_min(tdTomato_registered)
+    gcamp_offset=image_stack_min(gcamp_registered)
 
     #calculate the threshold pixel value
+    #(from the baseline array before it is filled, as in the previous versions)
+    base_gcamp_all=np.zeros((n_of_z,gcamp_registered.shape[2],gcamp_registered.shape[3]))
     flattened_array=np.ravel(base_gcamp_all)
     gcamp_sorted=np.sort(flattened_array)
     threshold_index=np.round(gcamp_sorted.shape[0]*gcamp_threshold_ratio)
@@ -575,87 +744,141 @@ class LegVibration_separate_z:
     gcamp_threshold=gcamp_sorted[threshold_index]
 
 
-    #calcuate the baseline and the response images for each z-level
-    for z_level in range(n_of_z):
-      #
-      average_tdTomato=np.average(tdTomato_registered[z_level,first_piezo_start:first_piezo_start+response_range,:,:],axis=0)
-      average_tdTomato2=np.average(tdTomato_registered[z_level,second_piezo_start:second_piezo_start+response_range,:,:],axis=0)
-      average_tdTomato=(average_tdTomato+average_tdTomato2)/2
+    #calcuate the baseline and the response images for all z-levels and stimuli at once
+    #maps is a [8, n_of_z, rows, columns] array
+    maps=piezo_response_maps(tdTomato_registered,gcamp_registered,piezo_starts,response_range,base_range,
+                             tdTomato_threshold,gcamp_threshold,ratio_threshold,dtype=map_dtype,
+                             tdTomato_offset=tdTomato_offset,gcamp_offset=gcamp_offset)
 
-      average_gcamp=np.average(gcamp_registered[z_level,first_piezo_start:first_piezo_start+response_range,:,:], axis=0)
-      average_gcamp2=np.average(gcamp_registered[z_level,second_piezo_start:second_piezo_start+response_range,:,:], axis=0)
-      average_gcamp=(average_gcamp+average_gcamp2)/2
+    self.diagnostics['maps']=maps
+    if self.plot:
+      import matplotlib.pyplot as plt
+      for z_level in range(n_of_z):
+        average_tdTomato, average_gcamp, base_tdTomato, base_gcamp, ratio_response, ratio_baseline, DF_F_map, DR_R_map = maps[:,z_level]
 
-      base_tdTomato=np.average(tdTomato_registered[z_level,first_piezo_start-base_range:first_piezo_start,:,:],axis=0)
-      base_tdTomato2=np.average(tdTomato_registered[z_level,second_piezo_start-base_range:second_piezo_start,:,:],axis=0)
-      base_tdTomato=(base_tdTomato+base_tdTomato2)/2
+        #plot in a figure
+        fig, axs = plt.subplots(1,3, figsize=(12,5),tight_layout = True)
 
-      base_gcamp=np.average(gcamp_registered[z_level,first_piezo_start-base_range:first_piezo_start,:,:],axis=0)
-      base_gcamp2=np.average(gcamp_registered[z_level,second_piezo_start-base_range:second_piezo_start,:,:],axis=0)
-      base_gcamp=(base_gcamp+base_gcamp2)/2
-
-      #initialize the response map to zero
-      ratio_response=np.zeros_like(base_gcamp)
-      ratio_baseline=np.zeros_like(base_gcamp)
-      DF_F_map=np.zeros_like(base_gcamp)
-      DR_R_map=np.zeros_like(base_gcamp)
-
-      #calculate ratio, but we need to exclude pixels with very low tdTomato value to avoid high noise
-      ratio_response=np.divide(average_gcamp,average_tdTomato, where=((average_tdTomato>=tdTomato_threshold)&(base_tdTomato>=tdTomato_threshold)))
-      ratio_baseline=np.divide(base_gcamp,base_tdTomato, where=((average_tdTomato>=tdTomato_threshold)&(base_tdTomato>=tdTomato_threshold)))
-
-      #plot in a figure
-      fig, axs = plt.subplots(1,3, figsize=(12,5),tight_layout = True)
+        axs[0].imshow(base_gcamp)
+        axs[0].set_yticks([])
+        axs[0].set_xticks([])
+        axs[0].set_title('gcamp baseline', fontsize=20)
 
-      axs[0].imshow(base_gcamp)
-      axs[0].set_yticks([])
-      axs[0].set_xticks([])
-      axs[0].set_title('gcamp baseline', fontsize=20)
-
-      #DF/F calculated only for pixels whose base_gcamp value is above the threshold
-      DF_F_map=np.divide((average_gcamp-base_gcamp),base_gcamp,where=(base_gcamp>=gcamp_threshold))
-      # where=() in np.divide seems to give inconsitent results in google colab.
-      #Force it with the following line for now.
-      DF_F_map[base_gcamp<=gcamp_threshold]=0
-      axs[1].imshow(DF_F_map,vmin=min_range3,vmax=max_range3)
-      axs[1].set_yticks([])
-      axs[1].set_xticks([])
-      axs[1].set_title('DF/F map', fontsize=20)
+        axs[1].imshow(DF_F_map,vmin=min_range3,vmax=max_range3)
+        axs[1].set_yticks([])
+        axs[1].set_xticks([])
+        axs[1].set_title('DF/F map', fontsize=20)
 
-      #DR/R calculated only for pixels whose ratio_baseline is above the threshold and we have certain level of baseline gcamp
-      DR_R_map=np.divide((ratio_response-ratio_baseline),ratio_baseline,where=((ratio_baseline>=ratio_threshold)&(base_gcamp>=gcamp_threshold)))
-      axs[2].imshow(DR_R_map,vmin=min_range3,vmax=max_range3)
-      axs[2].set_yticks([])
-      axs[2].set_xticks([])
-      axs[2].set_title('DR/R map', fontsize=20)
-
-      #Place in the appropriate data array.
-      average_tdTomato_all[z_level,:,:]=average_tdTomato
-      average_gcamp_all[z_level,:,:]=average_gcamp
-      base_tdTomato_all[z_level,:,:]=base_tdTomato
-      base_gcamp_all[z_level,:,:]=base_gcamp
-      ratio_response_all[z_level,:,:]=ratio_response
-      ratio_baseline_all[z_level,:,:]=ratio_baseline
-      DF_F_map_all[z_level,:,:]=DF_F_map
-      DR_R_map_all[z_level,:,:]=DR_R_map
+        axs[2].imshow(DR_R_map,vmin=min_range3,vmax=max_range3)
+        axs[2].set_yticks([])
+        axs[2].set_xticks([])
+        axs[2].set_title('DR/R map', fontsize=20)
 
     #Save the data array.
     outfile_name=gcamp_file+'_maps'
 
-    with open(outfile_name, "wb") as f:
-      pickle.dump([average_tdTomato_all,average_gcamp_all,base_tdTomato_all, base_gcamp_all, ratio_response_all, ratio_baseline_all, DF_F_map_all, DR_R_map_all], f)
+    #all maps are saved in one [8, n_of_z, rows, columns] array
+    save_image_stack(outfile_name,maps)
     print(outfile_name)
 
     self.map_data_path = outfile_name
 
     return self.map_data_path
 
+  @profiled_stage(frames='tdTomato_registered_path')
+  def get_pixel_traces_separate_z(self):
+    """
+    a method to calculate the DF/F and DR/R time series of every pixel in separate z level:
+    load the filtered and registered data for both tdTomato and GCaMP and divide each pixel by its
+    running baseline (the trace_baseline_percentile of the trace_baseline_window frames around each frame,
+    see pixel_traces). The images are read once, a chunk of frames at a time.
+    *tdTomato_file: a .npy (or older pickle) file that contains the filtered and registered tdTomato images.
+    *GCaMP_file: same for the GCaMP.
+    The DF/F and DR/R traces are saved as [n_of_z, frames, rows, columns] float32 .npy files.
+    """
+    tdTomato_file=self.tdTomato_registered_path
+    gcamp_file=self.gcamp_registered_path
+    tdTomato_threshold = self.tdTomato_threshold
+    ratio_threshold = self.ratio_threshold
+    gcamp_threshold = self.trace_gcamp_threshold
+
+    #memory-mapped: each frame is read once
+    tdTomato_registered=load_image_stack(tdTomato_file)
+    gcamp_registered=load_image_stack(gcamp_file)
+
+    #make all pixel values positive (as in get_piezo_response_map_separate_z)
+    tdTomato_offset=image_stack_min(tdTomato_registered)
+    gcamp_offset=image_stack_min(gcamp_registered)
+
+    dF_F_name=gcamp_file+'_dF_F'
+    dR_R_name=gcamp_file+'_dR_R'
+    dF_F=create_image_stack(dF_F_name, gcamp_registered.shape, np.float32)
+    dR_R=create_image_stack(dR_R_name, gcamp_registered.shape, np.float32)
+
+    pixel_traces(tdTomato_registered, gcamp_registered, dF_F, dR_R, self.trace_baseline_window, self.trace_baseline_percentile,
+                 self.trace_baseline_step, self.trace_chunk_frames, tdTomato_offset, gcamp_offset,
+                 tdTomato_threshold, gcamp_threshold, ratio_threshold, self.n_workers)
+    dF_F.flush()
+    dR_R.flush()
+    del dF_F, dR_R
+    print(dF_F_name)
+    print(dR_R_name)
+
+    self.dF_F_path = dF_F_name
+    self.dR_R_path = dR_R_name
+
+    return self.dF_F_path, self.dR_R_path
+
+  @profiled_stage(frames='tdTomato_registered_path')
+  def get_roi_traces_separate_z(self):
+    """
+    a method to extract the GCaMP and tdTomato traces of polygon ROIs and their DF/F and DR/R:
+    the polygons are rasterized into pixel indices and the mean of each ROI is calculated with one sparse
+    matrix product per chunk of frames of the filtered and registered data (see roi_traces).
+    *roi_filepath: a pickle file with a list of (z_level, points) ROIs, points are the [x, y] vertices
+    of the polygon (e.g. bbox_select.selected_points).
+    The baseline is the same running percentile as in get_pixel_traces_separate_z.
+    The traces are saved as a [4, n_of_rois, frames] float32 array (GCaMP, tdTomato, DF/F, DR/R).
+    """
+    tdTomato_file=self.tdTomato_registered_path
+    gcamp_file=self.gcamp_registered_path
+    if self.roi_filepath is None:
+      raise ValueError('roi_filepath is not set in the config file')
+
+    with open(self.roi_filepath, "rb") as f:
+      rois=pickle.load(f)
+
+    tdTomato_registered=load_image_stack(tdTomato_file)
+    gcamp_registered=load_image_stack(gcamp_file)
+    roi_pixels=rasterize_rois(rois, gcamp_registered.shape[2], gcamp_registered.shape[3])
+
+    #make all pixel values positive (as in get_piezo_response_map_separate_z)
+    tdTomato_offset=image_stack_min(tdTomato_registered)
+    gcamp_offset=image_stack_min(gcamp_registered)
+
+    gcamp_traces=roi_traces(gcamp_registered, roi_pixels, self.trace_chunk_frames, gcamp_offset, self.n_workers)
+    tdTomato_traces=roi_traces(tdTomato_registered, roi_pixels, self.trace_chunk_frames, tdTomato_offset, self.n_workers)
+    dF_F, dR_R = roi_trace_responses(gcamp_traces, tdTomato_traces, self.trace_baseline_window, self.trace_baseline_percentile,
+                                     self.trace_baseline_step, self.tdTomato_threshold, self.trace_gcamp_threshold, self.ratio_threshold)
+
+    traces=np.stack([gcamp_traces, tdTomato_traces, dF_F, dR_R])
+    self.diagnostics['roi_traces']=traces
+
+    outfile_name=gcamp_file+'_roi_traces'
+    save_image_stack(outfile_name,traces)
+    print(outfile_name)
+
+    self.roi_traces_path = outfile_name
+
+    return self.roi_traces_path
+
+  @profiled_stage
   def merge_piezo_response_map(self):
     """
     a method to merge the DF/F and DR/R response map from separate z level
     into one response map.
     load the response map and take the max response for each pixel.
-    *map_data_file: a pickle file that contains all the response maps.
+    *map_data_file: a .npy (or older pickle) file that contains all the response maps.
     *min_range and max_range defines the min and max for the DF/F and DR/R images.
     """
     map_data_file=self.map_data_path
@@ -663,32 +886,34 @@ class LegVibration_separate_z:
     max_range3 = self.max_range3
 
     #load all the response maps
-    with open(map_data_file, "rb") as f:
-      [average_tdTomato_all,average_gcamp_all,base_tdTomato_all, base_gcamp_all, ratio_response_all, ratio_baseline_all, DF_F_map_all, DR_R_map_all]=pickle.load(f)
+    [average_tdTomato_all,average_gcamp_all,base_tdTomato_all, base_gcamp_all, ratio_response_all, ratio_baseline_all, DF_F_map_all, DR_R_map_all]=load_image_stack(map_data_file, mmap_mode=None)
 
     #take the maximum intensity projection of the responses.
     base_gcamp_projection=np.nanmax(base_gcamp_all,axis=0)
     DF_F_projection=np.nanmax(DF_F_map_all,axis=0)
     DR_R_projection=np.nanmax(DR_R_map_all,axis=0)
 
-    #plot in a figure
-    fig, axs = plt.subplots(1,3, figsize=(12,5),tight_layout = True)
+    self.diagnostics['merged']=[base_gcamp_projection, DF_F_projection, DR_R_projection]
+    if self.plot:
+      import matplotlib.pyplot as plt
+      #plot in a figure
+      fig, axs = plt.subplots(1,3, figsize=(12,5),tight_layout = True)
 
-    axs[0].imshow(base_gcamp_projection)
-    axs[0].set_yticks([])
-    axs[0].set_xticks([])
-    axs[0].set_title('gcamp merged', fontsize=20)
+      axs[0].imshow(base_gcamp_projection)
+      axs[0].set_yticks([])
+      axs[0].set_xticks([])
+      axs[0].set_title('gcamp merged', fontsize=20)
 
 
-    axs[1].imshow(DF_F_projection,vmin=min_range3,vmax=max_range3)
-    axs[1].set_yticks([])
-    axs[1].set_xticks([])
-    axs[1].set_title('DF/F merged', fontsize=20)
+      axs[1].imshow(DF_F_projection,vmin=min_range3,vmax=max_range3)
+      axs[1].set_yticks([])
+      axs[1].set_xticks([])
+      axs[1].set_title('DF/F merged', fontsize=20)
 
-    axs[2].imshow(DR_R_projection,vmin=min_range3,vmax=max_range3)
-    axs[2].set_yticks([])
-    axs[2].set_xticks([])
-    axs[2].set_title('DR/R merged', fontsize=20)
+      axs[2].imshow(DR_R_projection,vmin=min_range3,vmax=max_range3)
+      axs[2].set_yticks([])
+      axs[2].set_xticks([])
+      axs[2].set_title('DR/R merged', fontsize=20)
 
     #Save the merged maps.
     outfile_name=map_data_file+'_merged'
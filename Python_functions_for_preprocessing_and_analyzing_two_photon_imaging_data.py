@@ -0,0 +1,1995 @@
+"""### Python functions shared by the classes for preprocessing and analyzing two-photon imaging data
+
+* **register_images_batched**: register blocks of images to a reference image at subpixel resolution using FFT. Same result as running phase_cross_correlation and fourier_shift frame by frame.
+
+* **apply_shifts_batched**: apply previously estimated shifts to blocks of images (e.g. the channel that was not used for registration).
+
+* **run_in_parallel**: run independent tasks (z-levels, frame chunks) in a thread pool or a process pool and gather the results in order.
+
+* **register_z_levels**, **shift_z_levels**: register (or shift) images of each z-level. z-levels and frame chunks can be processed in parallel.
+
+* **register_volumes**: register whole volumes with one shift per volume (from the projection of all z-levels),
+with an optional registration of the z-levels that are left with a residual shift.
+
+* **register_running_reference**, **register_z_levels_running**: register the frames in one pass to a running (exponential or window) average of the registered frames.
+
+* **read_ScanImage_volumes**: read a ScanImage file in chunks of volumes and demultiplex each chunk into channels and z-levels without copying.
+
+* **filter_ScanImageFile_streaming**: demultiplex and gaussian filter a ScanImage file chunk by chunk, without loading the whole file.
+
+* **preprocess_ScanImageFile_fused**: demultiplex, gaussian filter and register a ScanImage file in one stream of frame chunks, without saving the filtered images.
+
+* **tail_tiff_pages**, **preprocess_ScanImageFile_online**: read the pages of a ScanImage file while it is being written and filter (causal),
+register (to a running reference) and update live DF/F and DR/R maps frame by frame, with the latency of each frame.
+
+* **gaussian_filter_frames**: 3D gaussian filter with a choice of engine: 'scipy' (same as scipy.ndimage.gaussian_filter on int16), 'float32' (float32, rounded once at the end) or 'fft' (float32, spatial filter by FFT for large sigma).
+
+* **create_image_stack**, **load_image_stack**, **save_image_stack**: write and read image stacks as .npy files that can be memory-mapped (also reads the older pickle files).
+
+* **stage_cache_key**, **restore_cached_stage**, **store_cached_stage**: cache the outputs of the expensive stages, keyed on the input files and the config parameters that change the result, with least-recently-used eviction.
+
+* **profiled_stage**: record the wall time, CPU time, peak memory, bytes read/written and frames/second of each stage
+as JSON lines (and optionally a cProfile of the stage).
+
+* **detect_stimulus_epochs**, **load_piezo_epochs**: find the onset and offset of all stimuli in the piezo signal (with debounce) and load the saved epochs.
+
+* **match_nearest_peaks**: match each imaging frame to the closest camera frame with a sorted search.
+
+* **load_analog_signals**: memory-map the analog signals (frame signals, piezo signal) and return each channel as a view without copying.
+
+* **image_stack_min**: minimum pixel value of an image stack, read in chunks.
+
+* **piezo_response_maps**: calculate the baseline and response images and the DF/F and DR/R maps for all z-levels and stimuli in a few array operations.
+
+* **pixel_traces**, **sliding_percentile_baseline**: DF/F and DR/R time series of every pixel (or of any traces)
+with a running percentile baseline, in one pass over the memory-mapped registered images.
+
+* **rasterize_rois**, **roi_traces**, **roi_trace_responses**: rasterize polygon ROIs (e.g. from bbox_select) into pixel indices
+and extract the trace (and the DF/F and DR/R) of each ROI with one sparse matrix product per chunk of frames.
+
+* **render_synchronized_video**: write the video of the maximum intensity projections (and the camera images), mapping the images to uint8 with a lookup table.
+Frames are composed in a thread pool and written in order by an encoder thread.
+
+* **read_camera_frames**: decode the camera video forward in a background thread and yield only the frames that are needed.
+
+"""
+#Import packages
+import numpy as np
+import os
+import shutil
+import json
+import hashlib
+import pickle
+import queue
+import struct
+import threading
+import time
+import functools
+import warnings
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+#ScanImageTiffReader and scipy are imported in the functions that use them (faster import of the classes).
+
+
+#change when a stage changes its results, so older cache entries are not used
+stage_cache_version=1
+
+
+def create_image_stack(file_name, shape, dtype=np.int16):
+  """
+  a function to create a .npy file (file_name is kept as it is, without adding .npy) for an image stack
+  and return it as a writable memory-mapped array. Stages can write into it one z-level or
+  one frame chunk at a time without keeping the whole stack in memory.
+  Call .flush() (or delete the array) when finished writing.
+  An existing file_name is removed first, so a hard-linked copy (e.g. in the stage cache) is not overwritten.
+  """
+  _remove_file(file_name)
+  return np.lib.format.open_memmap(file_name, mode='w+', dtype=dtype, shape=tuple(shape))
+
+
+def load_image_stack(file_name, mmap_mode='r'):
+  """
+  a function to load an image stack saved by create_image_stack or save_image_stack.
+  With mmap_mode='r' the data is memory-mapped (read lazily), so reading a single z-level
+  or a window of frames does not load the whole stack. Use mmap_mode=None to load everything into memory.
+  Older files saved with pickle are loaded with pickle.
+  """
+  with open(file_name, "rb") as f:
+    is_npy=(f.read(6)==b'\x93NUMPY')
+    if not is_npy:
+      f.seek(0)
+      return pickle.load(f)
+
+  return np.load(file_name, mmap_mode=mmap_mode)
+
+
+def save_image_stack(file_name, data):
+  """
+  a function to save an array (e.g. response maps) as a .npy file without adding .npy to the file_name.
+  """
+  _remove_file(file_name)
+  with open(file_name, "wb") as f:
+    np.save(f, data)
+
+
+def _remove_file(file_name):
+  """
+  remove file_name if it exists.
+  """
+  if os.path.lexists(file_name):
+    os.remove(file_name)
+
+
+def _link_or_copy(source, destination):
+  """
+  hard link source to destination (no copy of the data), or copy it if hard links are not possible
+  (e.g. the cache directory is on another drive).
+  """
+  _remove_file(destination)
+  try:
+    os.link(source, destination)
+  except OSError:
+    shutil.copy2(source, destination)
+
+
+def stage_cache_key(stage, input_files, parameters):
+  """
+  a function to make the cache key of a stage from the identity of its input files (path, size and modification time,
+  so the multi-GB files are not read) and the config parameters that change its result.
+  Parameters that do not change the result (e.g. n_workers, display ranges) should not be included.
+  """
+  identity={'stage':stage, 'version':stage_cache_version, 'parameters':parameters, 'input_files':[]}
+  for file_name in input_files:
+    file_stat=os.stat(file_name)
+    identity['input_files'].append([os.path.abspath(file_name), file_stat.st_size, file_stat.st_mtime_ns])
+  return hashlib.sha1(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def restore_cached_stage(cache_directory, cache_key, output_files):
+  """
+  a function to restore the outputs of a stage from the cache.
+  Returns True if the cache has cache_key (output_files are then hard linked or copied from the cache),
+  False if it does not (or cache_directory is None, which disables the cache).
+  """
+  if cache_directory is None:
+    return False
+  entry_directory=os.path.join(cache_directory, cache_key)
+  cached_files=[os.path.join(entry_directory, str(index)) for index in range(len(output_files))]
+  if not all(os.path.exists(cached_file) for cached_file in cached_files):
+    return False
+
+  for cached_file, output_file in zip(cached_files, output_files):
+    _link_or_copy(cached_file, output_file)
+  #mark as recently used (for the LRU eviction)
+  os.utime(entry_directory)
+  print('restored from cache', cache_key)
+  return True
+
+
+def store_cached_stage(cache_directory, cache_key, output_files, cache_max_gb):
+  """
+  a function to store the outputs of a stage in the cache (as hard links when possible)
+  and evict the least recently used entries until the cache is smaller than cache_max_gb.
+  Does nothing if cache_directory is None.
+  """
+  if cache_directory is None:
+    return
+  entry_directory=os.path.join(cache_directory, cache_key)
+  temporary_directory=entry_directory+'.tmp'
+  shutil.rmtree(temporary_directory, ignore_errors=True)
+  os.makedirs(temporary_directory)
+  for index, output_file in enumerate(output_files):
+    _link_or_copy(output_file, os.path.join(temporary_directory, str(index)))
+  #rename at the end so an entry is never half written
+  shutil.rmtree(entry_directory, ignore_errors=True)
+  os.rename(temporary_directory, entry_directory)
+
+  evict_cache(cache_directory, cache_max_gb, keep=cache_key)
+
+
+def evict_cache(cache_directory, cache_max_gb, keep=None):
+  """
+  a function to delete the least recently used cache entries until the cache is smaller than cache_max_gb
+  (the entry keep is never deleted).
+  """
+  entries=[]
+  for cache_key in os.listdir(cache_directory):
+    entry_directory=os.path.join(cache_directory, cache_key)
+    if not os.path.isdir(entry_directory) or cache_key.endswith('.tmp'):
+      continue
+    size=sum(os.path.getsize(os.path.join(entry_directory, file_name)) for file_name in os.listdir(entry_directory))
+    entries.append((os.path.getmtime(entry_directory), cache_key, size))
+
+  total_size=sum(size for _, _, size in entries)
+  for _, cache_key, size in sorted(entries):
+    if total_size<=cache_max_gb*1e9:
+      break
+    if cache_key==keep:
+      continue
+    shutil.rmtree(os.path.join(cache_directory, cache_key))
+    print('evicted from cache', cache_key)
+    total_size-=size
+
+
+def _read_proc_io():
+  """
+  returns the I/O counters of this process from /proc/self/io (Linux), or an empty dictionary.
+  rchar/wchar count read()/write() calls, read_bytes/write_bytes count storage I/O (including memory-mapped files).
+  """
+  try:
+    with open('/proc/self/io', 'r') as file:
+      return {name:int(value) for name, value in (line.split(':') for line in file)}
+  except OSError:
+    return {}
+
+
+def _reset_peak_rss():
+  """
+  reset the peak resident memory (VmHWM) of this process (Linux). returns False if it cannot be reset.
+  """
+  try:
+    with open('/proc/self/clear_refs', 'w') as file:
+      file.write('5')
+    return True
+  except OSError:
+    return False
+
+
+def _peak_rss():
+  """
+  returns the peak resident memory (bytes) of this process since the last _reset_peak_rss (or since it started).
+  """
+  try:
+    with open('/proc/self/status', 'r') as file:
+      for line in file:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1])*1024
+  except OSError:
+    pass
+  import resource
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+def _child_cpu_time():
+  """
+  returns the CPU time (s) of the finished child processes (e.g. a process pool).
+  """
+  try:
+    import resource
+  except ImportError:
+    return 0.0
+  usage=resource.getrusage(resource.RUSAGE_CHILDREN)
+  return usage.ru_utime+usage.ru_stime
+
+
+def _image_stack_frames(file_name):
+  """
+  returns the number of frames (z-levels x frames) of a [n_of_z, frames, rows, columns] .npy image stack
+  without reading it, or None (no file, older pickle file or another shape).
+  """
+  if file_name is None or not os.path.exists(file_name):
+    return None
+  with open(file_name, "rb") as f:
+    if f.read(6)!=b'\x93NUMPY':
+      return None
+  shape=np.load(file_name, mmap_mode='r').shape
+  if len(shape)!=4:
+    return None
+  return shape[0]*shape[1]
+
+
+def profiled_stage(method=None, frames=None):
+  """
+  a decorator for the stage methods of the classes to record where time and memory go.
+  When the object has a profile_path (config), one JSON line is appended to it for each stage with
+  the wall time, CPU time (including finished child processes), peak resident memory during the stage,
+  bytes read/written (read()/write() calls and storage I/O, Linux only), the number of imaging frames
+  and frames per second.
+  *frames: name of the attribute with the path of the image stack whose frames the stage processes
+  (e.g. @profiled_stage(frames='tdTomato_registered_path')). The number of frames is z-levels x frames of that stack
+  after the stage. Without frames (@profiled_stage, stages that do not process every image frame, e.g.
+  detect_piezo_start_frames) frames and frames_per_second are null.
+  With profile_cprofile the stage also runs under cProfile and the stats are saved next to the data file
+  (data file name + '_' + stage + '.prof', open with pstats or snakeviz).
+  The records are also kept in the object's profile_records list. Without profile_path and profile_cprofile
+  the stage runs as it is.
+  """
+  if method is None:
+    return functools.partial(profiled_stage, frames=frames)
+
+  @functools.wraps(method)
+  def profiled_method(self, *args, **kwargs):
+    profile_path=getattr(self, 'profile_path', None)
+    profile_cprofile=getattr(self, 'profile_cprofile', False)
+    if profile_path is None and not profile_cprofile:
+      return method(self, *args, **kwargs)
+
+    stage=method.__name__
+    record={'time':time.strftime('%Y-%m-%dT%H:%M:%S'), 'class':type(self).__name__, 'data_filepath':self.data_filepath,
+            'stage':stage, 'n_workers':getattr(self, 'n_workers', 1)}
+    peak_rss_scope='stage' if _reset_peak_rss() else 'process'
+    io_start=_read_proc_io()
+    cpu_start=time.process_time()+_child_cpu_time()
+    wall_start=time.perf_counter()
+    if profile_cprofile:
+      import cProfile
+      profiler=cProfile.Profile()
+      profiler.enable()
+
+    try:
+      result=method(self, *args, **kwargs)
+      record['status']='completed'
+    except Exception as error:
+      record['status']='failed'
+      record['error']=repr(error)
+      raise
+    finally:
+      if profile_cprofile:
+        profiler.disable()
+        record['cprofile_path']=self.data_filepath.split('.')[0]+'_'+stage+'.prof'
+        profiler.dump_stats(record['cprofile_path'])
+      record['wall_time_s']=time.perf_counter()-wall_start
+      record['cpu_time_s']=time.process_time()+_child_cpu_time()-cpu_start
+      record['peak_rss_bytes']=_peak_rss()
+      record['peak_rss_scope']=peak_rss_scope
+      io_end=_read_proc_io()
+      for name, key in (('bytes_read','rchar'), ('bytes_written','wchar'), ('storage_bytes_read','read_bytes'), ('storage_bytes_written','write_bytes')):
+        record[name]=io_end[key]-io_start[key] if key in io_start and key in io_end else None
+      n_of_frames=_image_stack_frames(getattr(self, frames, None)) if frames is not None else None
+      record['frames']=n_of_frames
+      record['frames_per_second']=n_of_frames/record['wall_time_s'] if n_of_frames and record['wall_time_s']>0 else None
+
+      if not hasattr(self, 'profile_records'):
+        self.profile_records=[]
+      self.profile_records.append(record)
+      if profile_path is not None:
+        with open(profile_path, 'a') as file:
+          file.write(json.dumps(record)+'\n')
+
+    return result
+
+  return profiled_method
+
+
+def detect_stimulus_epochs(signal, threshold, debounce):
+  """
+  a function to find all stimulus epochs (onset and offset sample) in an analog signal (e.g. the piezo signal).
+  The signal is "on" where it is at or above threshold. The on/off edges are found in one pass over the signal.
+  An onset that is less than debounce samples after the previous onset is part of the same stimulus
+  (e.g. the cycles of a vibration stimulus), so each stimulus is one epoch.
+  *debounce: minimum number of samples between the onsets of two stimuli (skip_interval in older config files).
+
+  returns an [n_of_epochs, 2] int array with the onset (first on sample) and offset (first off sample after the
+  last on sample of the stimulus) of each epoch.
+  """
+  signal_on=np.asarray(signal)>=threshold
+
+  #rising edges (first on sample) and falling edges (first off sample)
+  edges=np.flatnonzero(signal_on[1:]!=signal_on[:-1])+1
+  rising=edges[signal_on[edges]]
+  falling=edges[~signal_on[edges]]
+  if signal_on.shape[0]>0 and signal_on[0]:
+    rising=np.concatenate(([0],rising))
+  if signal_on.shape[0]>0 and signal_on[-1]:
+    falling=np.concatenate((falling,[signal_on.shape[0]]))
+  if rising.shape[0]==0:
+    return np.zeros((0,2),dtype=int)
+
+  #keep the onsets that are at least debounce samples after the previous onset
+  onset_index=[0]
+  while True:
+    next_index=np.searchsorted(rising,rising[onset_index[-1]]+max(debounce,1),side='left')
+    if next_index>=rising.shape[0]:
+      break
+    onset_index.append(next_index)
+  onsets=rising[onset_index]
+
+  #offset: last falling edge before the next onset
+  next_onsets=np.concatenate((onsets[1:],[signal_on.shape[0]+1]))
+  offsets=falling[np.searchsorted(falling,next_onsets,side='left')-1]
+
+  return np.stack((onsets,offsets),axis=1).astype(int)
+
+
+def load_piezo_epochs(file_name):
+  """
+  a function to load the piezo epochs saved by detect_piezo_start_frames as an [n_of_epochs, 2] array of
+  (start volume, end volume). Older files with only the [first start, second start] volumes are
+  returned as an [2, 1] array of start volumes.
+  """
+  with open(file_name, "rb") as f:
+    piezo_data=np.asarray(pickle.load(f))
+  if piezo_data.ndim==1:
+    piezo_data=piezo_data.reshape(-1,1)
+  return piezo_data.astype(int)
+
+
+def load_analog_signals(file_name, number_of_channels):
+  """
+  a function to memory-map the analog signals (.bin file of float64 samples, channels interleaved)
+  and return them as a [samples, number_of_channels] array. Each channel ([:, channel]) is a strided view
+  of the file, so nothing is read until it is used and no index arrays are needed.
+  """
+  analog_signals=np.memmap(file_name, dtype=np.float64, mode='r')
+  number_of_samples=analog_signals.shape[0]//number_of_channels
+  return analog_signals[:number_of_samples*number_of_channels].reshape(-1, number_of_channels)
+
+
+def match_nearest_peaks(peaks_camera, peaks_image):
+  """
+  a function to find, for each imaging frame peak, the camera frame peak with the closest index.
+  Same result as taking np.argmin(np.absolute(peaks_camera-peaks_image[n])) for each n (ties go to
+  the earlier camera frame), but uses a sorted search so it scales to long recordings.
+  *peaks_camera: sorted array of the camera peak indices (from scipy.signal.find_peaks).
+  *peaks_image: array of the imaging frame peak indices.
+
+  returns image_in_camera_index (closest camera frame for each imaging frame) and camera_minus_image_index
+  (camera peak minus imaging peak, positive if the camera frame began after the imaging frame), both [frames, 1] int arrays.
+  """
+  peaks_camera=np.asarray(peaks_camera)
+  peaks_image=np.asarray(peaks_image)
+
+  #first camera peak at or after each imaging peak, and the one before it
+  after=np.clip(np.searchsorted(peaks_camera,peaks_image,side='left'),0,len(peaks_camera)-1)
+  before=np.clip(after-1,0,len(peaks_camera)-1)
+  use_before=np.absolute(peaks_image-peaks_camera[before])<=np.absolute(peaks_camera[after]-peaks_image)
+  nearest=np.where(use_before,before,after)
+
+  image_in_camera_index=nearest.astype(int).reshape(-1,1)
+  camera_minus_image_index=(peaks_camera[nearest]-peaks_image).astype(int).reshape(-1,1)
+  return image_in_camera_index, camera_minus_image_index
+
+
+def _upsampled_dft_batched(data, upsampled_region_size, upsample_factor, axis_offsets):
+  """
+  Batched version of skimage.registration._phase_cross_correlation._upsampled_dft
+  for 2D images.
+  *data: [frames, rows, columns] array with the DFT of each image.
+  *upsampled_region_size: size of the region to be sampled (same for both axes).
+  *upsample_factor: upsampling factor.
+  *axis_offsets: [frames, 2] array with the offset of the sampled region for each image.
+  """
+  im2pi = 1j * 2 * np.pi
+  sample_points=np.arange(upsampled_region_size)
+
+  #kernels for the rows and columns of each image: [frames, region, rows] and [frames, region, columns]
+  row_kernel=(sample_points[None,:]-axis_offsets[:,0,None])[:,:,None]*np.fft.fftfreq(data.shape[1],upsample_factor)[None,None,:]
+  row_kernel=np.exp(-im2pi*row_kernel)
+  column_kernel=(sample_points[None,:]-axis_offsets[:,1,None])[:,:,None]*np.fft.fftfreq(data.shape[2],upsample_factor)[None,None,:]
+  column_kernel=np.exp(-im2pi*column_kernel)
+
+  #Equivalent to row_kernel[n] @ data[n] @ column_kernel[n].T for each image.
+  return np.matmul(np.matmul(row_kernel,data),np.swapaxes(column_kernel,1,2))
+
+
+def _phase_ramp(shifts, shape):
+  """
+  Fourier-space phase ramp [frames, rows, columns] that shifts each image by shifts[frames, 2].
+  Same as scipy.ndimage.fourier_shift applied to each image.
+  """
+  row_phase=np.exp(-2j*np.pi*shifts[:,0,None]*np.fft.fftfreq(shape[0])[None,:])
+  column_phase=np.exp(-2j*np.pi*shifts[:,1,None]*np.fft.fftfreq(shape[1])[None,:])
+
+  return row_phase[:,:,None]*column_phase[:,None,:]
+
+
+def _real_phase_ramp(shifts, shape):
+  """
+  phase ramp [frames, rows, columns//2+1] for the real FFT (np.fft.rfft2) of the images. The real part of the inverse FFT
+  after _phase_ramp is the inverse of the Hermitian part of the shifted spectrum, so the ramp is (r(k)+conj(r(-k)))/2
+  (only different from _phase_ramp at the Nyquist frequency of even sizes). np.fft.irfft2 then gives the same images
+  as _phase_ramp with the complex FFT (up to float rounding) in about half the time.
+  """
+  row_frequencies=np.fft.fftfreq(shape[0])
+  column_frequencies=np.fft.fftfreq(shape[1])
+  half_columns=shape[1]//2+1
+  row_phase=np.exp(-2j*np.pi*shifts[:,0,None]*row_frequencies[None,:])
+  column_phase=np.exp(-2j*np.pi*shifts[:,1,None]*column_frequencies[None,:half_columns])
+  #the ramp at -k
+  negative_row_phase=np.exp(-2j*np.pi*shifts[:,0,None]*row_frequencies[None,(-np.arange(shape[0]))%shape[0]])
+  negative_column_phase=np.exp(-2j*np.pi*shifts[:,1,None]*column_frequencies[None,(-np.arange(half_columns))%shape[1]])
+
+  return (row_phase[:,:,None]*column_phase[:,None,:]+negative_row_phase.conj()[:,:,None]*negative_column_phase.conj()[:,None,:])/2
+
+
+def register_images_batched(reference_image, images, upsample, registered_images, other_images=None, other_registered_images=None, block_size=32, normalization='phase'):
+  """
+  a function to register images to the reference image at subpixel resolution.
+  Gives the same shifts as skimage.registration.phase_cross_correlation (with upsample_factor=upsample),
+  but the FFT of the reference image is calculated only once and the cross-power spectrum,
+  peak search and the shift are calculated for a whole block of frames at a time.
+
+  *reference_image: [rows, columns] image to register to (e.g. the average image).
+  *images: [frames, rows, columns] images to register.
+  *upsample: upsampling factor. Will register to 1/upsample pixels.
+  *registered_images: [frames, rows, columns] array to write the registered (rounded) images into.
+  *other_images, other_registered_images: optional second channel. The same shift is applied to these images.
+  *block_size: number of frames processed at a time. Larger blocks are faster but use more memory.
+  *normalization: 'phase' or None, same as the normalization in phase_cross_correlation.
+
+  returns the [frames, 2] array of (row, column) shifts.
+  """
+  n_of_frames=images.shape[0]
+  shape=np.array(images.shape[1:])
+  midpoint=np.trunc(shape/2)
+
+  #FFT of the reference image. Only calculated once.
+  reference_freq=np.fft.fft2(reference_image)
+
+  #parameters for the upsampled DFT (same as in phase_cross_correlation)
+  upsampled_region_size=np.ceil(upsample*1.5)
+  dftshift=np.trunc(upsampled_region_size/2.0)
+
+  all_shift=np.zeros((n_of_frames,2))
+
+  for start in range(0,n_of_frames,block_size):
+    end=min(start+block_size,n_of_frames)
+    frames_freq=np.fft.fft2(images[start:end])
+
+    #Whole-pixel shift: cross-correlation by an IFFT
+    image_product=reference_freq[None,:,:]*frames_freq.conj()
+    if normalization=='phase':
+      eps=np.finfo(image_product.real.dtype).eps
+      image_product/=np.maximum(np.abs(image_product),100*eps)
+    cross_correlation=np.fft.ifft2(image_product)
+
+    #Locate maximum for each frame
+    maxima=np.argmax(np.abs(cross_correlation).reshape(end-start,-1),axis=1)
+    shift=np.stack(np.unravel_index(maxima,cross_correlation.shape[1:]),axis=1).astype(float)
+    shift=np.where(shift>midpoint,shift-shape,shift)
+
+    if upsample>1:
+      #Initial shift estimate in upsampled grid
+      shift=np.round(shift*upsample)/upsample
+      #Matrix multiply DFT around the current shift estimate
+      sample_region_offset=dftshift-shift*upsample
+      cross_correlation=_upsampled_dft_batched(image_product.conj(),int(upsampled_region_size),upsample,sample_region_offset).conj()
+      #Locate maximum and map back to original pixel grid
+      maxima=np.argmax(np.abs(cross_correlation).reshape(end-start,-1),axis=1)
+      maxima=np.stack(np.unravel_index(maxima,cross_correlation.shape[1:]),axis=1).astype(float)
+      shift+=(maxima-dftshift)/upsample
+
+    #If its only one row or column the shift along that dimension has no effect.
+    shift[:,shape==1]=0
+    all_shift[start:end,:]=shift
+
+    #correct for the movement: the same phase ramp is used for both channels.
+    phase_ramp=_phase_ramp(shift,shape)
+    registered_images[start:end]=np.round(np.fft.ifft2(frames_freq*phase_ramp).real)
+    if other_images is not None:
+      other_registered_images[start:end]=np.round(np.fft.ifft2(np.fft.fft2(other_images[start:end])*phase_ramp).real)
+
+  return all_shift
+
+
+def apply_shifts_batched(images, shifts, shifted_images, block_size=32):
+  """
+  a function to apply the shifts (e.g. from register_images_batched) to the images.
+  Same as scipy.ndimage.fourier_shift on the FFT of each image, but for a whole block of frames at a time
+  and with the real FFT (see _real_phase_ramp).
+
+  *images: [frames, rows, columns] images to shift.
+  *shifts: [frames, 2] array of (row, column) shifts.
+  *shifted_images: [frames, rows, columns] array to write the shifted (rounded) images into.
+  *block_size: number of frames processed at a time.
+  """
+  n_of_frames=images.shape[0]
+  shape=np.array(images.shape[1:])
+
+  for start in range(0,n_of_frames,block_size):
+    end=min(start+block_size,n_of_frames)
+    phase_ramp=_real_phase_ramp(shifts[start:end],shape)
+    shifted_images[start:end]=np.round(np.fft.irfft2(np.fft.rfft2(images[start:end])*phase_ramp,s=tuple(shape)))
+
+  return shifted_images
+
+
+def run_in_parallel(function, arguments, n_workers=1, backend='thread'):
+  """
+  a function to run function(*argument) for each argument in arguments and return the results in the same order.
+  *n_workers: number of threads or processes. Runs serially if n_workers is 1 (or less).
+  *backend: 'thread' or 'process'. NumPy FFT and SciPy filters release the GIL for most of the work,
+  so threads avoid copying the images to each process. Use 'process' if the work is dominated by python code.
+  """
+  if n_workers is None or n_workers<=1 or len(arguments)<=1:
+    return [function(*argument) for argument in arguments]
+
+  if backend=='thread':
+    executor_class=ThreadPoolExecutor
+  elif backend=='process':
+    executor_class=ProcessPoolExecutor
+  else:
+    raise ValueError("backend must be either 'thread' or 'process'")
+
+  with executor_class(max_workers=min(n_workers,len(arguments))) as executor:
+    futures=[executor.submit(function,*argument) for argument in arguments]
+    return [future.result() for future in futures]
+
+
+def split_frames(n_of_frames, n_of_chunks):
+  """
+  a function to split n_of_frames frames into n_of_chunks (start, end) ranges of similar size.
+  """
+  n_of_chunks=max(1,min(n_of_chunks,n_of_frames))
+  edges=np.linspace(0,n_of_frames,n_of_chunks+1).astype(int)
+
+  return [(edges[n],edges[n+1]) for n in range(n_of_chunks)]
+
+
+def temporal_halo(gaussian_sigma, truncate=4.0):
+  """
+  number of frames on each side of a chunk that the gaussian filter needs along the time axis (first axis).
+  Same as the kernel radius used in scipy.ndimage.gaussian_filter.
+  """
+  return int(truncate*float(gaussian_sigma[0])+0.5)
+
+
+def _gaussian_kernel1d(sigma, radius):
+  """
+  normalized 1D gaussian kernel of size 2*radius+1 (same as the kernel used in scipy.ndimage.gaussian_filter1d).
+  """
+  x=np.arange(-radius,radius+1)
+  kernel=np.exp(-0.5/(sigma*sigma)*x**2)
+
+  return kernel/kernel.sum()
+
+
+def _fft_gaussian_filter_spatial(images, gaussian_sigma, truncate=4.0):
+  """
+  gaussian filter the rows and columns of [frames, rows, columns] float32 images by multiplying in Fourier space.
+  Images are padded by reflection (same as mode='reflect' in scipy.ndimage) by the kernel radius,
+  so the result matches the direct filter (up to float32 precision). Faster than the direct filter for large sigma.
+  """
+  import scipy.fft
+  padding=[]
+  kernels=[]
+  for sigma in gaussian_sigma:
+    if sigma>0:
+      radius=int(truncate*float(sigma)+0.5)
+      kernels.append(_gaussian_kernel1d(float(sigma),radius))
+    else:
+      radius=0
+      kernels.append(np.ones(1))
+    padding.append(radius)
+
+  padded=np.pad(images,((0,0),(padding[0],padding[0]),(padding[1],padding[1])),mode='symmetric')
+  padded_shape=padded.shape[1:]
+
+  #kernel centered at index 0 so that the circular convolution does not shift the image.
+  row_kernel=np.zeros(padded_shape[0],dtype=np.float32)
+  row_kernel[:kernels[0].size]=kernels[0]
+  row_kernel=np.roll(row_kernel,-padding[0])
+  column_kernel=np.zeros(padded_shape[1],dtype=np.float32)
+  column_kernel[:kernels[1].size]=kernels[1]
+  column_kernel=np.roll(column_kernel,-padding[1])
+  kernel_freq=scipy.fft.fft(row_kernel)[:,None]*scipy.fft.rfft(column_kernel)[None,:]
+
+  filtered=scipy.fft.irfft2(scipy.fft.rfft2(padded,axes=(1,2))*kernel_freq,s=padded_shape,axes=(1,2))
+
+  return filtered[:,padding[0]:padding[0]+images.shape[1],padding[1]:padding[1]+images.shape[2]]
+
+
+def gaussian_filter_frames(images, gaussian_sigma, start, end, engine='scipy'):
+  """
+  a function to apply the 3D gaussian filter to [frames, rows, columns] images and return the (rounded) frames
+  from start to end. images include the extra frames (halo) before and after these frames.
+  The time axis is filtered first, then only the frames from start to end are filtered along rows and columns.
+
+  *engine:
+    'scipy': same result as np.round(scipy.ndimage.gaussian_filter(images)) on int16 images
+    (each axis is filtered and stored as int16 in turn).
+    'float32': filter in float32 and round only once at the end. Uses half the memory of float64.
+    'fft': same as 'float32', but rows and columns are filtered by FFT (faster for large spatial sigma).
+  """
+  from scipy.ndimage import gaussian_filter1d
+  if engine=='scipy':
+    filtered=images
+    if gaussian_sigma[0]>0:
+      filtered=gaussian_filter1d(filtered,gaussian_sigma[0],axis=0)
+    filtered=filtered[start:end]
+    for axis in (1,2):
+      if gaussian_sigma[axis]>0:
+        filtered=gaussian_filter1d(filtered,gaussian_sigma[axis],axis=axis)
+    return np.round(filtered)
+
+  elif engine in ('float32','fft'):
+    filtered=np.asarray(images,dtype=np.float32)
+    if gaussian_sigma[0]>0:
+      filtered=gaussian_filter1d(filtered,gaussian_sigma[0],axis=0,output=np.float32)
+    filtered=filtered[start:end]
+    if engine=='fft':
+      filtered=_fft_gaussian_filter_spatial(filtered,gaussian_sigma[1:])
+    else:
+      for axis in (1,2):
+        if gaussian_sigma[axis]>0:
+          filtered=gaussian_filter1d(filtered,gaussian_sigma[axis],axis=axis,output=np.float32)
+    return np.round(filtered,out=filtered)
+
+  else:
+    raise ValueError("engine must be 'scipy', 'float32' or 'fft'")
+
+
+def get_ScanImageFile_shape(file_name, n_of_z, n_of_channels=2):
+  """
+  a function to get the number of volumes, rows and columns in a ScanImage file
+  (pages are multiplexed as volumes x z-levels x channels). Incomplete volumes at the end are ignored.
+  """
+  from ScanImageTiffReader import ScanImageTiffReader
+  reader=ScanImageTiffReader(file_name)
+  n_of_pages, rows, columns = reader.shape()
+  reader.close()
+
+  return n_of_pages//(n_of_z*n_of_channels), rows, columns
+
+
+def read_ScanImage_volumes(file_name, n_of_z, n_of_channels=2, chunk_volumes=100):
+  """
+  a generator to read a ScanImage file chunk_volumes volumes at a time.
+  Pages in the file are multiplexed so that the channel changes fastest, then the z-level, then the volume.
+  yields (start_volume, chunk) where chunk is a [volumes, n_of_z, n_of_channels, rows, columns] view of the pages read
+  (no copy), so chunk[:,z_level,channel] are the images of one channel at one z-level.
+  Only one chunk of the raw data is in memory at a time. The file is closed when the generator finishes,
+  is closed (e.g. the consumer stops iterating) or the consumer raises.
+  """
+  from ScanImageTiffReader import ScanImageTiffReader
+  reader=ScanImageTiffReader(file_name)
+  try:
+    n_of_pages, rows, columns = reader.shape()
+    pages_per_volume=n_of_z*n_of_channels
+    n_of_volumes=n_of_pages//pages_per_volume
+
+    for start in range(0,n_of_volumes,chunk_volumes):
+      end=min(start+chunk_volumes,n_of_volumes)
+      pages=reader.data(beg=start*pages_per_volume,end=end*pages_per_volume)
+      yield start, pages.reshape(end-start,n_of_z,n_of_channels,rows,columns)
+  finally:
+    reader.close()
+
+
+def filter_ScanImageFile_blocks(file_name, n_of_z, gaussian_sigma, n_of_channels=2, chunk_volumes=100, n_of_chunks=1, n_workers=1, backend='thread', engine='scipy'):
+  """
+  a generator to demultiplex a ScanImage file into channels and z-levels and apply the 3D gaussian filter,
+  reading chunk_volumes volumes at a time (see read_ScanImage_volumes).
+  Pages from each chunk are routed directly to the (channel, z-level) buffers. Frames are filtered as soon as
+  enough following frames (temporal_halo) have been read, and only the frames still needed as the halo for the
+  next chunk are kept, so the result is the same as filtering each whole z-level at once.
+
+  yields (start, end, filtered_blocks) where filtered_blocks is a list with one int16 [n_of_z, end-start, rows, columns]
+  array of filtered (rounded) frames per channel.
+  *n_of_chunks, n_workers, backend: the frames of each (channel, z-level) are split into n_of_chunks
+  and all of them are filtered with n_workers threads or processes (see run_in_parallel).
+  *engine: 'scipy', 'float32' or 'fft' (see gaussian_filter_frames).
+  """
+  n_of_frames, rows, columns = get_ScanImageFile_shape(file_name, n_of_z, n_of_channels)
+  halo=temporal_halo(gaussian_sigma)
+
+  buffers=[None]*n_of_channels
+  #frame number of the first frame in the buffers, and the first frame that has not been filtered yet.
+  buffer_start=0
+  next_frame=0
+
+  for start, chunk in read_ScanImage_volumes(file_name, n_of_z, n_of_channels, chunk_volumes):
+    end=start+chunk.shape[0]
+
+    #add the new frames to the buffer of each channel ([n_of_z, frames, rows, columns])
+    for channel in range(n_of_channels):
+      new_frames=np.moveaxis(chunk[:,:,channel],0,1)
+      if buffers[channel] is None:
+        buffers[channel]=new_frames.copy()
+      else:
+        buffers[channel]=np.concatenate((buffers[channel],new_frames),axis=1)
+    del chunk
+
+    #frames up to ready_end have all the frames they need for the filter.
+    if end>=n_of_frames:
+      ready_end=n_of_frames
+    else:
+      ready_end=end-halo
+    if ready_end<=next_frame:
+      continue
+
+    #filter the frames from next_frame to ready_end (plus the halo on each side) for each channel and z-level
+    tasks=[]
+    arguments=[]
+    for chunk_start, chunk_end in split_frames(ready_end-next_frame,n_of_chunks):
+      chunk_start+=next_frame
+      chunk_end+=next_frame
+      halo_start=max(0,chunk_start-halo)
+      halo_end=min(end,chunk_end+halo)
+      for channel in range(n_of_channels):
+        for depth in range(n_of_z):
+          tasks.append((channel,depth,chunk_start,chunk_end))
+          arguments.append((buffers[channel][depth,halo_start-buffer_start:halo_end-buffer_start],gaussian_sigma,chunk_start-halo_start,chunk_end-halo_start,engine))
+
+    filtered_blocks=[np.zeros((n_of_z,ready_end-next_frame,rows,columns),dtype=np.int16) for channel in range(n_of_channels)]
+    results=run_in_parallel(gaussian_filter_frames,arguments,n_workers,backend)
+    for (channel, depth, chunk_start, chunk_end), result in zip(tasks,results):
+      filtered_blocks[channel][depth,chunk_start-next_frame:chunk_end-next_frame]=result
+
+    yield next_frame, ready_end, filtered_blocks
+
+    #only keep the frames needed for the next chunk
+    next_frame=ready_end
+    new_buffer_start=max(0,next_frame-halo)
+    for channel in range(n_of_channels):
+      buffers[channel]=buffers[channel][:,new_buffer_start-buffer_start:]
+    buffer_start=new_buffer_start
+
+
+def filter_ScanImageFile_streaming(file_name, n_of_z, gaussian_sigma, filtered_images, chunk_volumes=100, n_of_chunks=1, n_workers=1, backend='thread', engine='scipy'):
+  """
+  a function to demultiplex a ScanImage file into channels and z-levels and apply the 3D gaussian filter
+  without loading the whole file (see filter_ScanImageFile_blocks).
+
+  *filtered_images: list with one [n_of_z, frames, rows, columns] array per channel (e.g. [GCaMP, tdTomato])
+  to write the filtered (rounded) images into. Can be memory-mapped arrays from create_image_stack.
+  """
+  for start, end, filtered_blocks in filter_ScanImageFile_blocks(file_name, n_of_z, gaussian_sigma, len(filtered_images), chunk_volumes,
+                                                                 n_of_chunks, n_workers, backend, engine):
+    for channel in range(len(filtered_images)):
+      filtered_images[channel][:,start:end]=filtered_blocks[channel]
+
+  return filtered_images
+
+
+def preprocess_ScanImageFile_fused(file_name, n_of_z, gaussian_sigma, registered_images, registration_channel, upsample, reference_volumes=None,
+                                   block_size=32, chunk_volumes=100, n_of_chunks=1, n_workers=1, backend='thread', engine='scipy', normalization='phase'):
+  """
+  a function to demultiplex, gaussian filter and register a ScanImage file in one stream of frame chunks.
+  The filtered images are never saved, so only the current chunk (plus the filter halo) is in memory.
+
+  *registered_images: list with one [n_of_z, frames, rows, columns] array per channel ([GCaMP, tdTomato])
+  to write the registered images into. Can be memory-mapped arrays from create_image_stack.
+  *registration_channel: index in registered_images of the channel used to register (the same shift is applied to the other channel).
+  *reference_volumes: None to register to the average of all filtered frames of each z-level (same result as
+  filter_ScanImageFile_streaming followed by register_z_levels, but the file is read and filtered twice).
+  Or a number of volumes: register to the average of the first reference_volumes filtered volumes (the file is read once).
+
+  returns the [n_of_z, frames, 2] array of (row, column) shifts.
+  """
+  n_of_frames, rows, columns = get_ScanImageFile_shape(file_name, n_of_z, len(registered_images))
+  other_channel=1-registration_channel
+  filter_arguments=(file_name, n_of_z, gaussian_sigma, len(registered_images), chunk_volumes, n_of_chunks, n_workers, backend, engine)
+
+  reference_images=None
+  if reference_volumes is None:
+    #first pass: sum of the filtered frames of each z-level (int16 sums are exact in float64)
+    image_sum=np.zeros((n_of_z,rows,columns))
+    for start, end, filtered_blocks in filter_ScanImageFile_blocks(*filter_arguments):
+      image_sum+=np.sum(filtered_blocks[registration_channel],axis=1,dtype=np.float64)
+    reference_images=image_sum/n_of_frames
+    reference_volumes=0
+
+  all_shift=np.zeros((n_of_z,n_of_frames,2))
+  pending_blocks=[]
+  for start, end, filtered_blocks in filter_ScanImageFile_blocks(*filter_arguments):
+    #keep the first blocks until there are enough volumes for the reference image
+    pending_blocks.append((start,end,filtered_blocks))
+    if reference_images is None:
+      if end<min(reference_volumes,n_of_frames):
+        continue
+      reference_frames=np.concatenate([blocks[registration_channel] for _, _, blocks in pending_blocks],axis=1)[:,:reference_volumes]
+      reference_images=np.mean(reference_frames,axis=1)
+      del reference_frames
+
+    for block_start, block_end, blocks in pending_blocks:
+      all_shift[:,block_start:block_end]=register_z_levels(reference_images, blocks[registration_channel], upsample, registered_images[registration_channel][:,block_start:block_end],
+                                                           blocks[other_channel], registered_images[other_channel][:,block_start:block_end], block_size, n_of_chunks, n_workers, backend,
+                                                           normalization)
+    pending_blocks=[]
+
+  return all_shift
+
+
+#integer TIFF field types (SHORT, LONG, LONG8) of the tags read by _read_tiff_page
+_tiff_integer_types={3:'u2', 4:'u4', 16:'u8'}
+
+
+def _read_tiff_header(f, file_size):
+  """
+  read the TIFF header: returns (byte order, big_tiff, position of the first IFD pointer), or None if it is not written yet.
+  """
+  if file_size<16:
+    return None
+  f.seek(0)
+  header=f.read(16)
+  if header[:2]==b'II':
+    byte_order='<'
+  elif header[:2]==b'MM':
+    byte_order='>'
+  else:
+    raise ValueError('not a TIFF file')
+  version=struct.unpack(byte_order+'H',header[2:4])[0]
+  if version==42:
+    return byte_order, False, 4
+  elif version==43:
+    return byte_order, True, 8
+  raise ValueError('not a TIFF file')
+
+
+def _read_tiff_pointer(f, byte_order, big_tiff, pointer_position, file_size):
+  """
+  read the IFD offset at pointer_position (0 if it is not written yet).
+  """
+  pointer_format, pointer_size = ('Q', 8) if big_tiff else ('I', 4)
+  if pointer_position+pointer_size>file_size:
+    return 0
+  f.seek(pointer_position)
+  return struct.unpack(byte_order+pointer_format,f.read(pointer_size))[0]
+
+
+def _read_tiff_page(f, byte_order, big_tiff, pointer_position, file_size):
+  """
+  read the page (IFD and image data) pointed to by the IFD pointer at pointer_position.
+  returns (image, position of the pointer to the next IFD), or None if the page is not written yet
+  (or only partly, see _tail_tiff_pages). Only uncompressed single-sample pages (as written by ScanImage) are supported.
+  """
+  pointer_format, pointer_size, count_format, entry_size = ('Q', 8, 'Q', 20) if big_tiff else ('I', 4, 'H', 12)
+  count_size=struct.calcsize(count_format)
+  offset=_read_tiff_pointer(f,byte_order,big_tiff,pointer_position,file_size)
+  if offset==0 or offset+count_size>file_size:
+    return None
+  f.seek(offset)
+  n_of_entries=struct.unpack(byte_order+count_format,f.read(count_size))[0]
+  next_pointer_position=offset+count_size+n_of_entries*entry_size
+  if next_pointer_position+pointer_size>file_size:
+    return None
+  entries=f.read(n_of_entries*entry_size)
+
+  #ImageWidth, ImageLength, BitsPerSample, Compression, StripOffsets, SamplesPerPixel, StripByteCounts, SampleFormat
+  tags={}
+  for entry_start in range(0,len(entries),entry_size):
+    entry=entries[entry_start:entry_start+entry_size]
+    tag, type_code = struct.unpack(byte_order+'HH',entry[:4])
+    if tag not in (256,257,258,259,273,277,279,339) or type_code not in _tiff_integer_types:
+      continue
+    count=struct.unpack(byte_order+pointer_format,entry[4:4+pointer_size])[0]
+    value_type=np.dtype(byte_order+_tiff_integer_types[type_code])
+    value_field=entry[4+pointer_size:]
+    if count*value_type.itemsize<=pointer_size:
+      data=value_field[:count*value_type.itemsize]
+    else:
+      value_offset=struct.unpack(byte_order+pointer_format,value_field)[0]
+      if value_offset+count*value_type.itemsize>file_size:
+        return None
+      f.seek(value_offset)
+      data=f.read(count*value_type.itemsize)
+    tags[tag]=np.frombuffer(data,dtype=value_type).astype(np.int64)
+
+  if tags.get(259,[1])[0]!=1 or tags.get(277,[1])[0]!=1:
+    raise ValueError('only uncompressed single-sample TIFF pages can be read while the file is written')
+  #the IFD is not completely written yet
+  if any(tag not in tags for tag in (256,257,258,273,279)) or int(tags.get(339,[1])[0]) not in (1,2,3):
+    return None
+  columns, rows = int(tags[256][0]), int(tags[257][0])
+  kind={1:'u', 2:'i', 3:'f'}[int(tags.get(339,[1])[0])]
+  dtype=np.dtype(byte_order+kind+str(int(tags[258][0])//8))
+  strip_offsets, strip_byte_counts = tags[273], tags[279]
+  if len(strip_offsets)!=len(strip_byte_counts) or np.sum(strip_byte_counts)<rows*columns*dtype.itemsize or np.max(strip_offsets+strip_byte_counts)>file_size:
+    return None
+
+  data=b''
+  for strip_offset, strip_byte_count in zip(strip_offsets,strip_byte_counts):
+    f.seek(int(strip_offset))
+    data+=f.read(int(strip_byte_count))
+  image=np.frombuffer(data,dtype=dtype,count=rows*columns).reshape(rows,columns).astype(dtype.newbyteorder('='))
+  return image, next_pointer_position
+
+
+def _tail_tiff_pages(file_name, page_queue, stop, poll_interval, idle_timeout):
+  """
+  follow the chain of pages of a TIFF file that is being written and put (page number, image, arrival time) on page_queue
+  as soon as each page is completely written (used by tail_tiff_pages in a background thread).
+  A page is complete when the writer has started the next page (the pointer to the next IFD is set) or when the file
+  has not changed during the last poll_interval (the writer may set the pointer to a page before writing it).
+  The arrival time (time.perf_counter) is taken when the page is read, before waiting for space on the queue.
+  Stops when no new page is written for idle_timeout seconds. The end (None) or an exception is put on the queue last.
+  """
+  f=None
+  try:
+    last_page_time=time.perf_counter()
+    header=None
+    page_number=0
+    polled_size=-1
+    while not stop.is_set():
+      page=None
+      if f is None and os.path.exists(file_name):
+        #unbuffered, so the pointers rewritten by the writer are not read from a stale buffer
+        f=open(file_name, "rb", buffering=0)
+      if f is not None:
+        file_size=os.fstat(f.fileno()).st_size
+        if header is None:
+          header=_read_tiff_header(f,file_size)
+          if header is not None:
+            byte_order, big_tiff, pointer_position = header
+        if header is not None:
+          page=_read_tiff_page(f,byte_order,big_tiff,pointer_position,file_size)
+          if page is not None and file_size!=polled_size and _read_tiff_pointer(f,byte_order,big_tiff,page[1],file_size)==0:
+            page=None
+      if page is None:
+        if time.perf_counter()-last_page_time>idle_timeout:
+          break
+        polled_size=file_size if f is not None else -1
+        time.sleep(poll_interval)
+        continue
+      image, pointer_position = page
+      last_page_time=time.perf_counter()
+      if not _put_unless_stopped(page_queue,(page_number,image,last_page_time),stop):
+        return
+      page_number+=1
+    _put_unless_stopped(page_queue,None,stop)
+  except Exception as error:
+    _put_unless_stopped(page_queue,error,stop)
+  finally:
+    if f is not None:
+      f.close()
+
+
+def tail_tiff_pages(file_name, poll_interval=0.05, idle_timeout=10, queue_size=256):
+  """
+  a generator to yield (page number, image, arrival time) for each page of a TIFF file (e.g. a ScanImage file)
+  while it is being written. The file is polled every poll_interval seconds by a background thread that follows
+  the chain of pages (only the new pages are read, the file is never parsed again from the start)
+  and the generator ends when no new page is written for idle_timeout seconds (the end of the acquisition).
+  At most queue_size pages wait in memory. The arrival time (time.perf_counter) can be used to measure the latency.
+  """
+  page_queue=queue.Queue(maxsize=queue_size)
+  stop=threading.Event()
+  reader=threading.Thread(target=_tail_tiff_pages, args=(file_name, page_queue, stop, poll_interval, idle_timeout), daemon=True)
+  reader.start()
+  try:
+    while True:
+      page=page_queue.get()
+      if page is None:
+        break
+      if isinstance(page, Exception):
+        raise page
+      yield page
+  finally:
+    #also stops the reader if the generator is closed early
+    stop.set()
+    reader.join()
+
+
+def _exponential_weight(tau, n_of_updates):
+  """
+  weight of the new value in a causal exponential average with time constant tau (in updates).
+  The first updates are a plain running mean (weight 1/n), so the average does not depend on its starting value.
+  tau of 0 (or None) keeps only the new value.
+  """
+  if not tau:
+    return 1.
+  return max(1-np.exp(-1/tau),1/n_of_updates)
+
+
+def preprocess_ScanImageFile_online(file_name, n_of_z, gaussian_sigma, registration_channel, upsample, filter_tau=1, reference_tau=100,
+                                    baseline_tau=100, response_tau=3, tdTomato_threshold=0, gcamp_threshold=0, ratio_threshold=0,
+                                    poll_interval=0.05, idle_timeout=10, callback=None, normalization='phase'):
+  """
+  a function to preprocess a ScanImage file while it is being acquired (see tail_tiff_pages).
+  As the pages arrive they are demultiplexed into channels ([GCaMP, tdTomato]) and z-levels and each frame is
+  * filtered with the spatial gaussian filter (gaussian_sigma[1:]) and a causal exponential filter in time with the time
+  constant filter_tau (volumes), instead of the temporal gaussian filter that needs the following frames.
+  * registered to the running reference image of its z-level: the exponential average of the registered frames with
+  the time constant reference_tau, starting from the first frame. The same shift is applied to the other channel.
+  * added to the exponential averages of GCaMP and of the ratio (GCaMP/tdTomato) with the time constants baseline_tau
+  (baseline) and response_tau (response), which give the live DF/F and DR/R maps. Thresholds as in pixel_traces.
+  Pixel values are made positive by subtracting the min of the first frame of each z-level and channel
+  (the offline methods use the min of the whole stack).
+  The work per frame does not depend on the length of the recording, so the latency stays bounded as long as
+  a frame is processed faster than it is acquired.
+
+  *registration_channel: index of the channel used to register ([GCaMP, tdTomato]).
+  *normalization: 'phase' or None (see register_images_batched).
+  *callback: called as callback(volume, registered, maps) after each volume. registered is the [2, n_of_z, rows, columns]
+  float32 array of the registered GCaMP and tdTomato images of the volume, maps the [2, n_of_z, rows, columns] live
+  DF/F and DR/R maps. Both arrays are updated in place by the next volume (copy them to keep them).
+
+  returns the [n_of_z, volumes, 2] shifts, the [2, n_of_z, rows, columns] DF/F and DR/R maps at the end and the
+  [n_of_z, volumes] latency (seconds from the arrival of the last page of each frame to the end of its processing).
+  """
+  from scipy.ndimage import gaussian_filter
+  n_of_channels=2
+  other_channel=1-registration_channel
+  spatial_sigma=gaussian_sigma[1:]
+
+  state=None
+  shifts=[[] for z_level in range(n_of_z)]
+  latency=[[] for z_level in range(n_of_z)]
+  pages=[None]*n_of_channels
+
+  for page_number, page, arrival_time in tail_tiff_pages(file_name, poll_interval, idle_timeout):
+    channel=page_number%n_of_channels
+    z_level=(page_number//n_of_channels)%n_of_z
+    volume=page_number//(n_of_channels*n_of_z)
+    pages[channel]=gaussian_filter(page.astype(np.float32),spatial_sigma)
+    if channel<n_of_channels-1:
+      continue
+
+    if state is None:
+      shape=(n_of_channels,n_of_z)+page.shape
+      state={'offset':np.zeros((n_of_channels,n_of_z),dtype=np.float32), 'filtered':np.zeros(shape,dtype=np.float32),
+             'registered':np.zeros(shape,dtype=np.float32), 'reference':np.zeros(shape[1:],dtype=np.float32),
+             'baseline':np.zeros(shape,dtype=np.float32), 'response':np.zeros(shape,dtype=np.float32),
+             'maps':np.zeros(shape,dtype=np.float32)}
+    filtered, registered, reference = state['filtered'], state['registered'], state['reference']
+    baseline, response, maps = state['baseline'], state['response'], state['maps']
+    n_of_updates=volume+1
+
+    #causal temporal filter
+    weight=_exponential_weight(filter_tau,n_of_updates)
+    for channel in range(n_of_channels):
+      filtered[channel,z_level]+=weight*(pages[channel]-filtered[channel,z_level])
+
+    #register to the running reference (the first frame is the reference)
+    if volume==0:
+      reference[z_level]=filtered[registration_channel,z_level]
+      state['offset'][:,z_level]=[np.min(filtered[channel,z_level]) for channel in range(n_of_channels)]
+    shift=register_images_batched(reference[z_level],filtered[registration_channel,z_level][None],upsample,registered[registration_channel,z_level][None],
+                                  filtered[other_channel,z_level][None],registered[other_channel,z_level][None],block_size=1,
+                                  normalization=normalization)
+    shifts[z_level].append(shift[0])
+    reference[z_level]+=_exponential_weight(reference_tau,n_of_updates)*(registered[registration_channel,z_level]-reference[z_level])
+
+    #baseline and response of GCaMP (F) and of the ratio (R, only where there is enough tdTomato)
+    F=registered[0,z_level]-state['offset'][0,z_level]
+    tdTomato=registered[1,z_level]-state['offset'][1,z_level]
+    R=np.zeros(F.shape,dtype=np.float32)
+    np.divide(F,tdTomato,where=(tdTomato>=tdTomato_threshold)&(tdTomato>0),out=R)
+    for index, values in enumerate((F,R)):
+      baseline[index,z_level]+=_exponential_weight(baseline_tau,n_of_updates)*(values-baseline[index,z_level])
+      response[index,z_level]+=_exponential_weight(response_tau,n_of_updates)*(values-response[index,z_level])
+    delta_over_baseline(response[0,z_level],baseline[0,z_level],gcamp_threshold,maps[0,z_level])
+    delta_over_baseline(response[1,z_level],baseline[1,z_level],ratio_threshold,maps[1,z_level])
+    maps[1,z_level][baseline[0,z_level]<gcamp_threshold]=0
+    latency[z_level].append(time.perf_counter()-arrival_time)
+
+    if z_level==n_of_z-1 and callback is not None:
+      callback(volume,registered,maps)
+
+  if state is None:
+    raise ValueError('no complete frame was written to %s' % file_name)
+  #only complete volumes
+  n_of_volumes=len(shifts[-1])
+  return (np.array([z_shifts[:n_of_volumes] for z_shifts in shifts]), state['maps'],
+          np.array([z_latency[:n_of_volumes] for z_latency in latency]))
+
+
+def latency_summary(latency):
+  """
+  a function to summarize the per-frame latency (seconds, e.g. from preprocess_ScanImageFile_online):
+  returns a dictionary with the number of frames and the mean, median, 95th percentile and max latency in milliseconds.
+  """
+  latency=np.ravel(latency)*1000
+  if latency.size==0:
+    return {'frames':0}
+  return {'frames':int(latency.size), 'mean_ms':float(np.mean(latency)), 'median_ms':float(np.median(latency)),
+          'p95_ms':float(np.percentile(latency,95)), 'max_ms':float(np.max(latency))}
+
+
+def _register_frames(reference_image, images, upsample, other_images, block_size, normalization='phase'):
+  """
+  register a chunk of frames and return the shifts and the registered images for both channels.
+  """
+  registered_images=np.zeros_like(images)
+  if other_images is None:
+    other_registered_images=None
+  else:
+    other_registered_images=np.zeros_like(other_images)
+
+  shifts=register_images_batched(reference_image, images, upsample, registered_images, other_images, other_registered_images, block_size, normalization)
+
+  return shifts, registered_images, other_registered_images
+
+
+def register_z_levels(reference_images, images, upsample, registered_images, other_images=None, other_registered_images=None, block_size=32, n_of_chunks=1, n_workers=1, backend='thread',
+                      normalization='phase'):
+  """
+  a function to register the images of each z-level to the reference image of that z-level (see register_images_batched).
+  Each z-level is split into n_of_chunks frame chunks and all (z-level, chunk) pairs are registered
+  with n_workers threads or processes.
+
+  *reference_images: [n_of_z, rows, columns] images to register to.
+  *images, registered_images: [n_of_z, frames, rows, columns] images to register and array to write the results into.
+  *other_images, other_registered_images: optional second channel. The same shift is applied to these images.
+  *normalization: 'phase' or None (see register_images_batched).
+
+  returns the [n_of_z, frames, 2] array of (row, column) shifts.
+  """
+  n_of_z=images.shape[0]
+  n_of_frames=images.shape[1]
+  chunks=split_frames(n_of_frames,n_of_chunks)
+
+  tasks=[]
+  arguments=[]
+  for z_level in range(n_of_z):
+    for start, end in chunks:
+      tasks.append((z_level,start,end))
+      if other_images is None:
+        arguments.append((reference_images[z_level],images[z_level,start:end],upsample,None,block_size,normalization))
+      else:
+        arguments.append((reference_images[z_level],images[z_level,start:end],upsample,other_images[z_level,start:end],block_size,normalization))
+
+  all_shift=np.zeros((n_of_z,n_of_frames,2))
+  results=run_in_parallel(_register_frames,arguments,n_workers,backend)
+  for (z_level, start, end), (shifts, registered, other_registered) in zip(tasks,results):
+    all_shift[z_level,start:end]=shifts
+    registered_images[z_level,start:end]=registered
+    if other_images is not None:
+      other_registered_images[z_level,start:end]=other_registered
+
+  return all_shift
+
+
+def register_running_reference(images, upsample, registered_images, other_images=None, other_registered_images=None, reference='exponential',
+                               reference_tau=100, reference_window=100, block_size=32, normalization='phase'):
+  """
+  a function to register the frames of one z-level in one pass to a running reference image, instead of the average
+  of all frames (which needs all frames before the registration starts and is blurred when the preparation slowly moves).
+  The first block of frames is registered to its average and the average of the registered frames is the first reference.
+  Each block of block_size frames is then registered to the reference and the reference is updated with the registered frames:
+  * reference='exponential': exponential average with the time constant reference_tau (frames).
+  Only the reference image is kept in memory.
+  * reference='window': average of the last reference_window registered frames. The frames that leave the window are read
+  back from registered_images, so only the sum of the window is kept in memory.
+  The first frames are a plain running average in both cases (see _exponential_weight).
+
+  *images, registered_images: [frames, rows, columns] images to register and array to write the results into
+  (can be memory-mapped). *other_images, other_registered_images, block_size, normalization: see register_images_batched.
+
+  returns the [frames, 2] array of (row, column) shifts.
+  """
+  if reference not in ('exponential','window'):
+    raise ValueError("reference must be either 'exponential' or 'window'")
+  n_of_frames=images.shape[0]
+  all_shift=np.zeros((n_of_frames,2))
+
+  #first reference: the first block registered to its average
+  first_block=np.asarray(images[:block_size])
+  first_registered=np.zeros(first_block.shape)
+  register_images_batched(np.mean(first_block,axis=0),first_block,upsample,first_registered,block_size=block_size,normalization=normalization)
+  reference_image=np.mean(first_registered,axis=0)
+  del first_block, first_registered
+  window_sum=np.zeros(reference_image.shape)
+
+  for start in range(0,n_of_frames,block_size):
+    end=min(start+block_size,n_of_frames)
+    if other_images is None:
+      all_shift[start:end]=register_images_batched(reference_image,images[start:end],upsample,registered_images[start:end],
+                                                   block_size=block_size,normalization=normalization)
+    else:
+      all_shift[start:end]=register_images_batched(reference_image,images[start:end],upsample,registered_images[start:end],
+                                                   other_images[start:end],other_registered_images[start:end],block_size,normalization)
+
+    #update the reference with the registered (rounded) frames
+    registered=np.asarray(registered_images[start:end],dtype=np.float64)
+    if reference=='exponential':
+      for index, frame in enumerate(registered):
+        reference_image+=_exponential_weight(reference_tau,start+index+1)*(frame-reference_image)
+    else:
+      window_sum+=np.sum(registered,axis=0)
+      drop_start, drop_end = max(0,start-reference_window), max(0,end-reference_window)
+      if drop_end>drop_start:
+        window_sum-=np.sum(registered_images[drop_start:drop_end],axis=0,dtype=np.float64)
+      reference_image=window_sum/min(end,reference_window)
+
+  return all_shift
+
+
+def register_z_levels_running(images, upsample, registered_images, other_images=None, other_registered_images=None, reference='exponential',
+                              reference_tau=100, reference_window=100, block_size=32, n_workers=1, normalization='phase'):
+  """
+  a function to register the images of each z-level to a running reference (see register_running_reference).
+  The frames of a z-level depend on the reference of the frames before them, so only the z-levels are processed
+  in parallel (n_workers threads, which write into registered_images directly).
+
+  *images, registered_images: [n_of_z, frames, rows, columns] images to register and array to write the results into.
+
+  returns the [n_of_z, frames, 2] array of (row, column) shifts.
+  """
+  arguments=[]
+  for z_level in range(images.shape[0]):
+    if other_images is None:
+      arguments.append((images[z_level],upsample,registered_images[z_level],None,None,reference,reference_tau,reference_window,block_size,normalization))
+    else:
+      arguments.append((images[z_level],upsample,registered_images[z_level],other_images[z_level],other_registered_images[z_level],
+                        reference,reference_tau,reference_window,block_size,normalization))
+  return np.array(run_in_parallel(register_running_reference,arguments,n_workers,'thread'))
+
+
+def reference_gradients(reference_image):
+  """
+  a function to precalculate the gradients of a reference image for residual_shifts:
+  returns (row gradient, column gradient, inverse of the 2x2 matrix of the sums of the gradient products).
+  """
+  gradient_rows, gradient_columns = np.gradient(np.asarray(reference_image,dtype=np.float64))
+  matrix=np.array([[np.sum(gradient_rows*gradient_rows), np.sum(gradient_rows*gradient_columns)],
+                   [np.sum(gradient_rows*gradient_columns), np.sum(gradient_columns*gradient_columns)]])
+  return gradient_rows, gradient_columns, np.linalg.pinv(matrix)
+
+
+def residual_shifts(images, reference_image, gradients):
+  """
+  a function to estimate the small shifts left between [frames, rows, columns] images (e.g. registered with the shift of
+  their volume) and the reference image with one linearized (Lucas-Kanade) step. Much cheaper than a registration (no FFT),
+  and accurate for residuals below about a pixel (smooth, filtered images).
+  *gradients: from reference_gradients(reference_image).
+
+  returns the [frames, 2] array of (row, column) displacements of the images from the reference.
+  """
+  gradient_rows, gradient_columns, inverse = gradients
+  difference=np.asarray(images,dtype=np.float64)-reference_image
+  projections=np.stack([np.einsum('frc,rc->f',difference,gradient_rows), np.einsum('frc,rc->f',difference,gradient_columns)],axis=1)
+  return -projections@inverse.T
+
+
+def _shift_volume_z_level(reference_image, gradients, images, shifts, registered_images, other_images, other_registered_images,
+                          upsample, refine_threshold, block_size, normalization):
+  """
+  apply the shifts of the volumes to the frames of one z-level (and the other channel), and register the frames
+  whose residual shift (see residual_shifts) is more than refine_threshold pixels to the reference of the z-level.
+  returns the shifts of the frames and the number of refined frames.
+  """
+  shifts=np.array(shifts)
+  apply_shifts_batched(images, shifts, registered_images, block_size)
+  if other_images is not None:
+    apply_shifts_batched(other_images, shifts, other_registered_images, block_size)
+  if refine_threshold is None:
+    return shifts, 0
+
+  residual=np.linalg.norm(residual_shifts(registered_images, reference_image, gradients),axis=1)
+  refine=np.flatnonzero(residual>refine_threshold)
+  if refine.size>0:
+    refined=np.zeros((refine.size,)+images.shape[1:],dtype=registered_images.dtype)
+    if other_images is None:
+      shifts[refine]=register_images_batched(reference_image, images[refine], upsample, refined, block_size=block_size, normalization=normalization)
+    else:
+      other_refined=np.zeros(refined.shape,dtype=other_registered_images.dtype)
+      shifts[refine]=register_images_batched(reference_image, images[refine], upsample, refined, other_images[refine], other_refined,
+                                             block_size, normalization)
+      other_registered_images[refine]=other_refined
+    registered_images[refine]=refined
+  return shifts, refine.size
+
+
+def register_volumes(reference_images, images, upsample, registered_images, other_images=None, other_registered_images=None, projection='max',
+                     refine_threshold=None, block_size=32, n_workers=1, normalization='phase'):
+  """
+  a function to register whole volumes with one shift per volume, for preparations that move rigidly: the projection
+  ('max' or 'mean') of all z-levels of each volume is registered to the projection of the reference images (see register_images_batched)
+  and the shift is applied to all z-levels (and the other channel), so there is one shift estimate per volume instead of one per z-level.
+  *refine_threshold: None, or the residual shift (pixels, see residual_shifts) above which a frame is registered
+  to the reference image of its own z-level (e.g. a z-level that moves differently).
+
+  *reference_images: [n_of_z, rows, columns] images to register to (e.g. the average image of each z-level).
+  *images, registered_images: [n_of_z, frames, rows, columns] images to register and array to write the results into.
+  *other_images, other_registered_images: optional second channel. The same shift is applied to these images.
+  Blocks of block_size volumes are processed at a time, z-levels with n_workers threads.
+
+  returns the [n_of_z, frames, 2] array of (row, column) shifts and the number of refined frames.
+  """
+  if projection=='max':
+    reference_projection=np.max(reference_images,axis=0)
+  elif projection=='mean':
+    reference_projection=np.mean(reference_images,axis=0)
+  else:
+    raise ValueError("projection must be either 'max' or 'mean'")
+  n_of_z, n_of_frames = images.shape[:2]
+  gradients=[reference_gradients(reference_images[z_level]) if refine_threshold is not None else None for z_level in range(n_of_z)]
+
+  all_shift=np.zeros((n_of_z,n_of_frames,2))
+  n_of_refined=0
+  for start in range(0,n_of_frames,block_size):
+    end=min(start+block_size,n_of_frames)
+    if projection=='max':
+      projections=np.max(images[:,start:end],axis=0)
+    else:
+      projections=np.mean(images[:,start:end],axis=0)
+    volume_shifts=register_images_batched(reference_projection, projections, upsample, np.zeros(projections.shape), block_size=block_size,
+                                          normalization=normalization)
+
+    arguments=[(reference_images[z_level], gradients[z_level], images[z_level,start:end], volume_shifts, registered_images[z_level,start:end],
+                None if other_images is None else other_images[z_level,start:end],
+                None if other_images is None else other_registered_images[z_level,start:end],
+                upsample, refine_threshold, block_size, normalization) for z_level in range(n_of_z)]
+    for z_level, (shifts, refined) in enumerate(run_in_parallel(_shift_volume_z_level, arguments, n_workers, 'thread')):
+      all_shift[z_level,start:end]=shifts
+      n_of_refined+=refined
+
+  return all_shift, n_of_refined
+
+
+def _shift_frames(images, shifts, block_size):
+  """
+  apply the shifts to a chunk of frames and return the shifted images.
+  """
+  return apply_shifts_batched(images, shifts, np.zeros_like(images), block_size)
+
+
+def shift_z_levels(images, shifts, shifted_images, block_size=32, n_of_chunks=1, n_workers=1, backend='thread'):
+  """
+  a function to apply the [n_of_z, frames, 2] shifts to the [n_of_z, frames, rows, columns] images
+  (see apply_shifts_batched). All (z-level, frame chunk) pairs are shifted with n_workers threads or processes.
+  """
+  n_of_z=images.shape[0]
+  chunks=split_frames(images.shape[1],n_of_chunks)
+
+  tasks=[]
+  arguments=[]
+  for z_level in range(n_of_z):
+    for start, end in chunks:
+      tasks.append((z_level,start,end))
+      arguments.append((images[z_level,start:end],shifts[z_level,start:end],block_size))
+
+  results=run_in_parallel(_shift_frames,arguments,n_workers,backend)
+  for (z_level, start, end), result in zip(tasks,results):
+    shifted_images[z_level,start:end]=result
+
+  return shifted_images
+
+
+def image_stack_min(images, chunk_frames=100):
+  """
+  a function to find the minimum pixel value of a [n_of_z, frames, rows, columns] image stack
+  reading chunk_frames frames of each z-level at a time (so a memory-mapped stack is never fully loaded).
+  """
+  stack_min=None
+  for z_level in range(images.shape[0]):
+    for start in range(0,images.shape[1],chunk_frames):
+      chunk_min=np.min(images[z_level,start:start+chunk_frames])
+      if stack_min is None or chunk_min<stack_min:
+        stack_min=chunk_min
+  return stack_min
+
+
+#order of the maps in the array returned by piezo_response_maps (and saved by get_piezo_response_map_separate_z)
+map_names=['average_tdTomato', 'average_gcamp', 'base_tdTomato', 'base_gcamp', 'ratio_response', 'ratio_baseline', 'DF_F_map', 'DR_R_map']
+
+
+def piezo_response_maps(tdTomato_registered, gcamp_registered, piezo_starts, response_range, base_range, tdTomato_threshold, gcamp_threshold, ratio_threshold,
+                        maps=None, dtype=np.float64, tdTomato_offset=0, gcamp_offset=0, block_size=128):
+  """
+  a function to calculate the baseline and the response images, and the DF/F and DR/R maps for all z-levels at once,
+  averaged over all piezo stimuli.
+  *tdTomato_registered, gcamp_registered: [n_of_z, frames, rows, columns] registered images (can be memory-mapped,
+  only the frames in the windows are read).
+  *piezo_starts: piezo start frames (volumes), one for each stimulus. Stimuli whose response or baseline
+  window is outside the recording are not used (with a warning). Raises ValueError if no stimulus is left.
+  *maps: optional preallocated [8, n_of_z, rows, columns] array to write the maps into (see map_names for the order).
+  *dtype: np.float64 (default, same result as calculating each z-level and stimulus separately, up to float rounding) or np.float32 (half the memory).
+  *tdTomato_offset, gcamp_offset: value subtracted from the frames in the windows (e.g. the min of each stack, see image_stack_min),
+  so the whole stack never needs to be offset or copied.
+  *block_size: number of frames read at a time. The baseline and response windows of as many stimuli as fit in block_size
+  frames of all z-levels (at least one stimulus) are read with one indexed read and summed in one reduction per channel
+  and window, so the memory used does not grow with the number of stimuli.
+  Pixels below the thresholds are 0 in the ratio, DF/F and DR/R maps.
+
+  returns the [8, n_of_z, rows, columns] array of maps: average_tdTomato, average_gcamp, base_tdTomato, base_gcamp,
+  ratio_response, ratio_baseline, DF_F_map, DR_R_map
+  """
+  n_of_z, n_of_frames, rows, columns = gcamp_registered.shape
+  piezo_starts=np.asarray(piezo_starts).reshape(-1)
+  n_of_stimuli=len(piezo_starts)
+  piezo_starts=piezo_starts[(piezo_starts-base_range>=0)&(piezo_starts+response_range<=n_of_frames)]
+  if len(piezo_starts)==0:
+    raise ValueError('none of the %d piezo stimuli has its baseline (%d frames) and response (%d frames) window inside the %d frames of the recording'
+                     % (n_of_stimuli, base_range, response_range, n_of_frames))
+  if len(piezo_starts)<n_of_stimuli:
+    warnings.warn('%d of %d piezo stimuli are not used: their baseline or response window is outside the %d frames of the recording'
+                  % (n_of_stimuli-len(piezo_starts), n_of_stimuli, n_of_frames))
+
+  if maps is None:
+    maps=np.zeros((len(map_names),n_of_z,rows,columns),dtype=dtype)
+  else:
+    maps[...]=0
+  average_tdTomato, average_gcamp, base_tdTomato, base_gcamp, ratio_response, ratio_baseline, DF_F_map, DR_R_map = maps
+
+  #frames of the baseline and response window of each stimulus ([stimuli, base_range+response_range])
+  window_frames=piezo_starts[:,None]+np.arange(-base_range,response_range)[None,:]
+  stimuli_per_block=max(1,block_size//(n_of_z*window_frames.shape[1]))
+
+  #sum the response and baseline windows of each block of stimuli over the stimuli and frames (all z-levels at once)
+  for start in range(0,len(piezo_starts),stimuli_per_block):
+    frames=window_frames[start:start+stimuli_per_block]
+    for images, average, base in [(tdTomato_registered, average_tdTomato, base_tdTomato), (gcamp_registered, average_gcamp, base_gcamp)]:
+      #only the frames in the windows are read, [n_of_z, stimuli, frames, rows, columns]
+      windows=images[:,frames]
+      average+=windows[:,:,base_range:].sum(axis=(1,2),dtype=maps.dtype)
+      base+=windows[:,:,:base_range].sum(axis=(1,2),dtype=maps.dtype)
+  #average over the stimuli and frames and offset (all windows of a kind have the same number of frames)
+  for average, offset, n_of_window_frames in [(average_tdTomato, tdTomato_offset, response_range), (average_gcamp, gcamp_offset, response_range),
+                                              (base_tdTomato, tdTomato_offset, base_range), (base_gcamp, gcamp_offset, base_range)]:
+    average/=len(piezo_starts)*n_of_window_frames
+    average-=offset
+
+  #calculate ratio, but we need to exclude pixels with very low tdTomato value to avoid high noise
+  tdTomato_mask=(average_tdTomato>=tdTomato_threshold)&(base_tdTomato>=tdTomato_threshold)
+  np.divide(average_gcamp,average_tdTomato,where=tdTomato_mask,out=ratio_response)
+  np.divide(base_gcamp,base_tdTomato,where=tdTomato_mask,out=ratio_baseline)
+
+  #DF/F calculated only for pixels whose base_gcamp value is above the threshold
+  window_average=np.zeros((n_of_z,rows,columns),dtype=maps.dtype)
+  np.subtract(average_gcamp,base_gcamp,out=window_average)
+  np.divide(window_average,base_gcamp,where=(base_gcamp>=gcamp_threshold),out=DF_F_map)
+  DF_F_map[base_gcamp<=gcamp_threshold]=0
+
+  #DR/R calculated only for pixels whose ratio_baseline is above the threshold and we have certain level of baseline gcamp
+  np.subtract(ratio_response,ratio_baseline,out=window_average)
+  np.divide(window_average,ratio_baseline,where=((ratio_baseline>=ratio_threshold)&(base_gcamp>=gcamp_threshold)),out=DR_R_map)
+
+  return maps
+
+
+def baseline_knots(n_of_frames, baseline_step):
+  """
+  frames where the sliding percentile baseline is calculated: every baseline_step frames and the last frame.
+  The baseline of the frames in between is linearly interpolated (baseline_step=1 is the exact sliding percentile).
+  """
+  knots=np.arange(0,n_of_frames,baseline_step)
+  if knots[-1]!=n_of_frames-1:
+    knots=np.append(knots,n_of_frames-1)
+  return knots
+
+
+def window_percentile(values, percentile):
+  """
+  percentile of values along the last axis (same as np.percentile with the default linear interpolation).
+  Uses a single partition and the min of the values above it, which is faster than np.percentile
+  for many short series (e.g. the baseline window of every pixel).
+  """
+  position=percentile/100*(values.shape[-1]-1)
+  lower=int(np.floor(position))
+  fraction=position-lower
+  partitioned=np.partition(values,lower,axis=-1)
+  result=partitioned[...,lower]
+  if fraction>0:
+    result=result+(partitioned[...,lower+1:].min(axis=-1)-result)*fraction
+  return result
+
+
+def _interpolate_baseline(knot_start, baseline_start, knot_end, baseline_end, start, end):
+  """
+  linearly interpolate the baseline ([..., 1] array at each knot) between two knots for the frames from start to end
+  ([..., end-start] array, frames on the last axis).
+  """
+  if knot_end==knot_start:
+    return np.repeat(baseline_start,end-start,axis=-1)
+  weights=(np.arange(start,end,dtype=np.float32)-knot_start)/(knot_end-knot_start)
+  return baseline_start+weights*(baseline_end-baseline_start)
+
+
+def delta_over_baseline(values, baseline, threshold, out):
+  """
+  (values-baseline)/baseline where baseline>=threshold (and >0), 0 elsewhere, written into out.
+  """
+  np.subtract(values,baseline,out=out)
+  valid=(baseline>=threshold)&(baseline>0)
+  np.divide(out,baseline,where=valid,out=out)
+  out[~valid]=0
+  return out
+
+
+def sliding_percentile_baseline(traces, baseline_window, baseline_percentile=10, baseline_step=1):
+  """
+  a function to calculate the running baseline of traces ([frames, ...] array, e.g. [frames, n_of_rois]):
+  the baseline_percentile of the baseline_window frames centered on each frame (the window is cut at the start
+  and the end of the recording). With baseline_step>1 the percentile is calculated every baseline_step frames
+  and linearly interpolated in between.
+
+  returns a float32 array with the same shape as traces.
+  """
+  traces=np.asarray(traces,dtype=np.float32)
+  n_of_frames=traces.shape[0]
+  half_window=baseline_window//2
+  #frames on the last axis
+  series=np.moveaxis(traces,0,-1)
+  baseline=np.empty(series.shape,dtype=np.float32)
+  knots=baseline_knots(n_of_frames,baseline_step)
+  values=[window_percentile(series[...,max(0,knot-half_window):knot+half_window+1],baseline_percentile)[...,None] for knot in knots]
+  baseline[...,knots[-1]:]=values[-1]
+  for index in range(len(knots)-1):
+    baseline[...,knots[index]:knots[index+1]]=_interpolate_baseline(knots[index],values[index],knots[index+1],values[index+1],knots[index],knots[index+1])
+  return np.moveaxis(baseline,-1,0)
+
+
+def _write_frames(images, start, values, block_pixels=4096):
+  """
+  write values ([pixels, frames]) into the frames of images ([frames, rows, columns]) from start,
+  transposing block_pixels pixels at a time (faster than transposing all pixels at once).
+  """
+  frames=np.empty((values.shape[1],)+images.shape[1:],dtype=images.dtype)
+  flat_frames=frames.reshape(values.shape[1],-1)
+  for pixel in range(0,values.shape[0],block_pixels):
+    flat_frames[:,pixel:pixel+block_pixels]=values[pixel:pixel+block_pixels].T
+  images[start:start+values.shape[1]]=frames
+
+
+def _pixel_traces_z_level(tdTomato_images, gcamp_images, dF_F, dR_R, baseline_window, baseline_percentile, baseline_step, chunk_frames,
+                          tdTomato_offset, gcamp_offset, tdTomato_threshold, gcamp_threshold, ratio_threshold):
+  """
+  DF/F and DR/R traces of one z-level ([frames, rows, columns] images, see pixel_traces).
+  Frames are read once, chunk_frames at a time, into a buffer ([pixels, frames], so the baseline window of
+  each pixel is contiguous) that keeps only the frames still needed for the baseline window of the next knot.
+  """
+  n_of_frames, rows, columns = gcamp_images.shape
+  half_window=baseline_window//2
+  knots=baseline_knots(n_of_frames,baseline_step)
+
+  #GCaMP (F) and ratio (R) of the frames from buffer_start
+  buffer_start=0
+  buffer_F=np.zeros((rows*columns,0),dtype=np.float32)
+  buffer_R=np.zeros((rows*columns,0),dtype=np.float32)
+  previous=None
+
+  for index, knot in enumerate(knots):
+    #read the frames up to the end of the baseline window of this knot
+    window_end=min(n_of_frames,knot+half_window+1)
+    buffer_end=buffer_start+buffer_F.shape[1]
+    if window_end>buffer_end:
+      read_end=min(n_of_frames,max(window_end,buffer_end+chunk_frames))
+      F=np.subtract(gcamp_images[buffer_end:read_end],gcamp_offset,dtype=np.float32).reshape(read_end-buffer_end,-1).T
+      tdTomato=np.subtract(tdTomato_images[buffer_end:read_end],tdTomato_offset,dtype=np.float32).reshape(read_end-buffer_end,-1).T
+      #ratio only for pixels with enough tdTomato (0 elsewhere)
+      R=np.zeros(F.shape,dtype=np.float32)
+      np.divide(F,tdTomato,where=(tdTomato>=tdTomato_threshold)&(tdTomato>0),out=R)
+      buffer_F=np.concatenate((buffer_F,F),axis=1)
+      buffer_R=np.concatenate((buffer_R,R),axis=1)
+      del F, tdTomato, R
+
+    window_start=max(0,knot-half_window)
+    baseline=[window_percentile(values[:,window_start-buffer_start:window_end-buffer_start],baseline_percentile)[:,None]
+              for values in (buffer_F,buffer_R)]
+
+    #write the frames from the previous knot to this knot (included if it is the last one)
+    if previous is None:
+      previous=(knot,baseline)
+    previous_knot, previous_baseline = previous
+    end=knot+1 if index==len(knots)-1 else knot
+    if end>previous_knot:
+      F0=_interpolate_baseline(previous_knot,previous_baseline[0],knot,baseline[0],previous_knot,end)
+      R0=_interpolate_baseline(previous_knot,previous_baseline[1],knot,baseline[1],previous_knot,end)
+      output=np.empty(F0.shape,dtype=np.float32)
+      delta_over_baseline(buffer_F[:,previous_knot-buffer_start:end-buffer_start],F0,gcamp_threshold,output)
+      _write_frames(dF_F,previous_knot,output)
+      #DR/R only for pixels with enough baseline GCaMP (as in piezo_response_maps)
+      delta_over_baseline(buffer_R[:,previous_knot-buffer_start:end-buffer_start],R0,ratio_threshold,output)
+      output[F0<gcamp_threshold]=0
+      _write_frames(dR_R,previous_knot,output)
+    previous=(knot,baseline)
+
+    #only keep the frames needed for the output and the baseline window of the next knot
+    if index<len(knots)-1:
+      keep_start=min(knot,max(0,knots[index+1]-half_window))
+      buffer_F=buffer_F[:,keep_start-buffer_start:]
+      buffer_R=buffer_R[:,keep_start-buffer_start:]
+      buffer_start=keep_start
+
+
+def pixel_traces(tdTomato_registered, gcamp_registered, dF_F, dR_R, baseline_window, baseline_percentile=10, baseline_step=1, chunk_frames=100,
+                 tdTomato_offset=0, gcamp_offset=0, tdTomato_threshold=0, gcamp_threshold=0, ratio_threshold=0, n_workers=1):
+  """
+  a function to calculate the DF/F and DR/R time series of every pixel of all z-levels in one pass over the registered images.
+  The baseline of each pixel is the running baseline_percentile of the baseline_window frames centered on each frame
+  (see sliding_percentile_baseline), calculated every baseline_step frames and linearly interpolated in between.
+  Calculations are in float32 and only about baseline_window+chunk_frames frames of each z-level are in memory.
+  z-levels are processed by n_workers threads.
+
+  *tdTomato_registered, gcamp_registered: [n_of_z, frames, rows, columns] registered images (can be memory-mapped).
+  *dF_F, dR_R: [n_of_z, frames, rows, columns] float32 arrays to write the traces into (e.g. from create_image_stack).
+  *tdTomato_offset, gcamp_offset: value subtracted from the images (e.g. the min of each stack, see image_stack_min).
+  *tdTomato_threshold: the ratio (GCaMP/tdTomato) is 0 where tdTomato is below it.
+  *gcamp_threshold, ratio_threshold: DF/F (and DR/R) is 0 where the GCaMP baseline is below gcamp_threshold,
+  DR/R is 0 where the ratio baseline is below ratio_threshold.
+  """
+  arguments=[(tdTomato_registered[z_level], gcamp_registered[z_level], dF_F[z_level], dR_R[z_level], baseline_window, baseline_percentile,
+              baseline_step, chunk_frames, tdTomato_offset, gcamp_offset, tdTomato_threshold, gcamp_threshold, ratio_threshold)
+             for z_level in range(gcamp_registered.shape[0])]
+  run_in_parallel(_pixel_traces_z_level, arguments, n_workers, 'thread')
+
+
+def rasterize_rois(rois, rows, columns):
+  """
+  a function to rasterize polygon ROIs into sets of pixel indices.
+  *rois: list of (z_level, points), points are the [x, y] vertices of a polygon as in bbox_select.selected_points
+  (x counted from the left, y from the top, subpixel values are fine).
+  returns a list of (z_level, pixel indices) with the flat (row*columns+column) index of each pixel inside each polygon.
+  """
+  from skimage.draw import polygon
+  roi_pixels=[]
+  for roi_number, (z_level, points) in enumerate(rois):
+    points=np.asarray(points,dtype=np.float64).reshape(-1,2)
+    pixel_rows, pixel_columns = polygon(points[:,1],points[:,0],shape=(rows,columns))
+    if pixel_rows.size==0:
+      raise ValueError('ROI %d (z-level %d) has no pixels inside its polygon' % (roi_number, z_level))
+    roi_pixels.append((int(z_level), np.ravel_multi_index((pixel_rows,pixel_columns),(rows,columns))))
+  return roi_pixels
+
+
+def roi_matrices(roi_pixels, n_of_z):
+  """
+  a function to make a sparse averaging matrix for the ROIs of each z-level.
+  Only the pixels that are in at least one ROI of the z-level (the union) are columns of the matrix, so the matrix
+  times a [union pixels, frames] block is the mean of each ROI in each frame.
+  *roi_pixels: list of (z_level, pixel indices) from rasterize_rois.
+  returns a list of (z_level, roi numbers, union pixel indices, [n_of_rois, n_of_union_pixels] csr matrix)
+  for each z-level that has ROIs.
+  """
+  from scipy.sparse import csr_matrix
+  matrices=[]
+  for z_level in range(n_of_z):
+    roi_numbers=[roi_number for roi_number, (roi_z_level, _) in enumerate(roi_pixels) if roi_z_level==z_level]
+    if len(roi_numbers)==0:
+      continue
+    pixels=[roi_pixels[roi_number][1] for roi_number in roi_numbers]
+    union=np.unique(np.concatenate(pixels))
+    matrix_rows=np.repeat(np.arange(len(pixels)),[len(roi) for roi in pixels])
+    matrix_columns=np.searchsorted(union,np.concatenate(pixels))
+    weights=np.concatenate([np.full(len(roi),1/len(roi)) for roi in pixels])
+    matrix=csr_matrix((weights,(matrix_rows,matrix_columns)),shape=(len(pixels),len(union)))
+    matrices.append((z_level, np.array(roi_numbers), union, matrix))
+  return matrices
+
+
+def _roi_traces_z_level(images, roi_numbers, union, matrix, traces, chunk_frames, offset):
+  """
+  mean of each ROI of one z-level ([frames, rows, columns] images) written into traces[roi_numbers]:
+  the union pixels of each chunk of frames are gathered and multiplied by the sparse matrix.
+  """
+  n_of_frames=images.shape[0]
+  for start in range(0,n_of_frames,chunk_frames):
+    end=min(start+chunk_frames,n_of_frames)
+    block=np.take(np.asarray(images[start:end]).reshape(end-start,-1),union,axis=1).astype(np.float64)
+    traces[roi_numbers,start:end]=(matrix@block.T)-offset
+
+
+def roi_traces(images, roi_pixels, chunk_frames=100, offset=0, n_workers=1):
+  """
+  a function to extract the mean trace of each ROI from an image stack with one sparse matrix product per chunk of frames
+  (instead of a boolean mask mean per ROI and frame).
+  *images: [n_of_z, frames, rows, columns] image stack (can be memory-mapped, chunk_frames frames are read at a time).
+  *roi_pixels: list of (z_level, pixel indices) from rasterize_rois.
+  *offset: value subtracted from the images (e.g. the min of the stack, see image_stack_min).
+  z-levels are processed by n_workers threads.
+
+  returns a [n_of_rois, frames] float32 array.
+  """
+  n_of_z, n_of_frames = images.shape[:2]
+  traces=np.zeros((len(roi_pixels),n_of_frames),dtype=np.float32)
+  arguments=[(images[z_level], roi_numbers, union, matrix, traces, chunk_frames, offset)
+             for z_level, roi_numbers, union, matrix in roi_matrices(roi_pixels, n_of_z)]
+  run_in_parallel(_roi_traces_z_level, arguments, n_workers, 'thread')
+  return traces
+
+
+def roi_trace_responses(gcamp_traces, tdTomato_traces, baseline_window, baseline_percentile=10, baseline_step=1,
+                        tdTomato_threshold=0, gcamp_threshold=0, ratio_threshold=0):
+  """
+  a function to calculate the DF/F and DR/R of ROI traces ([n_of_rois, frames], see roi_traces)
+  with the running percentile baseline (see sliding_percentile_baseline). Thresholds as in pixel_traces.
+
+  returns the [n_of_rois, frames] float32 DF/F and DR/R traces.
+  """
+  F=np.asarray(gcamp_traces,dtype=np.float32)
+  tdTomato=np.asarray(tdTomato_traces,dtype=np.float32)
+  #ratio only for ROIs (and frames) with enough tdTomato (0 elsewhere)
+  R=np.zeros(F.shape,dtype=np.float32)
+  np.divide(F,tdTomato,where=(tdTomato>=tdTomato_threshold)&(tdTomato>0),out=R)
+
+  F0=sliding_percentile_baseline(F.T,baseline_window,baseline_percentile,baseline_step).T
+  R0=sliding_percentile_baseline(R.T,baseline_window,baseline_percentile,baseline_step).T
+  dF_F=delta_over_baseline(F,F0,gcamp_threshold,np.empty(F.shape,dtype=np.float32))
+  dR_R=delta_over_baseline(R,R0,ratio_threshold,np.empty(R.shape,dtype=np.float32))
+  dR_R[F0<gcamp_threshold]=0
+  return dF_F, dR_R
+
+
+def make_video_lut(min_range, max_range):
+  """
+  a function to make the lookup table that maps int16 pixel values to uint8 for the videos.
+  Values at or below min_range are 0, values at or above max_range are 255 and the others are value/max_range*255
+  (truncated), the same as clipping and normalizing the images. Index the table with the int16 images viewed
+  as uint16 (see images_to_uint8), so no float copy of the images is needed.
+  """
+  values=np.arange(65536,dtype=np.uint32).astype(np.uint16).view(np.int16).copy()
+  values[values<=min_range]=0
+  values[values>=max_range]=max_range
+  return np.uint8((values/max_range)*255)
+
+
+def images_to_uint8(images, lut, min_range, max_range, out=None):
+  """
+  a function to map images to uint8 with the lookup table from make_video_lut (int16 images),
+  or by clipping and normalizing them (other data types, e.g. older pickle files).
+  *out: optional uint8 array (e.g. part of the video frame) to write into.
+  """
+  if images.dtype==np.int16:
+    if out is not None:
+      return np.take(lut,images.view(np.uint16),out=out)
+    return np.take(lut,images.view(np.uint16))
+  else:
+    images=np.array(images)
+    images[images<=min_range]=0
+    images[images>=max_range]=max_range
+    converted=np.uint8((images/max_range)*255)
+  if out is None:
+    return converted
+  out[...]=converted
+  return out
+
+
+def _put_unless_stopped(item_queue, item, stop):
+  """
+  put item on a bounded queue, waiting while it is full unless stop is set (the consumer is gone).
+  returns False if stopped.
+  """
+  while not stop.is_set():
+    try:
+      item_queue.put(item, timeout=0.1)
+      return True
+    except queue.Full:
+      pass
+  return False
+
+
+def _decode_camera_frames(input_video_file, frame_numbers, resized_size, frame_queue, stop):
+  """
+  decode the camera video forward from the start and put the frames in frame_numbers on frame_queue
+  (used by read_camera_frames in a background thread). Frames that are not needed are skipped with grab()
+  (no decoding to an image); a frame number that repeats reuses the last image. A frame number lower than
+  the previous one falls back to seeking. The end (None) or an exception is put on the queue last.
+  """
+  import cv2
+  cap = cv2.VideoCapture(input_video_file)
+  try:
+    next_frame=0#frame returned by the next grab()
+    image=None
+    for frame_number in frame_numbers:
+      frame_number=int(frame_number)
+      if image is None or frame_number!=next_frame-1:
+        if frame_number<next_frame:
+          cap.set(1, frame_number)
+          next_frame=frame_number
+        while next_frame<=frame_number:
+          if not cap.grab():
+            raise ValueError('could not read frame %d of %s' % (next_frame, input_video_file))
+          next_frame+=1
+        ret, temp_frame = cap.retrieve()
+        image=temp_frame[:,:,0]
+        if resized_size is not None:
+          image=cv2.resize(image,resized_size,interpolation = cv2.INTER_AREA)
+      if not _put_unless_stopped(frame_queue, image, stop):
+        return
+    _put_unless_stopped(frame_queue, None, stop)
+  except Exception as error:
+    _put_unless_stopped(frame_queue, error, stop)
+  finally:
+    cap.release()
+
+
+def read_camera_frames(input_video_file, frame_numbers, resized_size, queue_size=64):
+  """
+  a generator to yield the first color channel of the camera video frames in frame_numbers,
+  resized to resized_size (width, height), or not resized if resized_size is None.
+  frame_numbers should be non-decreasing (e.g. the camera frame of each imaging volume), so the video is decoded
+  once from the start instead of seeking to each frame (each seek decodes again from the previous keyframe).
+  Decoding runs in a background thread and at most queue_size frames wait in memory for the video writer.
+  """
+  frame_queue=queue.Queue(maxsize=queue_size)
+  stop=threading.Event()
+  decoder=threading.Thread(target=_decode_camera_frames, args=(input_video_file, frame_numbers, resized_size, frame_queue, stop), daemon=True)
+  decoder.start()
+  try:
+    while True:
+      image=frame_queue.get()
+      if image is None:
+        break
+      if isinstance(image, Exception):
+        raise image
+      yield image
+  finally:
+    #also stops the decoder if the generator is closed early
+    stop.set()
+    decoder.join()
+
+
+def _get_unless_stopped(item_queue, stop):
+  """
+  get an item from a queue, waiting while it is empty unless stop is set. returns None if stopped.
+  """
+  while not stop.is_set():
+    try:
+      return item_queue.get(timeout=0.1)
+    except queue.Empty:
+      pass
+  return None
+
+
+def _compose_video_frame(frame, frame_number, tdTomato_images, gcamp_images, luts, ranges, camera_image):
+  """
+  compose one video frame (used by render_synchronized_video in a thread pool): the maximum intensity projection
+  (over z) of the tdTomato and GCaMP images mapped to uint8, and the camera image (resized to fit) on the right.
+  """
+  import cv2
+  y_size, x_size = tdTomato_images.shape[2:]
+  for channel, images in enumerate((tdTomato_images, gcamp_images)):
+    projection=np.amax(images[:,frame_number],axis=0)
+    images_to_uint8(projection,luts[channel],*ranges[channel],out=frame[:,channel*x_size:(channel+1)*x_size])
+  if camera_image is not None:
+    camera_width=frame.shape[1]-x_size*2
+    if camera_image.shape!=(y_size,camera_width):
+      camera_image=cv2.resize(camera_image,(camera_width,y_size),interpolation = cv2.INTER_AREA)
+    frame[:,x_size*2:]=camera_image
+  return frame
+
+
+def render_synchronized_video(video_name, tdTomato_images, gcamp_images, tdTomato_range, gcamp_range, frames_per_second,
+                              camera_frames=None, camera_width=0, n_workers=1, buffer_frames=None):
+  """
+  a function to write a gray scale video of the maximum intensity projection (over z) of the tdTomato and GCaMP images
+  side by side (and the camera image on the right).
+  Frames are composed by n_workers threads (projection, lookup table to uint8 and resizing the camera image)
+  and written in order by one encoder thread. At most buffer_frames frames (default 4*n_workers) are composed
+  or waiting to be written, and their uint8 buffers are reused, so the memory used does not depend on the
+  length of the recording (the images can be memory-mapped).
+  *tdTomato_images, gcamp_images: [n_of_z, frames, rows, columns] registered images.
+  *tdTomato_range, gcamp_range: (min_range, max_range) for each channel (see make_video_lut).
+  *camera_frames: optional iterator of uint8 camera images, one for each frame
+  (resized to [rows, camera_width] if they have another size). It is closed at the end (e.g. read_camera_frames
+  stops its decoder thread), also if composing or writing a frame raises.
+  """
+  import cv2
+  n_of_z, total_frames, y_size, x_size = tdTomato_images.shape
+  ranges=[tdTomato_range, gcamp_range]
+  luts=[make_video_lut(*tdTomato_range), make_video_lut(*gcamp_range)]
+  if buffer_frames is None:
+    buffer_frames=4*n_workers
+
+  #Image width will be 2 * imaging_width (+ camera image)
+  #Final "0" necessary for gray scale image
+  video = cv2.VideoWriter(video_name,cv2.VideoWriter_fourcc(*'mp4v'),frames_per_second,(x_size*2+camera_width,y_size),0)
+
+  #frame buffers are taken from free_frames, composed, written by the encoder and put back
+  free_frames=queue.Queue()
+  for _ in range(buffer_frames):
+    free_frames.put(np.zeros((y_size,x_size*2+camera_width),dtype=np.uint8))
+  #futures of the composed frames in frame order (the encoder waits for each one in turn)
+  composed_frames=queue.Queue()
+  stop=threading.Event()
+  encoder_errors=[]
+
+  def encode():
+    try:
+      while True:
+        future=composed_frames.get()
+        #after an error, the frames that are not written yet are dropped
+        if future is None or stop.is_set():
+          break
+        frame=future.result()
+        video.write(frame)
+        free_frames.put(frame)
+    except Exception as error:
+      encoder_errors.append(error)
+      stop.set()
+
+  encoder=threading.Thread(target=encode, daemon=True)
+  encoder.start()
+  try:
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+      for frame_number in range(total_frames):
+        #camera frames are read in order here (see read_camera_frames)
+        camera_image=next(camera_frames) if camera_frames is not None else None
+        frame=_get_unless_stopped(free_frames, stop)
+        if frame is None:
+          break
+        composed_frames.put(executor.submit(_compose_video_frame, frame, frame_number, tdTomato_images, gcamp_images, luts, ranges, camera_image))
+  except BaseException:
+    #stop the encoder (and the camera reader below) instead of writing the frames composed so far
+    stop.set()
+    raise
+  finally:
+    composed_frames.put(None)
+    encoder.join()
+    video.release()
+    if camera_frames is not None and hasattr(camera_frames, 'close'):
+      camera_frames.close()
+  if encoder_errors:
+    raise encoder_errors[0]
@@ -0,0 +1,67 @@
+"""
+Benchmark for matching imaging frames to camera frames (detect_camera_imaging_frames2).
+
+Compares the original loop (np.argmin over all camera peaks for each imaging peak, O(N*M))
+with match_nearest_peaks (sorted search, O(N log M)) on synthetic pulse trains of increasing length,
+and checks that both give the same image_in_camera_index and camera_minus_image_index.
+
+Run from the repository directory:
+  python benchmarks/benchmark_frame_matching.py
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Python_functions_for_preprocessing_and_analyzing_two_photon_imaging_data import match_nearest_peaks
+
+
+def make_pulse_trains(duration, camera_interval=20, image_interval=333, jitter=2, seed=0):
+  """
+  make sorted peak indices for a camera and an imaging frame signal of duration samples
+  (with some jitter, so ties and uneven intervals happen).
+  """
+  rng=np.random.default_rng(seed)
+  peaks_camera=np.arange(5, duration, camera_interval)+rng.integers(-jitter, jitter+1, size=len(range(5, duration, camera_interval)))
+  peaks_image=np.arange(0, duration, image_interval)+rng.integers(-jitter, jitter+1, size=len(range(0, duration, image_interval)))
+  return np.sort(peaks_camera), np.sort(peaks_image)
+
+
+def match_loop(peaks_camera, peaks_image):
+  """
+  the original loop from detect_camera_imaging_frames2.
+  """
+  image_in_camera_index=np.zeros((peaks_image.shape[0],1), dtype=int)
+  camera_minus_image_index=np.zeros((peaks_image.shape[0],1), dtype=int)
+  for n in range(peaks_image.shape[0]):
+    time_to_camera=np.absolute(peaks_camera-peaks_image[n])
+    image_in_camera_index[n]=np.argmin(time_to_camera)
+    camera_minus_image_index[n]=peaks_camera[image_in_camera_index[n]]-peaks_image[n]
+  return image_in_camera_index, camera_minus_image_index
+
+
+def main(durations=(10**5, 10**6, 4*10**6, 10**7, 10**8), max_loop_duration=4*10**6):
+  print('%12s %10s %10s %12s %12s %8s' % ('samples', 'camera', 'imaging', 'loop (s)', 'sorted (s)', 'same'))
+  for duration in durations:
+    peaks_camera, peaks_image = make_pulse_trains(duration)
+
+    start=time.perf_counter()
+    sorted_result=match_nearest_peaks(peaks_camera, peaks_image)
+    sorted_time=time.perf_counter()-start
+
+    #the loop is too slow for the longest recordings
+    if duration<=max_loop_duration:
+      start=time.perf_counter()
+      loop_result=match_loop(peaks_camera, peaks_image)
+      loop_time='%12.3f' % (time.perf_counter()-start)
+      same=str(all(np.array_equal(a, b) for a, b in zip(loop_result, sorted_result)))
+    else:
+      loop_time='%12s' % '-'
+      same='-'
+
+    print('%12d %10d %10d %s %12.4f %8s' % (duration, len(peaks_camera), len(peaks_image), loop_time, sorted_time, same))
+
+
+if __name__ == '__main__':
+  main()
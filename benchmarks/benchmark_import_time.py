@@ -0,0 +1,62 @@
+"""
+Benchmark for the cold-start import time of the classes (e.g. paid by each worker process of a batch).
+
+Each measurement starts a new python process, so nothing is cached in memory between runs.
+'class only' imports the class module as it is now (heavy dependencies are imported by the methods that use them).
+'with eager imports' first imports the dependencies the class modules used to import at the top
+(matplotlib, seaborn, pandas, cv2, skimage, scipy.signal, scipy.ndimage, ScanImageTiffReader), which is the previous cold start.
+
+Run from the repository directory:
+  python benchmarks/benchmark_import_time.py
+"""
+import os
+import subprocess
+import sys
+import time
+
+repository_directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#top-level imports of the class modules before they were made lazy
+eager_imports='''
+import matplotlib.pyplot
+import seaborn
+import pandas
+import cv2
+import scipy.signal
+import scipy.ndimage
+import skimage.data
+import skimage.registration
+from ScanImageTiffReader import ScanImageTiffReader
+'''
+
+class_imports={'LegVibration_separate_z':'from Python_class_for_preprocessing_and_analyzing_two_photon_imaging_data_piezo_multi_z import LegVibration_separate_z',
+               'AxonRecording_separate_z':'from Python_class_for_preprocessing_and_analyzing_two_photon_imaging_data_AxonRecording_RH_Swing_multi_z import AxonRecording_separate_z'}
+
+
+def cold_start_time(code, repeats=5):
+  """
+  returns the median time (s) to start python and run code in a new process.
+  """
+  times=[]
+  for _ in range(repeats):
+    start=time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=repository_directory, check=True)
+    times.append(time.perf_counter()-start)
+  return sorted(times)[len(times)//2]
+
+
+def main(repeats=5):
+  baseline=cold_start_time('pass', repeats)
+  print('python start: %.3f s' % baseline)
+  print('%-26s %12s %20s' % ('class', 'class only', 'with eager imports'))
+  for class_name, class_import in class_imports.items():
+    lazy=cold_start_time(class_import, repeats)
+    try:
+      eager='%17.3f s' % cold_start_time(eager_imports+class_import, repeats)
+    except subprocess.CalledProcessError:
+      eager='%19s' % 'not installed'
+    print('%-26s %10.3f s %s' % (class_name, lazy, eager))
+
+
+if __name__ == '__main__':
+  main()
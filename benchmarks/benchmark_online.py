@@ -0,0 +1,90 @@
+"""
+Benchmark of the online mode (preprocess_online_separate_z) on a synthetic ScanImage file that is written
+during the benchmark, one volume every volume_interval seconds (see synthetic_data.py).
+
+The latency of each frame (from the arrival of its pages to the end of its processing) is reported with
+the mean, median, 95th percentile and max, and compared to the frame interval (volume_interval/n_of_z):
+the online mode keeps up with the acquisition when the frames are processed faster than they are written.
+The results are checked:
+* volumes: every volume written is processed.
+* registration: the shifts match the known drift, up to a constant offset (the running reference
+starts from the first frame).
+
+Runs offline on a CPU. Needs tifffile to write the ScanImage file. The synthetic images are generated by a thread
+of the same process, so on a machine with few cores the latency includes the time taken by the writer.
+
+Run from the repository directory:
+  python benchmarks/benchmark_online.py
+  python benchmarks/benchmark_online.py --size 200x256x256x3 --volume_interval 0.1
+"""
+import argparse
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from synthetic_data import make_scanimage_file, make_config
+
+
+def main(size='100x128x128x3', volume_interval=0.1, keep=None):
+  n_of_volumes, rows, columns, n_of_z = tuple(int(value) for value in size.split('x'))
+  path=keep if keep is not None else tempfile.mkdtemp(prefix='benchmark_online_')
+  os.makedirs(path, exist_ok=True)
+  data_filepath=os.path.join(path, 'online.tif')
+  config_filepath=os.path.join(path, 'config.yaml')
+  if os.path.exists(data_filepath):
+    os.remove(data_filepath)
+  #the phase normalization does not follow the drift of the smooth synthetic images, see benchmark_pipeline.py
+  make_config(config_filepath, n_of_z, online_idle_timeout=max(2, 20*volume_interval), registration_normalization=None)
+
+  from Python_class_for_preprocessing_and_analyzing_two_photon_imaging_data_piezo_multi_z import LegVibration_separate_z
+  experiment=LegVibration_separate_z(data_filepath, None, config_filepath)
+
+  #the acquisition: write the file in a thread while the online mode reads it
+  drift={}
+  def acquire():
+    drift['drift']=make_scanimage_file(data_filepath, n_of_volumes, n_of_z, rows, columns, volume_interval=volume_interval)
+  writer=threading.Thread(target=acquire)
+  writer.start()
+
+  volumes=[]
+  experiment.preprocess_online_separate_z(callback=lambda volume, registered, maps: volumes.append(volume))
+  writer.join()
+
+  with open(experiment.online_data_path, 'rb') as f:
+    shifts, maps, latency = pickle.load(f)
+  error=shifts+drift['drift'][None,:shifts.shape[1]]
+  error-=error.mean(axis=1,keepdims=True)
+  shift_error=np.sqrt(np.mean(np.square(error)))
+
+  summary=experiment.diagnostics['online_latency']
+  frame_interval_ms=volume_interval/n_of_z*1000
+  print('\n%s: %d volumes, %dx%d pixels, %d z-levels, one volume every %.3f s (a frame every %.1f ms)'
+        % (size, n_of_volumes, rows, columns, n_of_z, volume_interval, frame_interval_ms))
+  print('latency (ms): mean %.1f, median %.1f, 95%% %.1f, max %.1f' % (summary['mean_ms'], summary['median_ms'], summary['p95_ms'], summary['max_ms']))
+  print('keeps up with the acquisition:', 'yes' if summary['p95_ms']<frame_interval_ms else 'no (95% latency above the frame interval)')
+
+  checks=[('volumes', str(n_of_volumes), str(len(volumes)), len(volumes)==n_of_volumes),
+          ('shift error (px)', '<0.25', '%.3f' % shift_error, shift_error<0.25)]
+  all_passed=True
+  for check, expected, found, passed in checks:
+    print('  %-24s expected %-12s found %-12s %s' % (check, expected, found, 'ok' if passed else 'FAILED'))
+    all_passed&=passed
+
+  if keep is None:
+    shutil.rmtree(path)
+  print('\nall checks passed' if all_passed else '\nsome checks FAILED')
+  return all_passed
+
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--size', default='100x128x128x3', help='volumes x rows x columns x n_of_z of the synthetic recording')
+  parser.add_argument('--volume_interval', type=float, default=0.1, help='seconds between the volumes written')
+  parser.add_argument('--keep', default=None, help='directory to keep the recording and the online results in')
+  arguments=parser.parse_args()
+  sys.exit(0 if main(arguments.size, arguments.volume_interval, arguments.keep) else 1)
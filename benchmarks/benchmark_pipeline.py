@@ -0,0 +1,204 @@
+"""
+Benchmark of all methods of LegVibration_separate_z and AxonRecording_separate_z on synthetic recordings
+(see synthetic_data.py) of increasing size, with a check of the results against the ground truth.
+
+For each size (volumes, rows, columns, n_of_z) a recording is generated in a temporary directory and
+every stage is run with profile_path set, so the wall time, CPU time, peak memory and frames/second come from
+the same records as a real run (see profiled_stage). The results are checked:
+* registration: the shifts applied by motion_correction_separate_z (found from its registered images) are checked
+for both registration normalizations:
+  'phase' (the default): the shifts are the same as skimage.registration.phase_cross_correlation of each filtered
+  frame and the average image. Their error from the known drift is only reported (a known failure): after the
+  gaussian filter and the rounding to int16, the whitened spectrum of these synthetic frames is dominated by the
+  image borders and the rounding, so the phase correlation locks onto zero shift and does not follow the drift.
+  None: the shifts match the known drift, up to a constant offset. The stage is run again (not profiled)
+  with registration_normalization None.
+* piezo onsets: the detected start volumes are the synthetic stimulus volumes.
+* camera frames: every imaging frame is matched to a camera frame.
+
+Runs offline on a CPU. Needs tifffile and cv2 to generate the inputs.
+
+Run from the repository directory:
+  python benchmarks/benchmark_pipeline.py
+  python benchmarks/benchmark_pipeline.py --sizes 200x256x256x6 --n_workers 4 --keep /tmp/benchmark
+"""
+import argparse
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from synthetic_data import make_recording
+from Python_functions_for_preprocessing_and_analyzing_two_photon_imaging_data import load_image_stack, register_images_batched
+#the phase correlation that the default registration reproduces
+from skimage.registration import phase_cross_correlation
+
+leg_vibration_stages=['filter_ScanImageFile_separate_z', 'motion_correction_separate_z', 'detect_camera_imaging_frames2',
+                      'detect_piezo_start_frames', 'make_synchronized_video_gray_piezo', 'get_piezo_response_map_separate_z',
+                      'merge_piezo_response_map', 'filter_and_register_separate_z']
+axon_recording_stages=['filter_ScanImageFile_separate_z', 'motion_correction_separate_z', 'detect_camera_imaging_frames2',
+                       'detect_piezo_start_frames', 'make_synchronized_video_gray', 'get_piezo_response_map_separate_z',
+                       'merge_piezo_response_map']
+
+
+def parse_size(size):
+  """
+  '100x128x128x3' -> (volumes, rows, columns, n_of_z)
+  """
+  return tuple(int(value) for value in size.split('x'))
+
+
+def registration_stacks(experiment):
+  """
+  returns the filtered and registered [n_of_z, frames, rows, columns] images of the registration channel.
+  """
+  if experiment.registration_channel==1:
+    return load_image_stack(experiment.gcamp_filtered_path), load_image_stack(experiment.gcamp_registered_path)
+  return load_image_stack(experiment.tdTomato_filtered_path), load_image_stack(experiment.tdTomato_registered_path)
+
+
+def applied_shifts(experiment):
+  """
+  returns the [n_of_z, frames, 2] shifts applied by motion_correction_separate_z. The shift of each frame is found by
+  registering the filtered frame to its registered frame (the same content, so the estimate is exact up to the
+  rounding of the registered images).
+  """
+  filtered, registered = registration_stacks(experiment)
+  n_of_z, n_of_volumes = filtered.shape[:2]
+  scratch=np.empty((1,)+filtered.shape[2:], dtype=filtered.dtype)
+  return np.array([[register_images_batched(registered[z_level,volume], filtered[z_level,volume:volume+1], experiment.upsample,
+                                            scratch, normalization=None)[0] for volume in range(n_of_volumes)] for z_level in range(n_of_z)])
+
+
+def drift_error(shifts, drift):
+  """
+  returns the RMS error (pixels) between [n_of_z, frames, 2] shifts (that register the content back, i.e. -drift + constant)
+  and the known drift, after removing the mean error of each z-level (the average image is not centered on the first volume).
+  """
+  error=shifts+drift[None,:shifts.shape[1]]
+  error-=error.mean(axis=1,keepdims=True)
+  return np.sqrt(np.mean(np.square(error)))
+
+
+def phase_correlation_difference(experiment, shifts):
+  """
+  returns the max difference (pixels) between the shifts and the shifts from skimage.registration.phase_cross_correlation
+  of each filtered frame and the average image of its z-level (the registration done by motion_correction_separate_z).
+  """
+  filtered=registration_stacks(experiment)[0]
+  difference=0
+  for z_level in range(filtered.shape[0]):
+    average_image=np.mean(filtered[z_level],axis=0)
+    for volume in range(filtered.shape[1]):
+      reference_shift=phase_cross_correlation(average_image, filtered[z_level,volume], upsample_factor=experiment.upsample,
+                                              normalization='phase')[0]
+      difference=max(difference, np.max(np.abs(shifts[z_level,volume]-reference_shift)))
+  return difference
+
+
+def registration_checks(experiment, drift):
+  """
+  check the shifts of motion_correction_separate_z with the configured normalization, then run it again
+  (without profiling) with the other one, see the docstring of this file.
+  returns a dictionary of the results for each normalization ('phase' and None).
+  """
+  configured=experiment.registration_normalization
+  results={}
+  for normalization in [configured]+[other for other in ('phase', None) if other!=configured]:
+    if normalization!=configured:
+      experiment.registration_normalization=normalization
+      type(experiment).motion_correction_separate_z.__wrapped__(experiment)
+    shifts=applied_shifts(experiment)
+    results[normalization]={'drift_error':drift_error(shifts, drift)}
+    if normalization=='phase':
+      results[normalization]['phase_correlation_difference']=phase_correlation_difference(experiment, shifts)
+  #the later stages use the registration with the configured normalization
+  if experiment.registration_normalization!=configured:
+    experiment.registration_normalization=configured
+    type(experiment).motion_correction_separate_z.__wrapped__(experiment)
+  return results
+
+
+def run_class(class_name, recording, stages):
+  """
+  run the stages of one class on a synthetic recording.
+  returns the experiment (with its profile_records).
+  """
+  if class_name=='LegVibration_separate_z':
+    from Python_class_for_preprocessing_and_analyzing_two_photon_imaging_data_piezo_multi_z import LegVibration_separate_z
+    experiment=LegVibration_separate_z(recording['data_filepath'], recording['frame_signal_filepath'], recording['config_filepath'])
+  else:
+    from Python_class_for_preprocessing_and_analyzing_two_photon_imaging_data_AxonRecording_RH_Swing_multi_z import AxonRecording_separate_z
+    experiment=AxonRecording_separate_z(recording['data_filepath'], recording['frame_signal_filepath'], recording['video_filepath'],
+                                        recording['config_filepath'])
+  for stage in stages:
+    getattr(experiment, stage)()
+    if stage=='motion_correction_separate_z':
+      experiment.registration_results=registration_checks(experiment, recording['drift'])
+  return experiment
+
+
+def check_results(experiment, recording):
+  """
+  returns a list of (check, expected, found, passed) for one experiment.
+  """
+  phase=experiment.registration_results['phase']
+  no_normalization=experiment.registration_results[None]
+  with open(experiment.piezo_data_path, 'rb') as f:
+    piezo_volumes=np.asarray(pickle.load(f))
+  with open(experiment.frame_data_path, 'rb') as f:
+    image_in_camera_index, _ = pickle.load(f)
+  n_of_frames=recording['drift'].shape[0]*experiment.n_of_z
+
+  drift=recording['drift']
+  drift_rms=np.sqrt(np.mean(np.square(drift-drift.mean(axis=0))))
+  return [("'phase' = skimage (px)", '0', '%.3f' % phase['phase_correlation_difference'], phase['phase_correlation_difference']<1e-6),
+          ("'phase' shift error (px)", 'known failure', '%.3f (drift %.2f)' % (phase['drift_error'], drift_rms), True),
+          ('None shift error (px)', '<0.25', '%.3f (drift %.2f)' % (no_normalization['drift_error'], drift_rms), no_normalization['drift_error']<0.25),
+          ('piezo onsets (volume)', str(recording['stimulus_volumes']), str(piezo_volumes[:,0].tolist()),
+           piezo_volumes[:,0].tolist()==list(recording['stimulus_volumes'])),
+          ('matched frames', '>=%d' % n_of_frames, str(image_in_camera_index.shape[0]), image_in_camera_index.shape[0]>=n_of_frames)]
+
+
+def main(sizes=('100x128x128x3', '200x128x128x3', '100x256x256x3', '100x128x128x6'), n_workers=1, keep=None):
+  all_passed=True
+  for size in sizes:
+    n_of_volumes, rows, columns, n_of_z = parse_size(size)
+    path=keep if keep is not None else tempfile.mkdtemp(prefix='benchmark_pipeline_')
+    path=os.path.join(path, size)
+    profile_path=os.path.join(path, 'profile.jsonl')
+    recording=make_recording(path, n_of_volumes, n_of_z, rows, columns, n_workers=n_workers, profile_path=profile_path)
+    input_mb=os.path.getsize(recording['data_filepath'])/2**20
+
+    print('\n%s: %d volumes, %dx%d pixels, %d z-levels, %.0f MB, %d workers' % (size, n_of_volumes, rows, columns, n_of_z, input_mb, n_workers))
+    print('%-26s %-36s %9s %9s %9s %10s %9s' % ('class', 'stage', 'wall (s)', 'cpu (s)', 'peak MB', 'frames/s', 'MB/s'))
+    for class_name, stages in (('LegVibration_separate_z', leg_vibration_stages), ('AxonRecording_separate_z', axon_recording_stages)):
+      experiment=run_class(class_name, recording, stages)
+      for record in experiment.profile_records:
+        print('%-26s %-36s %9.3f %9.3f %9.0f %10s %9.1f' % (class_name, record['stage'], record['wall_time_s'], record['cpu_time_s'],
+              record['peak_rss_bytes']/2**20, '%.0f' % record['frames_per_second'] if record['frames_per_second'] else '-',
+              input_mb/record['wall_time_s']))
+      for check, expected, found, passed in check_results(experiment, recording):
+        print('  %-24s expected %-12s found %-12s %s' % (check, expected, found, 'ok' if passed else 'FAILED'))
+        all_passed&=passed
+
+    if keep is None:
+      shutil.rmtree(os.path.dirname(path))
+    else:
+      print('records in', profile_path)
+
+  print('\nall checks passed' if all_passed else '\nsome checks FAILED')
+  return all_passed
+
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--sizes', nargs='+', default=['100x128x128x3', '200x128x128x3', '100x256x256x3', '100x128x128x6'],
+                      help='volumes x rows x columns x n_of_z of each synthetic recording')
+  parser.add_argument('--n_workers', type=int, default=1)
+  parser.add_argument('--keep', default=None, help='directory to keep the recordings and the JSON lines records in')
+  arguments=parser.parse_args()
+  sys.exit(0 if main(arguments.sizes, arguments.n_workers, arguments.keep) else 1)
@@ -0,0 +1,104 @@
+"""
+Check of the gaussian filter engines (see gaussian_filter_frames) against scipy.ndimage.gaussian_filter.
+
+A synthetic ScanImage file (see synthetic_data.py) is filtered with filter_ScanImageFile_blocks for each engine,
+sigma, chunk_volumes and n_of_chunks, and the result is compared with scipy.ndimage.gaussian_filter applied to each
+whole z-level of each channel at once. Chunk sizes smaller and larger than the temporal halo (see temporal_halo) check
+that the frames at the chunk boundaries get the same filter as in the whole stack.
+* 'scipy': identical to np.round(gaussian_filter(int16 stack)).
+* 'float32', 'fft': within 1 count of np.round(gaussian_filter(float64 stack)), in at most 0.1% of the pixels
+(the float32 sums round differently when the filtered value is close to .5).
+
+Runs offline on a CPU. Needs tifffile to write the ScanImage file.
+
+Run from the repository directory:
+  python benchmarks/check_gaussian_filter.py
+  python benchmarks/check_gaussian_filter.py --size 60x128x128x3
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from synthetic_data import make_scanimage_file
+from Python_functions_for_preprocessing_and_analyzing_two_photon_imaging_data import filter_ScanImageFile_blocks, temporal_halo
+
+engines=['scipy', 'float32', 'fft']
+sigmas=[[1,2,2], [3,1,1.5]]
+#max difference (counts) and fraction of the pixels that may differ from the reference, for each engine
+tolerances={'scipy':(0, 0), 'float32':(1, 1e-3), 'fft':(1, 1e-3)}
+
+
+def reference_filter(data_filepath, n_of_z, gaussian_sigma, engine):
+  """
+  returns a list with one [n_of_z, frames, rows, columns] array per channel: scipy.ndimage.gaussian_filter of each whole z-level,
+  on the int16 images for the 'scipy' engine and on float64 images for the others.
+  """
+  import tifffile
+  from scipy.ndimage import gaussian_filter
+  pages=tifffile.imread(data_filepath)
+  volumes=pages.reshape(-1, n_of_z, 2, pages.shape[-2], pages.shape[-1])
+  references=[]
+  for channel in range(2):
+    reference=np.empty((n_of_z,)+volumes.shape[:1]+volumes.shape[3:], dtype=np.float64)
+    for z_level in range(n_of_z):
+      images=volumes[:,z_level,channel] if engine=='scipy' else volumes[:,z_level,channel].astype(np.float64)
+      reference[z_level]=np.round(gaussian_filter(images, gaussian_sigma))
+    references.append(reference)
+  return references
+
+
+def streamed_filter(data_filepath, n_of_z, gaussian_sigma, engine, chunk_volumes, n_of_chunks):
+  """
+  returns the filtered images from filter_ScanImageFile_blocks, one [n_of_z, frames, rows, columns] array per channel.
+  """
+  blocks=[[], []]
+  for start, end, filtered_blocks in filter_ScanImageFile_blocks(data_filepath, n_of_z, gaussian_sigma, chunk_volumes=chunk_volumes,
+                                                                 n_of_chunks=n_of_chunks, engine=engine):
+    for channel in range(2):
+      blocks[channel].append(filtered_blocks[channel])
+  return [np.concatenate(channel_blocks, axis=1) for channel_blocks in blocks]
+
+
+def main(size='40x64x64x3', keep=None):
+  n_of_volumes, rows, columns, n_of_z = tuple(int(value) for value in size.split('x'))
+  path=keep if keep is not None else tempfile.mkdtemp(prefix='check_gaussian_filter_')
+  os.makedirs(path, exist_ok=True)
+  data_filepath=os.path.join(path, 'rec.tif')
+  make_scanimage_file(data_filepath, n_of_volumes, n_of_z, rows, columns)
+
+  print('\n%s: %d volumes, %dx%d pixels, %d z-levels' % (size, n_of_volumes, rows, columns, n_of_z))
+  print('%-8s %-12s %6s %8s %6s %10s %12s %s' % ('engine', 'sigma', 'halo', 'chunks', 'split', 'max diff', 'differing', ''))
+  all_passed=True
+  for gaussian_sigma in sigmas:
+    halo=temporal_halo(gaussian_sigma)
+    #chunks smaller than the halo, a little larger, and the whole file at once
+    chunk_sizes=sorted(set([max(1, halo//2), halo+3, n_of_volumes]))
+    for engine in engines:
+      references=reference_filter(data_filepath, n_of_z, gaussian_sigma, engine)
+      max_difference, max_fraction = tolerances[engine]
+      for chunk_volumes in chunk_sizes:
+        for n_of_chunks in (1, 3):
+          filtered=streamed_filter(data_filepath, n_of_z, gaussian_sigma, engine, chunk_volumes, n_of_chunks)
+          differences=np.concatenate([np.abs(filtered[channel]-references[channel]).ravel() for channel in range(2)])
+          passed=(filtered[0].shape==references[0].shape and differences.max()<=max_difference
+                  and np.mean(differences>0)<=max_fraction)
+          print('%-8s %-12s %6d %8d %6d %10.0f %12.2e %s' % (engine, str(gaussian_sigma), halo, chunk_volumes, n_of_chunks,
+                differences.max(), np.mean(differences>0), 'ok' if passed else 'FAILED'))
+          all_passed&=passed
+
+  if keep is None:
+    shutil.rmtree(path)
+  print('\nall checks passed' if all_passed else '\nsome checks FAILED')
+  return all_passed
+
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--size', default='40x64x64x3', help='volumes x rows x columns x n_of_z of the synthetic recording')
+  parser.add_argument('--keep', default=None, help='directory to keep the recording in')
+  arguments=parser.parse_args()
+  sys.exit(0 if main(arguments.size, arguments.keep) else 1)
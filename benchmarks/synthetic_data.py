@@ -0,0 +1,184 @@
+"""
+Synthetic inputs for the benchmarks: ScanImage files, analog signals (.bin), camera videos and config files
+that look like a recording (the ground truth is returned, so the results can be checked).
+
+* **make_scanimage_file**: interleaved 2-channel multi-z int16 stack (pages are volumes x z-levels x channels)
+with a known rigid drift (the same for all z-levels and both channels) and GCaMP responses during the stimuli.
+
+* **make_analog_signals**: 7-channel float64 .bin file with the camera pulse train, the imaging frame (mirror) pulses
+(one per z-level of each volume) and the piezo signal during each stimulus.
+
+* **make_camera_video**: gray camera video with one frame per camera pulse.
+
+* **make_config**: config.yaml that matches the synthetic recording.
+
+* **make_recording**: all of the above in one directory.
+
+Needs tifffile (to write the ScanImage file) and cv2 (camera video).
+"""
+import os
+import time
+import numpy as np
+import yaml
+
+#layout of the analog signals (same channels as the configuration script)
+number_of_channels=7
+camera_channel=1
+imaging_channel=2
+piezo_channel=6
+
+
+def _blob_images(n_of_z, rows, columns, rng):
+  """
+  make a base image for each z-level: a few gaussian blobs (cells) on a textured background, so the
+  registration has structure to lock on to.
+  """
+  yy, xx = np.mgrid[0:rows, 0:columns]
+  images=np.zeros((n_of_z, rows, columns))
+  for z_level in range(n_of_z):
+    images[z_level]=200+20*rng.random((rows, columns))
+    for _ in range(max(4, rows*columns//2000)):
+      row, column = rng.uniform(0, rows), rng.uniform(0, columns)
+      radius=rng.uniform(2, 6)
+      images[z_level]+=rng.uniform(100, 400)*np.exp(-((yy-row)**2+(xx-column)**2)/(2*radius**2))
+  return images
+
+
+def _shift_images(images, shifts):
+  """
+  shift images [n, rows, columns] by shifts [2] (rows, columns) with a Fourier phase ramp (periodic, subpixel).
+  """
+  rows, columns = images.shape[-2:]
+  ramp=np.exp(-2j*np.pi*(shifts[0]*np.fft.fftfreq(rows)[:,None]+shifts[1]*np.fft.fftfreq(columns)[None,:]))
+  return np.fft.ifft2(np.fft.fft2(images)*ramp).real
+
+
+def make_scanimage_file(file_name, n_of_volumes, n_of_z, rows, columns, stimulus_volumes=(), stimulus_length=10,
+                        drift_amplitude=2, drift_period=40, response=0.5, noise=5, seed=0, volume_interval=0):
+  """
+  a function to write a synthetic ScanImage file (pages: volumes x z-levels x [GCaMP, tdTomato]).
+
+  *stimulus_volumes: first volume of each stimulus. GCaMP is (1+response) times brighter for stimulus_length volumes.
+  *drift_amplitude, drift_period: the rigid drift is a slow oscillation (amplitude in pixels, period in volumes)
+  with a random phase in each direction, like the sway of the preparation.
+  *volume_interval: seconds between volumes. With volume_interval>0 the pages are written (and flushed) one at a time
+  like during an acquisition, e.g. to test the online mode on a growing file.
+
+  returns the [n_of_volumes, 2] drift (rows, columns) of the image content in each volume.
+  """
+  import tifffile
+  rng=np.random.default_rng(seed)
+  tdTomato_base=_blob_images(n_of_z, rows, columns, rng)
+  gcamp_base=0.4*tdTomato_base
+  phase=rng.uniform(0, 2*np.pi, 2)
+  drift=drift_amplitude*np.sin(2*np.pi*np.arange(n_of_volumes)[:,None]/drift_period+phase[None,:])
+
+  gain=np.ones(n_of_volumes)
+  for start in stimulus_volumes:
+    gain[start:start+stimulus_length]=1+response
+
+  with tifffile.TiffWriter(file_name, bigtiff=True) as tif:
+    for volume in range(n_of_volumes):
+      pages=np.empty((n_of_z, 2, rows, columns), dtype=np.int16)
+      pages[:,0]=np.clip(_shift_images(gcamp_base*gain[volume], drift[volume])+rng.normal(0, noise, (n_of_z, rows, columns)), -32768, 32767)
+      pages[:,1]=np.clip(_shift_images(tdTomato_base, drift[volume])+rng.normal(0, noise, (n_of_z, rows, columns)), -32768, 32767)
+      if volume_interval>0:
+        for page in pages.reshape(-1, rows, columns):
+          tif.write(page, contiguous=False)
+        tif.filehandle.flush()
+        time.sleep(volume_interval)
+      else:
+        tif.write(pages.reshape(-1, rows, columns), contiguous=True)
+
+  return drift
+
+
+def make_analog_signals(file_name, n_of_volumes, n_of_z, stimulus_volumes=(), stimulus_length=10,
+                        samples_per_frame=400, camera_period=130, start_sample=500, noise=0.01, seed=0):
+  """
+  a function to write synthetic analog signals ([samples, 7] float64, channels interleaved).
+  The imaging channel has one pulse per imaging frame (z-level) starting at start_sample, the camera channel
+  a pulse every camera_period samples and the piezo channel a 37-sample sine wave from the start of each stimulus
+  volume for stimulus_length volumes.
+
+  returns the number of camera frames.
+  """
+  rng=np.random.default_rng(seed)
+  n_of_frames=n_of_volumes*n_of_z
+  n_of_samples=start_sample+n_of_frames*samples_per_frame+2000
+  signals=rng.normal(0, noise, (n_of_samples, number_of_channels))
+
+  camera_starts=np.arange(100, n_of_samples-20, camera_period)
+  for start in camera_starts:
+    signals[start:start+40, camera_channel]+=5
+
+  for frame in range(n_of_frames):
+    start=start_sample+frame*samples_per_frame
+    signals[start:start+samples_per_frame//2, imaging_channel]+=5
+
+  for volume in stimulus_volumes:
+    #the stimulus starts during the last z-level of the previous volume (see detect_piezo_start_frames)
+    start=start_sample+(volume*n_of_z-1)*samples_per_frame
+    end=start_sample+(volume+stimulus_length)*n_of_z*samples_per_frame
+    signals[start:end, piezo_channel]+=2*(1+np.sin(2*np.pi*np.arange(end-start)/37.))
+
+  signals.tofile(file_name)
+  return len(camera_starts)
+
+
+def make_camera_video(file_name, n_of_frames, width=96, height=72, frames_per_second=30):
+  """
+  a function to write a synthetic camera video (each frame has a different gray level and its number).
+  """
+  import cv2
+  video=cv2.VideoWriter(file_name, cv2.VideoWriter_fourcc(*'mp4v'), frames_per_second, (width, height))
+  for frame_number in range(n_of_frames):
+    frame=np.full((height, width, 3), (frame_number*7)%255, np.uint8)
+    cv2.putText(frame, str(frame_number), (5, height//2), 0, 1, (255, 255, 255))
+    video.write(frame)
+  video.release()
+
+
+def make_config(file_name, n_of_z, stimulus_length=10, samples_per_frame=400, **parameters):
+  """
+  a function to write a config.yaml for the synthetic recordings. parameters overwrite the defaults
+  (e.g. n_workers, profile_path).
+  """
+  config={'gaussian_filter':[1,2,2], 'number_of_channels':number_of_channels, 'camera_channel':camera_channel,
+          'imaging_channel':imaging_channel, 'piezo_channel':piezo_channel,
+          'c_height':0.3, 'c_width':0.1, 'c_distance':50, 'i_height':1, 'i_width':1, 'i_distance':100,
+          'window_width':1, 'skip_interval':2*stimulus_length*n_of_z*samples_per_frame, 'n_of_z':n_of_z,
+          'frames_per_second':10, 'min_range1':25, 'max_range1':700, 'min_range2':10, 'max_range2':200,
+          'min_range3':0, 'max_range3':2, 'gcamp_threshold_ratio':0.9, 'tdTomato_threshold':40, 'ratio_threshold':0.1,
+          'response_range':stimulus_length//2, 'base_range':stimulus_length//2, 'upsample':4, 'registration_channel':2,
+          'plot':False}
+  config.update(parameters)
+  with open(file_name, 'w') as yaml_file:
+    yaml.dump([config], yaml_file)
+
+
+def make_recording(path, n_of_volumes, n_of_z, rows, columns, n_of_stimuli=2, stimulus_length=10, video=True, seed=0, **parameters):
+  """
+  a function to write a synthetic recording (rec.tif, rec.bin, rec.mp4, config.yaml) into path.
+  The stimuli are evenly spaced, at least 3*stimulus_length volumes apart (the debounce is 2*stimulus_length).
+
+  returns a dictionary with the file paths and the ground truth (drift, stimulus_volumes).
+  """
+  os.makedirs(path, exist_ok=True)
+  spacing=n_of_volumes//(n_of_stimuli+1)
+  if spacing<3*stimulus_length:
+    raise ValueError('%d volumes is too short for %d stimuli of %d volumes' % (n_of_volumes, n_of_stimuli, stimulus_length))
+  stimulus_volumes=[spacing*(stimulus+1) for stimulus in range(n_of_stimuli)]
+
+  recording={'data_filepath':os.path.join(path, 'rec.tif'), 'frame_signal_filepath':os.path.join(path, 'rec.bin'),
+             'video_filepath':os.path.join(path, 'rec.mp4'), 'config_filepath':os.path.join(path, 'config.yaml'),
+             'stimulus_volumes':stimulus_volumes}
+  recording['drift']=make_scanimage_file(recording['data_filepath'], n_of_volumes, n_of_z, rows, columns, stimulus_volumes,
+                                         stimulus_length, seed=seed)
+  n_of_camera_frames=make_analog_signals(recording['frame_signal_filepath'], n_of_volumes, n_of_z, stimulus_volumes,
+                                         stimulus_length, seed=seed)
+  if video:
+    make_camera_video(recording['video_filepath'], n_of_camera_frames+5)
+  make_config(recording['config_filepath'], n_of_z, stimulus_length, **parameters)
+
+  return recording
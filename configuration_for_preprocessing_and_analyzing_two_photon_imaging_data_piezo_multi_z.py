@@ -13,6 +13,7 @@ parameter_file = [
                   'i_distance': 100, #image frame detection interpeak distance
                   'window_width': 1, # width of window average
                   'skip_interval': 100000, # number of sample point to skip after the initial piezo detection
+                  'piezo_debounce': 100000, # minimum number of samples between the starts of two piezo stimuli (all stimuli are detected)
                   'n_of_z': 6, #number of z levels in the image
                   'frames_per_second': 10, # number of frames per second for the new video
                   'min_range1': 25, # min value for the tdTomato channel
@@ -26,8 +27,39 @@ parameter_file = [
                   'ratio_threshold': 0.1,#threshold for gcamp/tdTomato ratio to calculate the DR/R
                   'response_range': 20, #number of frames after the start of the piezo stimulus to use as the response
                   'base_range': 20, #number of frames before the start of the piezo stimulus to use as the baseline
+                  'map_dtype': 'float64', # 'float64' or 'float32' (half the memory, slightly different rounding) for the response maps
+                  'trace_baseline_window': 101, #get_pixel_traces_separate_z: number of frames (volumes) of the running baseline of each pixel
+                  'trace_baseline_percentile': 10, #percentile of the frames in the window used as the baseline F0 (and R0)
+                  'trace_baseline_step': 25, #the baseline is calculated every trace_baseline_step frames and interpolated in between (1: every frame)
+                  'trace_chunk_frames': 100, #number of frames of each z-level processed at a time
+                  'trace_gcamp_threshold': 0, #DF/F and DR/R are 0 where the GCaMP baseline is below this value
+                  'online_filter_tau': None, #preprocess_online_separate_z: time constant (volumes) of the causal temporal filter (None: the temporal sigma of gaussian_filter)
+                  'online_reference_tau': 100, #time constant (volumes) of the running reference image used to register each frame
+                  'online_baseline_tau': 100, #time constant (volumes) of the baseline of the live DF/F and DR/R maps
+                  'online_response_tau': 3, #time constant (volumes) of the response of the live DF/F and DR/R maps
+                  'online_poll_interval': 0.05, #seconds between checks for new pages in the ScanImage file
+                  'online_idle_timeout': 10, #the acquisition has ended when no new page is written for this many seconds
+                  'roi_filepath': None, #get_roi_traces_separate_z: pickle file with a list of (z_level, polygon points [[x, y], ...]) ROIs, e.g. from bbox_select
+                  'plot': True, # show the diagnostic plots (set to False for batch processing, the arrays are kept in .diagnostics)
                   'upsample': 4, # upsampling factor. Will register to 1/upsample pixels
-                  'registration_channel': 2 # imaging channel to use for registering images
+                  'registration_channel': 2, # imaging channel to use for registering images
+                  'registration_normalization': 'phase', # 'phase' (same as phase_cross_correlation) or None (cross-correlation without normalization)
+                  'registration_reference': 'average', # motion_correction_separate_z: 'average' (average of all frames), 'exponential' or 'window' (running average of the registered frames, one pass, follows slow drift)
+                  'reference_tau': 100, # time constant (frames) of the 'exponential' running reference
+                  'reference_window': 100, # number of frames of the 'window' running reference
+                  'volume_registration': False, # motion_correction_separate_z with the 'average' reference: one shift per volume from the projection over z (rigid preparations, fewer shift estimates)
+                  'volume_projection': 'max', # projection over z used by volume_registration: 'max' or 'mean'
+                  'volume_refine_threshold': None, # residual shift (pixels) above which a frame is registered per z-level with volume_registration, None: no refinement
+                  'registration_block_size': 32, # number of frames registered at a time (larger is faster but uses more memory)
+                  'n_workers': 1, # number of threads (or processes) to process z-levels and frame chunks (and compose video frames) in parallel
+                  'parallel_backend': 'thread', # 'thread' (default, no copy of the images) or 'process'
+                  'read_chunk_volumes': 100, # number of volumes read from the ScanImage file at a time
+                  'filter_engine': 'scipy', # 'scipy' (int16, same as before), 'float32' (less memory, rounded once) or 'fft' (for large spatial sigma)
+                  'fused_reference_volumes': None, # filter_and_register_separate_z: None registers to the average of all volumes (reads the file twice), N to the average of the first N volumes (reads the file once)
+                  'cache_directory': None, # directory to cache the filtered and registered images (None: no cache). Same file and parameters -> outputs are reused
+                  'cache_max_gb': 100, # maximum size of the cache directory in GB (least recently used outputs are deleted first)
+                  'profile_path': None, # file to append the time, memory and I/O of each stage as JSON lines (None disables it)
+                  'profile_cprofile': False # also save a cProfile (.prof) of each stage next to the data file
                    }
 ]
 